@@ -28,6 +28,8 @@ from mergin.sync.tasks import (
     remove_temp_files,
     remove_projects_backups,
     remove_unused_chunks,
+    remove_unused_checksums,
+    remove_push_jobs,
 )
 from mergin.celery import celery, configure_celery
 from mergin.stats.config import Configuration
@@ -95,3 +97,13 @@ def setup_periodic_tasks(sender, **kwargs):
         remove_unused_chunks,
         name="clean up of outdated chunks",
     )
+    sender.add_periodic_task(
+        crontab(hour=4, minute=0),
+        remove_unused_checksums,
+        name="clean up of unused checksum cache",
+    )
+    sender.add_periodic_task(
+        crontab(hour=4, minute=30),
+        remove_push_jobs,
+        name="clean up of finished push jobs",
+    )
@@ -5,6 +5,7 @@
 import hashlib
 import logging
 import os
+from datetime import datetime
 import connexion
 import wtforms_json
 import gevent
@@ -159,7 +160,7 @@ def create_app(public_keys: List[str] = None) -> Flask:
     from .sync.app import register as register_sync
     from .sync.project_handler import ProjectHandler
     from .sync.utils import get_blacklisted_dirs, get_blacklisted_files
-    from .sync.workspace import GlobalWorkspaceHandler
+    from .sync.workspace import CachedWorkspaceHandler, GlobalWorkspaceHandler
 
     app = create_simple_app().connexion_app
 
@@ -422,6 +423,10 @@ def create_app(public_keys: List[str] = None) -> Flask:
 
     # we need to register default handler to be accessible within app
     application.ws_handler = GlobalWorkspaceHandler()
+    if Configuration.WORKSPACE_CACHE_TTL > 0:
+        application.ws_handler = CachedWorkspaceHandler(
+            application.ws_handler, Configuration.WORKSPACE_CACHE_TTL
+        )
     application.project_handler = ProjectHandler()
 
     # append config route with settings from app.config needed by clients
@@ -448,9 +453,17 @@ def create_app(public_keys: List[str] = None) -> Flask:
     return application
 
 
+DATETIME_WITH_Z_FORMAT = "%Y-%m-%dT%H:%M:%S%zZ"
+
+
 class DateTimeWithZ(fields.DateTime):
     def __init__(self, **kwargs):
-        super(DateTimeWithZ, self).__init__("%Y-%m-%dT%H:%M:%S%zZ", **kwargs)
+        super(DateTimeWithZ, self).__init__(DATETIME_WITH_Z_FORMAT, **kwargs)
+
+
+def datetime_with_z(value: Optional[datetime]) -> Optional[str]:
+    """Serialize datetime the same way as DateTimeWithZ field"""
+    return value.strftime(DATETIME_WITH_Z_FORMAT) if value is not None else None
 
 
 def parse_version_string(version: str) -> Optional[Dict]:
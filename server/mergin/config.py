@@ -92,6 +92,8 @@ class Configuration(object):
     GLOBAL_READ = config("GLOBAL_READ", default=False, cast=bool)
     GLOBAL_WRITE = config("GLOBAL_WRITE", default=False, cast=bool)
     GLOBAL_ADMIN = config("GLOBAL_ADMIN", default=False, cast=bool)
+    # time in seconds global workspace looked up by id or name is cached in process, 0 disables the cache
+    WORKSPACE_CACHE_TTL = config("WORKSPACE_CACHE_TTL", default=60, cast=int)
 
     # can users create their own account or is it reserved for superuser only
     USER_SELF_REGISTRATION = config("USER_SELF_REGISTRATION", default=False, cast=bool)
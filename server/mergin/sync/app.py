@@ -7,6 +7,7 @@ from flask import Flask
 from .commands import add_commands
 from .config import Configuration
 from .db_events import register_events
+from .delta import DeltaCache
 
 
 def register(app: Flask):
@@ -15,6 +16,11 @@ def register(app: Flask):
     Register db events/hooks.
     """
     app.config.from_object(Configuration)
+    app.delta_cache = DeltaCache(
+        app.config["DELTA_CACHE_SIZE"],
+        app.config["DELTA_CACHE_URL"],
+        app.config["DELTA_CACHE_TTL"],
+    )
 
     app.connexion_app.add_api(
         "sync/public_api.yaml",
@@ -0,0 +1,156 @@
+# Copyright (C) Lutra Consulting Limited
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-MerginMaps-Commercial
+
+"""Construction of merged diff files (diff checkpoints) of versioned files.
+
+Merges of different files, or of sibling checkpoints of the same file, do not depend on each other.
+As geodiff is CPU bound, they can be run in pool of processes rather than one after another.
+"""
+
+from __future__ import annotations
+import logging
+import multiprocessing
+import os
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import suppress
+from dataclasses import dataclass
+from typing import Callable, List, Optional
+
+from pygeodiff import GeoDiff
+from pygeodiff.geodifflib import GeoDiffLibError, GeoDiffLibConflictError
+
+from .storages.disk import copy_file, exclusive_lock
+from .utils import generate_checksum
+
+# seconds to wait for checkpoint which is being constructed by other worker, if lock is not waited for
+LOCK_TIMEOUT = 60
+
+
+@dataclass
+class DiffMerge:
+    """Merge of diff files (in order) into a checkpoint diff file"""
+
+    sources: List[str]
+    output: str
+
+
+@dataclass
+class DiffMergeResult:
+    """Outcome of a diff merge with size and checksum of the created checkpoint"""
+
+    output: str
+    sources_count: int
+    size: Optional[int] = None
+    checksum: Optional[str] = None
+    duration: float = 0.0
+    error: Optional[str] = None
+
+
+def merge_diffs(
+    merge: DiffMerge, geodiff: GeoDiff, wait: bool = False
+) -> DiffMergeResult:
+    """Create checkpoint diff file by merging source diffs.
+
+    Checkpoint is locked while it is constructed, so it is normally not built by two workers at once.
+    If lock is not waited for (e.g. in gevent hub) it is polled for up to LOCK_TIMEOUT seconds.
+    Checkpoint is written to temporary file and moved in place once complete, so existing file
+    is always complete and it is used if it was constructed by other worker meanwhile.
+    """
+    start = time.monotonic()
+    result = DiffMergeResult(output=merge.output, sources_count=len(merge.sources))
+    # create diffs directory if not exists and subfolders in case of diffs/subfolder/diff-file
+    os.makedirs(os.path.dirname(merge.output), exist_ok=True)
+    lock_path = f"{merge.output}.lock"
+    tmp_path = f"{merge.output}.{uuid.uuid4()}.tmp"
+    try:
+        if not os.path.exists(merge.output):
+            with exclusive_lock(lock_path, wait=wait, timeout=LOCK_TIMEOUT):
+                try:
+                    if not os.path.exists(merge.output):
+                        if len(merge.sources) == 1:
+                            # geodiff.concat_changes is not able to concat one diff, copy it as a checkpoint
+                            copy_file(merge.sources[0], tmp_path)
+                        else:
+                            geodiff.concat_changes(merge.sources, tmp_path)
+                        os.replace(tmp_path, merge.output)
+                finally:
+                    # lock file is not needed anymore, it might have been removed by other worker already
+                    with suppress(FileNotFoundError):
+                        os.remove(lock_path)
+        result.size = os.path.getsize(merge.output)
+        result.checksum = generate_checksum(merge.output)
+    except BlockingIOError:
+        result.error = "Checkpoint is being constructed by another worker"
+    except (GeoDiffLibError, GeoDiffLibConflictError) as e:
+        result.error = f"Geodiff: Failed to merge diffs: {e}"
+    except OSError as e:
+        result.error = f"Failed to create checkpoint: {e}"
+    if result.error:
+        with suppress(FileNotFoundError):
+            os.remove(tmp_path)
+    result.duration = time.monotonic() - start
+    return result
+
+
+_process_geodiff = None
+
+
+def _merge_in_process(merge: DiffMerge) -> DiffMergeResult:
+    """Merge diffs in pool process, with geodiff instance of the process"""
+    global _process_geodiff
+    if _process_geodiff is None:
+        _process_geodiff = GeoDiff()
+    return merge_diffs(merge, _process_geodiff, wait=True)
+
+
+class CheckpointExecutor:
+    """Run independent diff merges concurrently in pool of processes, results are in order of merges.
+
+    Processes are spawned, so they do not inherit database connections or gevent hub of the parent.
+    Pool is started for each executor, hence it is meant for background tasks, not for request handlers.
+    With a single worker merges run sequentially in the current thread.
+    """
+
+    def __init__(self, workers: int = 1):
+        self.workers = workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def __enter__(self) -> CheckpointExecutor:
+        if self.workers > 1:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._executor:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def run(
+        self, merges: List[DiffMerge], geodiff: Callable[[], GeoDiff]
+    ) -> List[DiffMergeResult]:
+        """Run merges and report size and timing of each of them.
+
+        Geodiff instance for merges in current process is provided by callable.
+        """
+        if self._executor and len(merges) > 1:
+            results = list(self._executor.map(_merge_in_process, merges))
+        else:
+            results = [merge_diffs(merge, geodiff()) for merge in merges]
+
+        for result in results:
+            if result.error:
+                logging.error(
+                    f"Failed to merge {result.sources_count} diffs into {result.output}: {result.error}"
+                )
+            else:
+                logging.info(
+                    f"Merged {result.sources_count} diffs into {result.output} "
+                    f"({result.size} bytes) in {result.duration:.3f} s"
+                )
+        return results
@@ -13,7 +13,7 @@ from sqlalchemy import func
 
 from ..app import db
 from .models import Project, ProjectVersion
-from .utils import split_project_path
+from .utils import is_qgis, split_project_path
 from ..auth.models import User
 from ..commands import normalize_input
 
@@ -174,3 +174,57 @@ def add_commands(app: Flask):
 
         project.get_delta_changes(since, to)
         click.secho("Project checkpoint(s) created", fg="green")
+
+    @project.command()
+    @click.argument(
+        "project-name", required=False, callback=normalize_input(lowercase=False)
+    )
+    @click.option("--fix", is_flag=True, help="Save recomputed values")
+    def check_stats(project_name=None, fix=False):
+        """Recompute disk usage, number of QGIS files and tags of projects from their files and report inconsistencies"""
+        query = Project.query.filter(Project.storage_params.isnot(None))
+        if project_name:
+            ws, name = split_project_path(project_name)
+            workspace = current_app.ws_handler.get_by_name(ws)
+            if not workspace:
+                click.secho("ERROR: Workspace does not exist", fg="red", err=True)
+                sys.exit(1)
+            query = query.filter_by(workspace_id=workspace.id, name=name)
+        projects = query.all()
+        if project_name and not projects:
+            click.secho("ERROR: Project does not exist", fg="red", err=True)
+            sys.exit(1)
+
+        inconsistent = 0
+        for p in projects:
+            files = p.files
+            disk_usage = sum(f.size for f in files)
+            qgis_files_count = sum(1 for f in files if is_qgis(f.path))
+            tags = ProjectVersion.qgis_tags(qgis_files_count)
+            if (
+                p.disk_usage == disk_usage
+                and p.qgis_files_count == qgis_files_count
+                and sorted(p.tags or []) == sorted(tags)
+            ):
+                continue
+
+            inconsistent += 1
+            click.secho(
+                f"{p.workspace.name}/{p.name}: disk usage {p.disk_usage} (expected {disk_usage}), "
+                f"QGIS files {p.qgis_files_count} (expected {qgis_files_count}), "
+                f"tags {p.tags} (expected {tags})",
+                fg="yellow",
+            )
+            if fix:
+                p.disk_usage = disk_usage
+                p.qgis_files_count = qgis_files_count
+                p.tags = tags
+
+        if fix and inconsistent:
+            db.session.commit()
+            click.secho(f"Fixed {inconsistent} project(s)", fg="green")
+        elif inconsistent:
+            click.secho(f"Found {inconsistent} inconsistent project(s)", fg="red")
+            sys.exit(1)
+        else:
+            click.secho("Project stats are consistent", fg="green")
@@ -62,6 +62,9 @@ class Configuration(object):
         "GEODIFF_WORKING_DIR",
         default=os.path.join(LOCAL_PROJECTS, "geodiff_tmp"),
     )
+    # apply and construct diffs directly in upload directory (with reflink clone of basefile where supported)
+    # instead of working on copies in GEODIFF_WORKING_DIR, which is then used only as a fallback
+    GEODIFF_IN_PLACE = config("GEODIFF_IN_PLACE", default=True, cast=bool)
     # in seconds, older unfinished zips are moved to temp
     PARTIAL_ZIP_EXPIRATION = config("PARTIAL_ZIP_EXPIRATION", default=600, cast=int)
     # whether new push is allowed
@@ -82,5 +85,46 @@ class Configuration(object):
     )
     # files that should be ignored during extension and MIME type checks
     UPLOAD_FILES_WHITELIST = config("UPLOAD_FILES_WHITELIST", default="", cast=Csv())
+    # files of project versions are stored at each checkpoint of this rank (every LOG_BASE ** rank versions)
+    # and used as a starting point to resolve files of later versions
+    FILES_SNAPSHOT_RANK = config("FILES_SNAPSHOT_RANK", default=3, cast=int)
+    # build delta checkpoints in background once pushed version completes them (every LOG_BASE versions)
+    EAGER_CHECKPOINTS = config("EAGER_CHECKPOINTS", default=True, cast=bool)
+    # construct also merged diff files of versioned files for eagerly built checkpoints
+    EAGER_CHECKPOINT_DIFFS = config("EAGER_CHECKPOINT_DIFFS", default=False, cast=bool)
+    # number of processes merging independent diff checkpoints concurrently in background task (1 means sequential merging)
+    CHECKPOINT_WORKERS = config("CHECKPOINT_WORKERS", default=1, cast=int)
+    # max total size (in characters of serialized json) of delta responses cached in process, 0 disables the cache
+    DELTA_CACHE_SIZE = config("DELTA_CACHE_SIZE", default=64 * 1024 * 1024, cast=int)
+    # url of redis shared by all workers to cache delta responses (e.g. redis://redis:6379/1), empty value disables it
+    DELTA_CACHE_URL = config("DELTA_CACHE_URL", default="")
+    # time in seconds delta responses are kept in shared cache, 0 means no expiration
+    DELTA_CACHE_TTL = config("DELTA_CACHE_TTL", default=24 * 3600, cast=int)
     # max batch size for fetch projects in batch endpoint
     MAX_BATCH_SIZE = config("MAX_BATCH_SIZE", default=100, cast=int)
+    # max time in seconds upload of asynchronous push is kept locked while its job waits in celery queue
+    PUSH_JOB_LOCK_EXPIRATION = config(
+        "PUSH_JOB_LOCK_EXPIRATION", default=3600, cast=int
+    )
+    # time in days after which asynchronous push jobs are removed
+    PUSH_JOB_EXPIRATION = config("PUSH_JOB_EXPIRATION", default=7, cast=int)
+    # number of files processed concurrently when push is finished (1 means sequential processing)
+    UPLOAD_PROCESSING_WORKERS = config("UPLOAD_PROCESSING_WORKERS", default=1, cast=int)
+    # size of blocks for streaming file I/O (copies, checksums, downloads), in bytes
+    IO_BLOCK_SIZE = config("IO_BLOCK_SIZE", default=1024 * 1024, cast=int)
+    # max time spent in file I/O loop before yielding to other greenlets, in milliseconds
+    IO_YIELD_INTERVAL = config("IO_YIELD_INTERVAL", default=5, cast=int)
+    # copy files within kernel (reflink, copy_file_range, sendfile) where filesystem supports it
+    IO_COPY_OFFLOAD = config("IO_COPY_OFFLOAD", default=True, cast=bool)
+    # how project files are copied when project is cloned (reflink, hardlink), regular copy is the fallback
+    CLONE_COPY_STRATEGIES = config(
+        "CLONE_COPY_STRATEGIES", default="reflink,hardlink", cast=Csv()
+    )
+    # compute file checksums in gevent native thread pool so that hashing does not block other greenlets
+    CHECKSUM_THREADPOOL = config("CHECKSUM_THREADPOOL", default=True, cast=bool)
+    # directory for cached checksums of files keyed by (inode, mtime, size), empty value disables the cache
+    CHECKSUM_CACHE_DIR = config("CHECKSUM_CACHE_DIR", default="")
+    # time in days after which unused checksum cache entries are removed
+    CHECKSUM_CACHE_EXPIRATION = config(
+        "CHECKSUM_CACHE_EXPIRATION", default=30, cast=int
+    )
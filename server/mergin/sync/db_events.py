@@ -6,8 +6,9 @@ import os
 from flask import current_app, abort
 from sqlalchemy import event
 
-from .models import ProjectVersion
-from .tasks import optimize_storage
+from .models import ProjectVersion, push_finished
+from .tasks import create_checkpoints, optimize_storage
+from .utils import LOG_BASE
 from ..app import db
 
 
@@ -22,11 +23,19 @@ def optimize_gpgk_storage(mapper, connection, project_version):
         optimize_storage.delay(project_version.project_id)
 
 
+def create_checkpoints_after_push(project_version):
+    # checkpoints of higher ranks can be completed only by every LOG_BASE-th version
+    if current_app.config["EAGER_CHECKPOINTS"] and not project_version.name % LOG_BASE:
+        create_checkpoints.delay(str(project_version.project_id), project_version.name)
+
+
 def register_events():
     event.listen(db.session, "before_commit", check)
     event.listen(ProjectVersion, "after_insert", optimize_gpgk_storage)
+    push_finished.connect(create_checkpoints_after_push)
 
 
 def remove_events():
     event.remove(db.session, "before_commit", check)
     event.listen(ProjectVersion, "after_insert", optimize_gpgk_storage)
+    push_finished.disconnect(create_checkpoints_after_push)
@@ -0,0 +1,259 @@
+# Copyright (C) Lutra Consulting Limited
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-MerginMaps-Commercial
+
+"""Merging of project delta changes.
+
+Changes json (as stored in ProjectVersionDelta.changes) is decoded directly into compact records,
+which are merged by a module level transition table. Dataclasses and schemas are only used for merged result.
+"""
+
+from __future__ import annotations
+import logging
+from collections import OrderedDict
+from enum import Enum
+from operator import attrgetter
+from typing import Dict, List, Optional, Set
+
+import redis
+
+from .files import DeltaChange, DeltaChangeMerged, DeltaDiffFile, PushChangeType
+
+
+class ChangeComparisonAction(Enum):
+    """Actions to take when comparing two changes"""
+
+    REPLACE = "replace"
+    UPDATE_METADATA = "update_metadata"  # Update metadata and keep diffs (used for update + update sequence)
+    REPLACE_DIFFS = "replace_diffs"  # Replace diffs but keep metadata (used for update + update sequence when only diffs are changed)
+    EXCLUDE = "exclude"  # Return None to exclude the file
+    FORCE_UPDATE = (
+        "force_update"  # Force update even if it looks like a delete + create sequence
+    )
+
+
+CREATE = PushChangeType.CREATE
+UPDATE = PushChangeType.UPDATE
+DELETE = PushChangeType.DELETE
+UPDATE_DIFF = PushChangeType.UPDATE_DIFF
+
+# action for (previous change, new change) of file which was created within merged range
+CHANGE_TRANSITIONS: Dict[tuple, ChangeComparisonAction] = {
+    # CREATE + DELETE: file didn't exist before, the pair cancels out
+    (CREATE, DELETE): ChangeComparisonAction.EXCLUDE,
+    # create + update = create with updated info
+    (CREATE, UPDATE): ChangeComparisonAction.UPDATE_METADATA,
+    (CREATE, UPDATE_DIFF): ChangeComparisonAction.UPDATE_METADATA,
+    (CREATE, CREATE): ChangeComparisonAction.REPLACE,
+    # update + update_diff = update with latest info
+    (UPDATE, UPDATE_DIFF): ChangeComparisonAction.UPDATE_METADATA,
+    (UPDATE, UPDATE): ChangeComparisonAction.REPLACE,
+    (UPDATE, DELETE): ChangeComparisonAction.REPLACE,
+    (UPDATE, CREATE): ChangeComparisonAction.REPLACE,
+    # update_diff + update_diff = update_diff with latest info with proper order of diffs
+    (UPDATE_DIFF, UPDATE_DIFF): ChangeComparisonAction.REPLACE_DIFFS,
+    (UPDATE_DIFF, UPDATE): ChangeComparisonAction.REPLACE,
+    (UPDATE_DIFF, DELETE): ChangeComparisonAction.REPLACE,
+    (UPDATE_DIFF, CREATE): ChangeComparisonAction.REPLACE,
+    (DELETE, CREATE): ChangeComparisonAction.FORCE_UPDATE,
+    # delete + update = replace it (used for multicheckpoint ranges when we want to keep file in history even if it was deleted in the middle, so we keep delete but update metadata and diffs)
+    (DELETE, UPDATE): ChangeComparisonAction.REPLACE,
+    (DELETE, UPDATE_DIFF): ChangeComparisonAction.EXCLUDE,
+    (DELETE, DELETE): ChangeComparisonAction.REPLACE,
+}
+
+# action for (previous change, new change) of file which existed before merged range
+EXISTING_FILE_CHANGE_TRANSITIONS: Dict[tuple, ChangeComparisonAction] = {
+    **CHANGE_TRANSITIONS,
+    # keep the DELETE so the client removes its local copy
+    (CREATE, DELETE): ChangeComparisonAction.REPLACE,
+}
+
+_CHANGE_TYPES = {c.value: c for c in PushChangeType}
+_version = attrgetter("version")
+
+
+class DeltaRecord:
+    """Change of file in delta, diffs are ids of diff files in order they should be applied"""
+
+    __slots__ = ("path", "size", "checksum", "change", "version", "diffs")
+
+    def __init__(
+        self,
+        path: str,
+        size: int,
+        checksum: str,
+        change: PushChangeType,
+        version: int,
+        diffs: Optional[List[str]] = None,
+    ):
+        self.path = path
+        self.size = size
+        self.checksum = checksum
+        self.change = change
+        self.version = version
+        self.diffs = diffs
+
+    @classmethod
+    def from_change(cls, item: DeltaChange) -> DeltaRecord:
+        return cls(
+            item.path,
+            item.size,
+            item.checksum,
+            item.change,
+            item.version,
+            [item.diff] if item.diff else None,
+        )
+
+    def to_merged(self) -> DeltaChangeMerged:
+        return DeltaChangeMerged(
+            path=self.path,
+            size=self.size,
+            checksum=self.checksum,
+            change=self.change,
+            version=self.version,
+            diffs=[DeltaDiffFile(id=d) for d in self.diffs or []],
+        )
+
+    def to_json(self, diff: Optional[str] = None) -> Dict:
+        """Dump to changes json item with single diff file, equivalent of DeltaChangeSchema().dump"""
+        assert (
+            self.change is not UPDATE_DIFF or diff
+        ), "Diff file must be provided for update_diff change type"
+        data = {
+            "path": self.path,
+            "size": self.size,
+            "checksum": self.checksum,
+            "version": self.version,
+            "change": self.change.value,
+        }
+        if diff:
+            data["diff"] = diff
+        return data
+
+
+def decode_changes(changes: List[Dict]) -> List[DeltaRecord]:
+    """Decode changes json (e.g. ProjectVersionDelta.changes) into records, without schema validation"""
+    return [
+        DeltaRecord(
+            item["path"],
+            item["size"],
+            item["checksum"],
+            _CHANGE_TYPES[item["change"]],
+            item["version"],
+            [item["diff"]] if item.get("diff") else None,
+        )
+        for item in changes
+    ]
+
+
+def merge_records(records: List[DeltaRecord]) -> List[DeltaRecord]:
+    """Merge changes into one change per file (or none if file changes cancel out).
+
+    Records are sorted by version and may be modified in place, hence they should not be used afterwards.
+    """
+    # track existing paths to avoid deleting files that are already in history before
+    existing_files: Set[str] = set()
+    result: Dict[str, DeltaRecord] = {}
+    records.sort(key=_version)
+    for record in records:
+        path = record.path
+        previous = result.get(path)
+        # first change for this file
+        if previous is None:
+            result[path] = record
+            if record.change is not CREATE:
+                existing_files.add(path)
+            continue
+
+        transitions = (
+            EXISTING_FILE_CHANGE_TRANSITIONS
+            if path in existing_files
+            else CHANGE_TRANSITIONS
+        )
+        action = transitions.get((previous.change, record.change))
+        if action is ChangeComparisonAction.REPLACE:
+            result[path] = record
+        elif action is ChangeComparisonAction.FORCE_UPDATE:
+            # previous change was delete and new change is create - just revert to update with new metadata
+            record.change = UPDATE
+            record.diffs = None
+            result[path] = record
+        elif action is ChangeComparisonAction.UPDATE_METADATA:
+            # previous change was create (or update) - keep it with new metadata
+            record.change = previous.change
+            record.diffs = None
+            result[path] = record
+        elif action is ChangeComparisonAction.REPLACE_DIFFS:
+            if previous.diffs:
+                if record.diffs:
+                    previous.diffs.extend(record.diffs)
+                record.diffs = previous.diffs
+            result[path] = record
+        else:
+            # no change is detected
+            del result[path]
+
+    return list(result.values())
+
+
+class DeltaCache:
+    """Cache of serialized delta responses keyed by project and version range.
+
+    Project versions are immutable, so cached delta of a version range never gets stale and there is
+    no invalidation. Entries are kept in LRU of the process bounded by total size, and optionally in shared
+    backend (redis), so all workers can reuse delta computed by one of them.
+    """
+
+    def __init__(self, max_size: int, url: str = "", ttl: int = 0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._local: OrderedDict[str, str] = OrderedDict()
+        self._shared = redis.Redis.from_url(url) if url else None
+
+    @staticmethod
+    def key(project_id, since: int, to: int) -> str:
+        return f"delta:{project_id}:{since}:{to}"
+
+    def get(self, key: str) -> Optional[str]:
+        data = self._local.get(key)
+        if data is not None:
+            self._local.move_to_end(key)
+            self.hits += 1
+            return data
+
+        if self._shared:
+            try:
+                data = self._shared.get(key)
+            except redis.RedisError as e:
+                logging.warning(f"Failed to get delta from shared cache: {e}")
+            if data is not None:
+                data = data.decode()
+                self._set_local(key, data)
+                self.hits += 1
+                return data
+        self.misses += 1
+
+    def set(self, key: str, data: str) -> None:
+        self._set_local(key, data)
+        if self._shared:
+            try:
+                self._shared.set(key, data, ex=self.ttl or None)
+            except redis.RedisError as e:
+                logging.warning(f"Failed to store delta in shared cache: {e}")
+
+    def _set_local(self, key: str, data: str) -> None:
+        # entries larger than the whole cache are not worth it
+        if len(data) > self.max_size:
+            return
+        previous = self._local.pop(key, None)
+        if previous is not None:
+            self.size -= len(previous)
+        self._local[key] = data
+        self.size += len(data)
+        while self.size > self.max_size:
+            _, evicted = self._local.popitem(last=False)
+            self.size -= len(evicted)
@@ -97,6 +97,19 @@ class BigChunkError(ResponseError):
     detail = f"Chunk size exceeds maximum allowed size {MAX_CHUNK_SIZE} MB"
 
 
+class ChunkOffsetMismatch(ResponseError):
+    code = "ChunkOffsetMismatch"
+    detail = "Uploaded data do not continue from the last stored byte of chunk"
+
+    def __init__(self, offset: int):
+        self.offset = offset
+
+    def to_dict(self) -> Dict:
+        data = super().to_dict()
+        data["offset"] = self.offset
+        return data
+
+
 class BatchLimitError(ResponseError):
     code = "BatchLimitExceeded"
     detail = f"Batch size exceeds maximum allowed size {Configuration.MAX_BATCH_SIZE}"
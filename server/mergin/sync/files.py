@@ -5,7 +5,7 @@ import datetime
 from enum import Enum
 import os
 from dataclasses import dataclass, field
-from typing import Optional, List
+from typing import Dict, Optional, List
 import uuid
 from flask import current_app
 from marshmallow import (
@@ -83,6 +83,15 @@ class ProjectFile(File):
     location: str
 
 
+@dataclass
+class UploadedFile:
+    """Metadata of file assembled from uploaded chunks, collected in single pass over data"""
+
+    checksum: str
+    size: int
+    mime_type: Optional[str] = None
+
+
 @dataclass
 class ProjectFileChange(ProjectFile):
     """Metadata of changed file in project version.
@@ -91,6 +100,8 @@ class ProjectFileChange(ProjectFile):
     """
 
     change: PushChangeType
+    # metadata of file assembled from chunks during push, not stored in database
+    upload: Optional[UploadedFile] = None
 
 
 def files_changes_from_upload(
@@ -154,6 +165,26 @@ def files_changes_from_upload(
     return version_changes
 
 
+def index_files(files: List[File]) -> Dict[str, File]:
+    """Index project files by path for constant time lookups"""
+    return {f.path: f for f in files}
+
+
+def changes_size_delta(changes: dict, files: Dict[str, File]) -> int:
+    """Calculate how project size changes once upload changes (as dumped by ChangesSchema) are applied.
+
+    :param changes: upload changes with added, updated and removed files
+    :param files: current project files indexed by path
+    :return: size difference in bytes
+    """
+    updated = {f["path"] for f in changes["updated"]}
+    return (
+        sum(f["size"] for f in changes["added"] + changes["updated"])
+        - sum(files[path].size for path in updated if path in files)
+        - sum(f["size"] for f in changes["removed"])
+    )
+
+
 class FileSchema(ma.Schema):
     path = fields.String()
     size = fields.Integer()
@@ -16,16 +16,20 @@ from typing import Optional, List, Dict, Set, Tuple
 from dataclasses import dataclass, asdict
 import logging
 
+import gevent
+import psycopg2
 from blinker import signal
 from flask_login import current_user
 from pygeodiff import GeoDiff
 from functools import cached_property
+from result import Err, Ok, Result
 from sqlalchemy import text, null, desc, nullslast, tuple_
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from sqlalchemy.orm import contains_eager, joinedload, load_only
 from sqlalchemy.dialects.postgresql import ARRAY, BIGINT, UUID, JSONB, ENUM, insert
 from sqlalchemy.types import String
 from sqlalchemy.ext.hybrid import hybrid_property
-from pygeodiff.geodifflib import GeoDiffLibError, GeoDiffLibConflictError
+from pygeodiff.geodifflib import GeoDiffLibError
 from flask import Flask, current_app
 
 from .files import (
@@ -41,19 +45,22 @@ from .files import (
     mergin_secure_filename,
     PushChangeType,
 )
+from .checkpoints import CheckpointExecutor, DiffMerge
+from .delta import DeltaRecord, decode_changes, merge_records
+from .errors import DataSyncError, UploadError
 from .interfaces import WorkspaceRole
-from .storages.disk import copy_file, move_to_tmp
+from .storages.disk import assemble_chunks, move_to_tmp
 from ..app import db
 from .storages import DiskStorage
 from .utils import (
     LOG_BASE,
     Checkpoint,
-    generate_checksum,
     get_chunk_location,
     get_project_path,
     is_supported_type,
     is_versioned_file,
     is_qgis,
+    thread_pool_executor,
 )
 
 Storages = {"local": DiskStorage}
@@ -69,18 +76,6 @@ class FileSyncErrorType(Enum):
     SYNC_ERROR = "sync error"
 
 
-class ChangeComparisonAction(Enum):
-    """Actions to take when comparing two changes"""
-
-    REPLACE = "replace"
-    UPDATE_METADATA = "update_metadata"  # Update metadata and keep diffs (used for update + update sequence)
-    REPLACE_DIFFS = "replace_diffs"  # Replace diffs but keep metadata (used for update + update sequence when only diffs are changed)
-    EXCLUDE = "exclude"  # Return None to exclude the file
-    FORCE_UPDATE = (
-        "force_update"  # Force update even if it looks like a delete + create sequence
-    )
-
-
 class Project(db.Model):
     id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     name = db.Column(db.String, index=True)
@@ -93,6 +88,8 @@ class Project(db.Model):
     tags = db.Column(ARRAY(String), server_default="{}")
     # disk_usage & latest_version are cached properties to keep even if versions are deleted
     disk_usage = db.Column(BIGINT, nullable=False, default=0)
+    # number of QGIS project files in latest version, maintained together with disk_usage (null if not known)
+    qgis_files_count = db.Column(db.Integer, nullable=True)
     latest_version = db.Column(db.Integer, index=True)
     workspace_id = db.Column(db.Integer, index=True, nullable=False)
     removed_at = db.Column(db.DateTime, index=True)
@@ -120,9 +117,8 @@ class Project(db.Model):
         self.workspace_id = workspace.id
         self.creator = creator
         self.latest_version = 0
+        self.qgis_files_count = 0
         self.public = kwargs.get("public", False)
-        latest_files = LatestProjectFiles(project=self)
-        db.session.add(latest_files)
 
     @property
     def storage(self):
@@ -145,105 +141,43 @@ class Project(db.Model):
         pattern = r"(\.gpkg|\.qgs|.qgz)(.*conflict.*)|( \(.*conflict.*)"
         return any(re.search(pattern, f.path) for f in self.files)
 
-    def get_latest_files_cache(self) -> List[int]:
-        """Get latest file history ids either from cached table or calculate them on the fly"""
-        if self.latest_project_files.file_history_ids is not None:
-            return self.latest_project_files.file_history_ids
-
-        query = f"""
-            WITH latest_changes AS (
-                SELECT
-                    fp.id,
-                    pv.project_id,
-                    max(pv.name) AS version
-                FROM
-                    project_version pv
-                    LEFT OUTER JOIN file_history fh ON fh.version_id = pv.id
-                    LEFT OUTER JOIN project_file_path fp ON fp.id = fh.file_path_id
-                WHERE
-                    pv.project_id = :project_id
-                    AND pv.name <= :latest_version
-                GROUP BY
-                    fp.id, pv.project_id
-            )
-            SELECT
-                fh.id 
-            FROM latest_changes ch
-            LEFT OUTER JOIN file_history fh ON (fh.file_path_id = ch.id AND fh.project_version_name = ch.version AND fh.change != 'delete')
-            WHERE fh.id IS NOT NULL;
-        """
-        params = {"project_id": self.id, "latest_version": self.latest_version}
-        return [row.id for row in db.session.execute(text(query), params).fetchall()]
-
-    def cache_latest_files(self) -> None:
-        """Get project files from changes (FileHistory) and save them for later use."""
+    def cache_latest_files(self, commit: bool = True) -> None:
+        """Rebuild current project files from changes (FileHistory), e.g. when file history was modified."""
         if self.latest_version is None:
             return
 
-        query = f"""
-            WITH latest_changes AS (
-                SELECT
-                    fp.id,
-                    pv.project_id,
-                    max(pv.name) AS version
-                FROM
-                    project_version pv
-                    LEFT OUTER JOIN file_history fh ON fh.version_id = pv.id
-                    LEFT OUTER JOIN project_file_path fp ON fp.id = fh.file_path_id
-                WHERE
-                    pv.project_id = :project_id
-                    AND pv.name <= :latest_version
-                GROUP BY
-                    fp.id, pv.project_id
-            ), aggregates AS (
-                SELECT
-                    project_id,
-                    COALESCE(array_agg(fh.id) FILTER (WHERE fh.change != 'delete'), ARRAY[]::INTEGER[]) AS files_ids
-                FROM latest_changes ch
-                LEFT OUTER JOIN file_history fh ON (fh.file_path_id = ch.id AND fh.project_version_name = ch.version)
-                GROUP BY project_id
-            )
-            UPDATE latest_project_files pf
-            SET file_history_ids = a.files_ids
-            FROM aggregates a
-            WHERE a.project_id = pf.project_id;
-        """
-        params = {"project_id": self.id, "latest_version": self.latest_version}
-        db.session.execute(text(query), params)
-        db.session.commit()
+        CurrentProjectFile.refresh(self.id, self.latest_version)
+        self._files_cache = None
+        if commit:
+            db.session.commit()
 
     @property
     def files(self) -> List[ProjectFile]:
-        """Return project files at latest version"""
-        # cache file history ids if needed
-        if self.latest_project_files.file_history_ids is None:
-            self.cache_latest_files()
-
-        if not self.latest_project_files.file_history_ids:
-            return []
+        """Return project files at latest version.
 
-        query = f"""
-            WITH files_ids AS (
-                SELECT
-                    unnest(file_history_ids) AS fh_id
-                FROM latest_project_files
-                WHERE project_id = :project_id
-            )
+        Files are memoized on project instance, hence for the lifetime of db session (request),
+        until project latest version changes.
+        """
+        cached = getattr(self, "_files_cache", None)
+        if cached is None or cached[0] != self.latest_version:
+            cached = self._files_cache = (self.latest_version, self._get_files())
+        return list(cached[1])
+
+    def _get_files(self) -> List[ProjectFile]:
+        """Query project files at latest version"""
+        query = """
             SELECT
-                fp.path,
-                fh.size,
-                fh.location,
-                fh.checksum,
-                pv.created AS mtime,
-                fd.path as diff_path,
-                fd.size as diff_size,
-                fd.checksum as diff_checksum,
-                fd.location as diff_location
-            FROM files_ids
-            LEFT OUTER JOIN file_history fh ON fh.id = files_ids.fh_id
-            LEFT OUTER JOIN project_file_path fp ON fp.id = fh.file_path_id
-            LEFT OUTER JOIN project_version pv ON pv.id = fh.version_id
-            LEFT OUTER JOIN file_diff fd ON fd.file_path_id = fh.file_path_id AND fd.version = fh.project_version_name and fd.rank = 0;
+                path,
+                size,
+                location,
+                checksum,
+                mtime,
+                diff_path,
+                diff_size,
+                diff_checksum,
+                diff_location
+            FROM current_project_file
+            WHERE project_id = :project_id;
         """
         params = {"project_id": self.id}
         files = [
@@ -319,9 +253,8 @@ class Project(db.Model):
         db.session.execute(
             files_path_table.delete().where(files_path_table.c.project_id == self.id)
         )
-        # reset project files cache
-        files_cache = LatestProjectFiles.query.filter_by(project_id=self.id).first()
-        files_cache.file_history_ids = null()
+        # current project files were removed together with file paths
+        self._files_cache = None
         # remove pending uploads
         upload_table = Upload.__table__
         db.session.execute(
@@ -332,7 +265,13 @@ class Project(db.Model):
         db.session.execute(
             delta_table.delete().where(delta_table.c.project_id == self.id)
         )
+        # remove snapshots of project files
+        snapshot_table = ProjectFilesSnapshot.__table__
+        db.session.execute(
+            snapshot_table.delete().where(snapshot_table.c.project_id == self.id)
+        )
         self.project_users.clear()
+        self._members_cache = None
         access_requests = (
             AccessRequest.query.filter_by(project_id=self.id)
             .filter(AccessRequest.status.is_(None))
@@ -344,8 +283,16 @@ class Project(db.Model):
         project_deleted.send(self)
 
     def _member(self, user_id: int) -> Optional[ProjectUser]:
-        """Return association object for user_id"""
-        return next((u for u in self.project_users if u.user_id == user_id), None)
+        """Return association object for user_id.
+
+        Members are looked up in map memoized on project instance, until members collection is reloaded
+        (e.g. expired by commit) or modified.
+        """
+        members = self.project_users
+        cached = getattr(self, "_members_cache", None)
+        if cached is None or cached[0] is not members:
+            cached = self._members_cache = (members, {u.user_id: u for u in members})
+        return cached[1].get(user_id)
 
     def get_role(self, user_id: int) -> Optional[ProjectRole]:
         """Get user role"""
@@ -361,12 +308,14 @@ class Project(db.Model):
         else:
             project_access_granted.send(self, user_id=user_id)
             self.project_users.append(ProjectUser(user_id=user_id, role=role.value))
+            self._members_cache = None
 
     def unset_role(self, user_id: int) -> None:
         """Remove user's role"""
         member = self._member(user_id)
         if member:
             self.project_users.remove(member)
+            self._members_cache = None
 
     def get_member(self, user_id: int) -> Optional[ProjectMember]:
         """Get project member"""
@@ -442,13 +391,13 @@ class Project(db.Model):
         )
         existing_delta_map = {(c.rank, c.version): c for c in expected_deltas}
 
-        result: List[DeltaChange] = []
+        result: List[DeltaRecord] = []
         for checkpoint in expected_checkpoints:
             existing_delta = existing_delta_map.get((checkpoint.rank, checkpoint.end))
 
             # we have delta in database, just return delta data from it
             if existing_delta:
-                result.extend(DeltaChangeSchema(many=True).load(existing_delta.changes))
+                result.extend(decode_changes(existing_delta.changes))
                 continue
 
             if checkpoint.rank == 0:
@@ -462,16 +411,14 @@ class Project(db.Model):
                     project_id, checkpoint
                 )
                 if new_checkpoint:
-                    result.extend(
-                        DeltaChangeSchema(many=True).load(new_checkpoint.changes)
-                    )
+                    result.extend(decode_changes(new_checkpoint.changes))
                 else:
                     logging.error(
                         f"Not possible to create checkpoint for project {project_id} in range {checkpoint.start}-{checkpoint.end}"
                     )
                     return
 
-        return ProjectVersionDelta.merge_changes(result)
+        return [item.to_merged() for item in merge_records(result)]
 
 
 class ProjectRole(Enum):
@@ -553,36 +500,121 @@ class ProjectFilePath(db.Model):
         return mergin_secure_filename(f"{self.path}-diff-{uuid.uuid4()}")
 
 
-class LatestProjectFiles(db.Model):
-    """Store project latest version files history ids.
+class CurrentProjectFile(db.Model):
+    """Denormalized metadata of project files in the latest project version.
 
-    This is a caching table to store the latest relevant files history ids for further use in
-    Project.files and ProjectVersion.files. It is updated when ProjectVersion itself is created.
+    Rows are inserted, updated or removed per changed path when ProjectVersion is created,
+    so that reading project files does not need to go through the whole file history.
     """
 
+    file_path_id = db.Column(
+        db.BigInteger,
+        db.ForeignKey("project_file_path.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
     project_id = db.Column(
         UUID(as_uuid=True),
         db.ForeignKey("project.id", ondelete="CASCADE"),
         index=True,
-        primary_key=True,
+        nullable=False,
     )
-    file_history_ids = db.Column(ARRAY(db.Integer), nullable=True)
-
-    project = db.relationship(
-        "Project",
-        uselist=False,
-        backref=db.backref(
-            "latest_project_files",
-            single_parent=True,
-            uselist=False,
-            cascade="all,delete",
-            lazy="select",
-        ),
+    file_history_id = db.Column(
+        db.BigInteger,
+        db.ForeignKey("file_history.id", ondelete="CASCADE"),
+        nullable=False,
     )
+    path = db.Column(db.String, nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    checksum = db.Column(db.String, nullable=False)
+    location = db.Column(db.String)
+    # creation time of project version where file was last changed
+    mtime = db.Column(db.DateTime)
+    # metadata of diff file pushed with the last change
+    diff_path = db.Column(db.String)
+    diff_size = db.Column(db.BigInteger)
+    diff_checksum = db.Column(db.String)
+    diff_location = db.Column(db.String)
+
+    # insert statement with metadata of file history records (filtered by caller)
+    _insert_query = """
+        INSERT INTO current_project_file (
+            file_path_id, project_id, file_history_id, path, size, checksum, location, mtime,
+            diff_path, diff_size, diff_checksum, diff_location
+        )
+        SELECT
+            fp.id,
+            fp.project_id,
+            fh.id,
+            fp.path,
+            fh.size,
+            fh.checksum,
+            fh.location,
+            pv.created,
+            fd.path,
+            fd.size,
+            fd.checksum,
+            fd.location
+        FROM file_history fh
+        JOIN project_file_path fp ON fp.id = fh.file_path_id
+        JOIN project_version pv ON pv.id = fh.version_id
+        LEFT OUTER JOIN file_diff fd ON fd.file_path_id = fh.file_path_id AND fd.version = fh.project_version_name AND fd.rank = 0
+    """
 
-    def __init__(self, project):
-        self.project = project
-        self.file_history_ids = []
+    @classmethod
+    def upsert(cls, file_history_ids: List[int]) -> None:
+        """Insert or replace current files by the given file history records"""
+        if not file_history_ids:
+            return
+
+        query = f"""
+            {cls._insert_query}
+            WHERE fh.id = ANY(:ids)
+            ON CONFLICT (file_path_id) DO UPDATE SET
+                file_history_id = EXCLUDED.file_history_id,
+                size = EXCLUDED.size,
+                checksum = EXCLUDED.checksum,
+                location = EXCLUDED.location,
+                mtime = EXCLUDED.mtime,
+                diff_path = EXCLUDED.diff_path,
+                diff_size = EXCLUDED.diff_size,
+                diff_checksum = EXCLUDED.diff_checksum,
+                diff_location = EXCLUDED.diff_location;
+        """
+        db.session.execute(text(query), {"ids": list(file_history_ids)})
+
+    @classmethod
+    def remove(cls, file_path_ids: List[int]) -> None:
+        """Remove files from current project files"""
+        if not file_path_ids:
+            return
+
+        db.session.execute(
+            cls.__table__.delete().where(
+                cls.__table__.c.file_path_id.in_(file_path_ids)
+            )
+        )
+
+    @classmethod
+    def refresh(cls, project_id: str, version: int) -> None:
+        """Rebuild current files of project from the latest changes of files up to version"""
+        db.session.execute(
+            cls.__table__.delete().where(cls.__table__.c.project_id == project_id)
+        )
+        query = f"""
+            {cls._insert_query}
+            WHERE fh.id IN (
+                SELECT latest.id
+                FROM (
+                    SELECT DISTINCT ON (h.file_path_id) h.id, h.change
+                    FROM file_history h
+                    JOIN project_version v ON v.id = h.version_id
+                    WHERE v.project_id = :project_id AND v.name <= :version
+                    ORDER BY h.file_path_id, v.name DESC
+                ) AS latest
+                WHERE latest.change != 'delete'
+            );
+        """
+        db.session.execute(text(query), {"project_id": project_id, "version": version})
 
 
 class FileHistory(db.Model):
@@ -820,63 +852,44 @@ class FileHistory(db.Model):
         checkpoints = Checkpoint.get_checkpoints(
             basefile.project_version_name + 1, version
         )
-        expected_diffs = (
-            FileDiff.query.filter_by(
-                basefile_id=basefile.id,
-            )
-            .filter(
-                tuple_(FileDiff.rank, FileDiff.version).in_(
-                    [(item.rank, item.end) for item in checkpoints]
-                )
-            )
-            .all()
-        )
-
+        plan = DiffCheckpointsPlan(basefile, version)
         for item in checkpoints:
-            diff_needs_to_be_created = False
-            diff = next(
-                (
-                    d
-                    for d in expected_diffs
-                    if d.rank == item.rank and d.version == item.end
-                ),
-                None,
-            )
-            if diff:
-                if os.path.exists(diff.abs_path):
-                    diffs.append(diff)
-                else:
-                    diff_needs_to_be_created = True
-            else:
+            diff = plan.diffs.get((item.rank, item.end))
+            if not diff:
                 # we do not have record in DB, create a checkpoint if it makes sense
-                if item.rank > 0 and FileDiff.can_create_checkpoint(file_id, item):
-                    diff = FileDiff(
-                        basefile=basefile,
-                        version=item.end,
-                        rank=item.rank,
-                        path=basefile.file.generate_diff_name(),
-                        size=None,
-                        checksum=None,
-                    )
-                    db.session.add(diff)
-                    db.session.commit()
-                    diff_needs_to_be_created = True
+                if item.rank > 0 and plan.can_create_checkpoint(item):
+                    diff = plan.add(item)
                 else:
                     # we asked for checkpoint where there was no change
                     continue
+            diffs.append(diff)
 
-            if diff_needs_to_be_created:
-                diff_created = diff.construct_checkpoint()
-                if diff_created:
-                    diffs.append(diff)
-                else:
-                    logging.error(
-                        f"Failed to create a diff for file {basefile.file.path} at version {basefile.project_version_name} of rank {item.rank}."
-                    )
-                    return None, []
+        if not plan.construct(diffs):
+            logging.error(
+                f"Failed to create diffs for file {basefile.file.path} with basefile at version {basefile.project_version_name} up to version {version}."
+            )
+            return None, []
 
         return basefile, diffs
 
+    @classmethod
+    def get_basefiles(cls, file_path_ids: List[int], version: int) -> Dict[int, int]:
+        """Get ids of basefiles for diff file changes of multiple files at some version, by file path id"""
+        rows = (
+            db.session.query(cls.file_path_id, cls.id)
+            .filter(
+                cls.file_path_id.in_(file_path_ids),
+                cls.project_version_name < version,
+                cls.change.in_(
+                    [PushChangeType.CREATE.value, PushChangeType.UPDATE.value]
+                ),
+            )
+            .distinct(cls.file_path_id)
+            .order_by(cls.file_path_id, desc(cls.project_version_name))
+            .all()
+        )
+        return {row.file_path_id: row.id for row in rows}
+
     @classmethod
     def get_basefile(cls, file_path_id: int, version: int) -> Optional[FileHistory]:
         """Get basefile (start of file diffable history) for diff file change at some version"""
@@ -1015,15 +1028,22 @@ class FileDiff(db.Model):
         if os.path.exists(self.abs_path):
             return True
 
+        plan = self.checkpoint_plan()
+        if not plan:
+            return False
+        return plan.construct([self])
+
+    def checkpoint_plan(self) -> Optional[DiffCheckpointsPlan]:
+        """Plan of diff checkpoints with the same basefile as this checkpoint, None if it cannot be constructed"""
         if self.rank == 0:
             logging.error(
                 "Checkpoint of rank 0 should be created by user upload, cannot be constructed"
             )
-            return False
+            return
 
         # merged diffs can only be created for certain versions
         if self.version % LOG_BASE:
-            return False
+            return
 
         cache_level_index = self.version // LOG_BASE**self.rank
         try:
@@ -1032,119 +1052,207 @@ class FileDiff(db.Model):
             logging.error(
                 f"Invalid record for cached level of rank {self.rank} and index {cache_level_index} for file {self.file_path_id}"
             )
-            return False
+            return
 
         basefile = FileHistory.get_basefile(self.file_path_id, cache_level.end)
         if not basefile:
             logging.error(f"Unable to find basefile for file {self.file_path_id}")
-            return False
+            return
 
         if basefile.project_version_name > cache_level.start:
             logging.error(
                 f"Basefile version {basefile.project_version_name} is higher than start version {cache_level.start} - broken history"
             )
-            return False
+            return
 
-        diffs_paths = []
-        # let's confirm we have all intermediate diffs needed, if not, we need to create them (recursively) first
-        cached_items = Checkpoint.get_checkpoints(
-            cache_level.start, cache_level.end - 1
-        )
-        expected_diffs = (
-            FileDiff.query.filter_by(
-                basefile_id=basefile.id,
+        return DiffCheckpointsPlan(basefile, cache_level.end)
+
+
+class DiffCheckpointsPlan:
+    """Plan of diff checkpoints (merged diffs) of versioned file which share the same basefile.
+
+    File history and diffs of the file in the version range are loaded at once, checkpoints tree is then
+    resolved in memory, missing diff records are inserted in bulk and merged diffs are constructed
+    from lower ranks up.
+    """
+
+    def __init__(self, basefile: FileHistory, end: int):
+        self.basefile = basefile
+        self.end = end
+        self.diffs: Dict[Tuple[int, int], FileDiff] = {
+            (d.rank, d.version): d
+            for d in FileDiff.query.filter(
+                FileDiff.basefile_id == basefile.id,
+                FileDiff.version > basefile.project_version_name,
+                FileDiff.version <= end,
             )
-            .filter(
-                tuple_(FileDiff.rank, FileDiff.version).in_(
-                    [(item.rank, item.end) for item in cached_items]
-                )
+        }
+        self.deleted_versions = [
+            row.project_version_name
+            for row in db.session.query(FileHistory.project_version_name).filter(
+                FileHistory.file_path_id == basefile.file_path_id,
+                FileHistory.project_version_name >= basefile.project_version_name,
+                FileHistory.project_version_name <= end,
+                FileHistory.change == PushChangeType.DELETE.value,
             )
-            .all()
+        ]
+        self.new_diffs: List[FileDiff] = []
+
+    def can_create_checkpoint(self, checkpoint: Checkpoint) -> bool:
+        """Equivalent of FileDiff.can_create_checkpoint for checkpoint within the plan"""
+        # do not create checkpoint if basefile is present in the range as it does not have valid use case
+        if self.basefile.project_version_name >= checkpoint.start:
+            return False
+
+        if any(checkpoint.start <= v <= checkpoint.end for v in self.deleted_versions):
+            return False
+
+        # rank 0 is a special case we only verify it exists
+        if checkpoint.rank == 0:
+            return (0, checkpoint.end) in self.diffs
+        # for higher ranks we need to check if there were diff updates in that range
+        return any(
+            rank == 0 and checkpoint.start <= version <= checkpoint.end
+            for rank, version in self.diffs
         )
 
-        for item in cached_items:
+    def add(self, checkpoint: Checkpoint) -> FileDiff:
+        """Add record of missing diff checkpoint, it is saved together with others once plan is constructed"""
+        diff = FileDiff(
+            basefile=self.basefile,
+            version=checkpoint.end,
+            rank=checkpoint.rank,
+            path=self.basefile.file.generate_diff_name(),
+            size=None,
+            checksum=None,
+        )
+        diff.file = self.basefile.file
+        self.diffs[(checkpoint.rank, checkpoint.end)] = diff
+        self.new_diffs.append(diff)
+        return diff
+
+    def sources(self, checkpoint: Checkpoint) -> List[FileDiff]:
+        """Diffs to be merged into diff checkpoint, missing lower rank checkpoints are added to plan"""
+        result = []
+        for item in Checkpoint.get_checkpoints(checkpoint.start, checkpoint.end - 1):
             # basefile is a start of the diff chain, checkpoint must start after basefile version
-            if basefile.project_version_name >= item.start:
+            if self.basefile.project_version_name >= item.start:
                 continue
 
-            # find diff in table and on disk
-            # diffs might not exist because theye were not created yet or there were no changes (e.g. for zeroth rank diffs)
-            diff = next(
-                (
-                    d
-                    for d in expected_diffs
-                    if d.rank == item.rank and d.version == item.end
-                ),
-                None,
-            )
-
+            # diffs might not exist because they were not created yet or there were no changes (e.g. for zeroth rank diffs)
+            diff = self.diffs.get((item.rank, item.end))
             if not diff:
-                # lower rank diff not even in DB yet - create it and try to construct merged file
-                if item.rank > 0 and FileDiff.can_create_checkpoint(
-                    self.file_path_id, item
-                ):
-                    diff = FileDiff(
-                        basefile=basefile,
-                        version=item.end,
-                        rank=item.rank,
-                        path=basefile.file.generate_diff_name(),
-                        size=None,
-                        checksum=None,
-                    )
-                    db.session.add(diff)
-                    db.session.commit()
+                if item.rank > 0 and self.can_create_checkpoint(item):
+                    diff = self.add(item)
                 else:
                     # such diff is not expected to exist
                     continue
-
-            diff_exists = diff.construct_checkpoint()
-            if diff_exists:
-                diffs_paths.append(diff.abs_path)
-            else:
-                logging.error(
-                    f"Unable to create checkpoint diff for {item} for file {self.file_path_id}"
-                )
-                return False
+            result.append(diff)
 
         # we apply latest change (if any) on previous version
-        end_diff = FileDiff.query.filter_by(
-            basefile_id=basefile.id,
-            rank=0,
-            version=cache_level.end,
-        ).first()
-
+        end_diff = self.diffs.get((0, checkpoint.end))
         if end_diff:
-            diffs_paths.append(end_diff.abs_path)
+            result.append(end_diff)
+        return result
 
-        if not diffs_paths:
+    def _plan(
+        self, diff: FileDiff, steps: List[Tuple[FileDiff, List[FileDiff]]]
+    ) -> bool:
+        """Add steps (diff and its sources) needed to construct diff file, lower ranks first"""
+        if any(diff is d for d, _ in steps) or os.path.exists(diff.abs_path):
+            return True
+
+        if diff.rank == 0:
+            logging.error(
+                "Checkpoint of rank 0 should be created by user upload, cannot be constructed"
+            )
+            return False
+
+        checkpoint = Checkpoint(
+            rank=diff.rank, index=diff.version // LOG_BASE**diff.rank
+        )
+        sources = self.sources(checkpoint)
+        if not sources:
             logging.warning(
-                f"No diffs for next checkpoint for file {self.file_path_id}"
+                f"No diffs for next checkpoint for file {self.basefile.file_path_id}"
             )
             return False
 
-        project: Project = basefile.file.project
+        for source in sources:
+            if not self._plan(source, steps):
+                logging.error(
+                    f"Unable to create checkpoint diff for {checkpoint} for file {self.basefile.file_path_id}"
+                )
+                return False
+        steps.append((diff, sources))
+        return True
 
-        # create diffs directory if not exists and subfolders in case of diffs/subfolder/diff-file
-        os.makedirs(os.path.dirname(self.abs_path), exist_ok=True)
+    def prepare(
+        self, diffs: List[FileDiff]
+    ) -> Optional[List[Tuple[FileDiff, List[FileDiff]]]]:
+        """Plan construction of diff files (if missing) of diff checkpoints incl. all required lower rank checkpoints.
 
-        try:
-            if len(diffs_paths) == 1:
-                # if there is only one diff, we can just copy it as a checkpoint without merging
-                # geodiff.concat_changes is not able to concat one diff
-                copy_file(diffs_paths[0], self.abs_path)
-            else:
-                project.storage.geodiff.concat_changes(diffs_paths, self.abs_path)
-        except (GeoDiffLibError, GeoDiffLibConflictError):
-            logging.error(
-                f"Geodiff: Failed to merge diffs for file {self.file_path_id}."
-            )
-            return False
+        Records of missing checkpoints are inserted at once. Returns list of checkpoints to construct
+        with their sources, lower ranks first, or None if some diff cannot be constructed.
+        """
+        steps = []
+        planned = all(self._plan(diff, steps) for diff in diffs)
+        if self.new_diffs:
+            db.session.add_all(self.new_diffs)
+            db.session.flush()
+            self.new_diffs = []
+        return steps if planned else None
+
+    def construct(self, diffs: List[FileDiff]) -> bool:
+        """Construct diff files (if missing) of diff checkpoints incl. all required lower rank checkpoints.
 
-        self.size = os.path.getsize(self.abs_path)
-        self.checksum = generate_checksum(self.abs_path)
+        Once checkpoint is created, size and checksum are updated in the database.
+        """
+        steps = self.prepare(diffs)
+        result = steps is not None and construct_diff_checkpoints(steps)
         db.session.commit()
+        return result
+
+
+def construct_diff_checkpoints(
+    steps: List[Tuple[FileDiff, List[FileDiff]]], workers: int = 1
+) -> bool:
+    """Construct diff files of planned checkpoints of project from their sources, see DiffCheckpointsPlan.prepare.
+
+    Checkpoints are built in waves, each wave only depends on diffs from previous ones,
+    so merges within a wave can be run concurrently by more workers (only in background tasks).
+    Size and checksum of created checkpoints are updated in the session, but not committed.
+    """
+    waves: Dict[int, List[Tuple[FileDiff, List[FileDiff]]]] = {}
+    levels: Dict[int, int] = {}
+    for diff, sources in steps:
+        # the same checkpoint might be planned by different plans
+        if id(diff) in levels:
+            continue
+        level = 1 + max((levels.get(id(s), 0) for s in sources), default=0)
+        levels[id(diff)] = level
+        waves.setdefault(level, []).append((diff, sources))
+    if not waves:
         return True
 
+    storage = steps[0][0].file.project.storage
+    with CheckpointExecutor(workers) as executor:
+        for level in sorted(waves):
+            wave = waves[level]
+            results = executor.run(
+                [
+                    DiffMerge([s.abs_path for s in sources], diff.abs_path)
+                    for diff, sources in wave
+                ],
+                lambda: storage.geodiff,
+            )
+            for (diff, _), result in zip(wave, results):
+                diff.size = result.size
+                diff.checksum = result.checksum
+            if any(result.error for result in results):
+                return False
+    return True
+
 
 class ProjectVersionDelta(db.Model):
     id = db.Column(db.BigInteger, primary_key=True, autoincrement=True)
@@ -1183,163 +1291,8 @@ class ProjectVersionDelta(db.Model):
         Merge changes json array objects into one list of changes.
         Changes are merged based on file path and change type.
         """
-        updating_files: Set[str] = set()
-        # sorting changes by version to apply them in correct order
-        items.sort(key=lambda x: x.version)
-
-        # Merge changes for each file in a single pass
-        result: Dict[str, DeltaChangeMerged] = {}
-        for item in items:
-            path = item.path
-            current = item.to_merged()
-
-            # First change for this file
-            if path not in result:
-                result[path] = current
-                # track existing paths to avoid deleting files that are already in history before
-                if current.change != PushChangeType.CREATE:
-                    updating_files.add(path)
-                continue
-
-            # Compare and merge with previous change for this file
-            # If file did not exist before this range (first change was CREATE),
-            # a CREATE+DELETE sequence is transparent — exclude the pair.
-            exclude_delete = path not in updating_files
-            new_change = ProjectVersionDelta._compare_changes(
-                result[path], current, exclude_delete
-            )
-
-            # Update result (or remove if no change is detected)
-            if new_change is not None:
-                result[path] = new_change
-            else:
-                del result[path]
-
-        return list(result.values())
-
-    @staticmethod
-    def _compare_changes(
-        previous: DeltaChangeMerged,
-        new: DeltaChangeMerged,
-        exclude_delete: bool,
-    ) -> Optional[DeltaChangeMerged]:
-        """
-        Compare and merge two changes for the same file.
-
-        Args:
-            previous: Previously accumulated change
-            new: New change to compare
-            exclude_delete: If True, a CREATE+DELETE pair is excluded (file was
-                created and deleted within the same range — no net effect).
-                If False, the DELETE is kept (file existed before this range
-                and the client needs to remove it).
-
-        Returns:
-            Merged change or None if file should be excluded
-        """
-
-        # Map change type pairs to actions
-        action_map = {
-            # CREATE + DELETE: if file didn't exist before (exclude_delete=True),
-            # the pair cancels out (EXCLUDE). If it did exist, keep the DELETE
-            # so the client removes its local copy.
-            (
-                PushChangeType.CREATE,
-                PushChangeType.DELETE,
-            ): (
-                ChangeComparisonAction.EXCLUDE
-                if exclude_delete
-                else ChangeComparisonAction.REPLACE
-            ),
-            # create + update = create with updated info
-            (
-                PushChangeType.CREATE,
-                PushChangeType.UPDATE,
-            ): ChangeComparisonAction.UPDATE_METADATA,
-            (
-                PushChangeType.CREATE,
-                PushChangeType.UPDATE_DIFF,
-            ): ChangeComparisonAction.UPDATE_METADATA,
-            (
-                PushChangeType.CREATE,
-                PushChangeType.CREATE,
-            ): ChangeComparisonAction.REPLACE,
-            # update + update_diff = update with latest info
-            (
-                PushChangeType.UPDATE,
-                PushChangeType.UPDATE_DIFF,
-            ): ChangeComparisonAction.UPDATE_METADATA,
-            (
-                PushChangeType.UPDATE,
-                PushChangeType.UPDATE,
-            ): ChangeComparisonAction.REPLACE,
-            (
-                PushChangeType.UPDATE,
-                PushChangeType.DELETE,
-            ): ChangeComparisonAction.REPLACE,
-            (
-                PushChangeType.UPDATE,
-                PushChangeType.CREATE,
-            ): ChangeComparisonAction.REPLACE,
-            # update_diff + update_diff = update_diff with latest info with proper order of diffs
-            (
-                PushChangeType.UPDATE_DIFF,
-                PushChangeType.UPDATE_DIFF,
-            ): ChangeComparisonAction.REPLACE_DIFFS,
-            (
-                PushChangeType.UPDATE_DIFF,
-                PushChangeType.UPDATE,
-            ): ChangeComparisonAction.REPLACE,
-            (
-                PushChangeType.UPDATE_DIFF,
-                PushChangeType.DELETE,
-            ): ChangeComparisonAction.REPLACE,
-            (
-                PushChangeType.UPDATE_DIFF,
-                PushChangeType.CREATE,
-            ): ChangeComparisonAction.REPLACE,
-            (
-                PushChangeType.DELETE,
-                PushChangeType.CREATE,
-            ): ChangeComparisonAction.FORCE_UPDATE,
-            # delete + update = replace it (used for multicheckpoint ranges when we want to keep file in history even if it was deleted in the middle, so we keep delete but update metadata and diffs)
-            (
-                PushChangeType.DELETE,
-                PushChangeType.UPDATE,
-            ): ChangeComparisonAction.REPLACE,
-            (
-                PushChangeType.DELETE,
-                PushChangeType.UPDATE_DIFF,
-            ): ChangeComparisonAction.EXCLUDE,
-            (
-                PushChangeType.DELETE,
-                PushChangeType.DELETE,
-            ): ChangeComparisonAction.REPLACE,
-        }
-
-        action = action_map.get((previous.change, new.change))
-
-        result = None
-        if action == ChangeComparisonAction.REPLACE:
-            result = new
-
-        elif action == ChangeComparisonAction.FORCE_UPDATE:
-            # handle force update case, when previous change was delete and new change is create - just revert to update with new metadata
-            new.change = PushChangeType.UPDATE
-            new.diffs = []
-            result = new
-
-        elif action == ChangeComparisonAction.UPDATE_METADATA:
-            # handle update case, when previous change was create - just revert to create with new metadata
-            new.change = previous.change
-            new.diffs = []
-            result = new
-
-        elif action == ChangeComparisonAction.REPLACE_DIFFS:
-            new.diffs = (previous.diffs or []) + (new.diffs or [])
-            result = new
-
-        return result
+        records = [DeltaRecord.from_change(item) for item in items]
+        return [record.to_merged() for record in merge_records(records)]
 
     @classmethod
     def create_checkpoint(
@@ -1396,16 +1349,14 @@ class ProjectVersionDelta(db.Model):
 
         # dump changes lists from database and flatten list for merging
         delta_range = sorted(delta_range, key=lambda x: x.version)
-        changes = []
+        changes: List[DeltaRecord] = []
         for delta in delta_range:
-            changes.extend(DeltaChangeSchema(many=True).load(delta.changes))
+            changes.extend(decode_changes(delta.changes))
 
         # Merge changes for compact storage and FileDiff checkpoint decisions.
-        merged_changes = cls.merge_changes(changes)
-
-        merged_delta_items: List[DeltaChange] = [
-            d.to_data_delta() for d in merged_changes
-        ]
+        merged_delta_items = merge_records(changes)
+        # merged diffs are replaced by single diff checkpoint of versioned file
+        checkpoint_diffs: Dict[str, str] = {}
 
         # Pre-fetch data for all versioned files to create FileDiff checkpoints where it makes sense
         versioned_delta_items = [
@@ -1453,25 +1404,123 @@ class ProjectVersionDelta(db.Model):
                         version=checkpoint.end,
                     )
                     # Patch the delta with the path to the new diff checkpoint
-                    item.diff = checkpoint_diff.path
+                    checkpoint_diffs[item.path] = checkpoint_diff.path
                     db.session.add(checkpoint_diff)
                 else:
                     # checkpoint already exists, just patch the delta with the path to the existing diff checkpoint
                     # this could happen when file diff exists but dela was missing
                     # this allowing us to remove rank > 0 delta checkpoints in case of inconsistencies
-                    item.diff = existing_diff_checkpoint.path
+                    checkpoint_diffs[item.path] = existing_diff_checkpoint.path
 
         checkpoint_delta = ProjectVersionDelta(
             project_id=project_id,
             version=checkpoint.end,
             rank=checkpoint.rank,
-            changes=DeltaChangeSchema(many=True).dump(merged_delta_items),
+            changes=[
+                item.to_json(checkpoint_diffs.get(item.path))
+                for item in merged_delta_items
+            ],
         )
         db.session.add(checkpoint_delta)
         db.session.commit()
         return checkpoint_delta
 
 
+class ProjectFilesSnapshot(db.Model):
+    """Store file history ids of project files at the end of checkpoint of FILES_SNAPSHOT_RANK.
+
+    Files of any later version (until the next snapshot) are resolved from the snapshot
+    by replaying a bounded number of changes, rather than going through the whole file history.
+    Snapshots are created when version is pushed, or on demand for older versions.
+    """
+
+    project_id = db.Column(
+        UUID(as_uuid=True),
+        db.ForeignKey("project.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    version = db.Column(db.Integer, primary_key=True)
+    file_history_ids = db.Column(ARRAY(db.BigInteger), nullable=False)
+
+    def __init__(self, project_id: str, version: int, file_history_ids: List[int]):
+        self.project_id = project_id
+        self.version = version
+        self.file_history_ids = file_history_ids
+
+    @staticmethod
+    def snapshot_version(version: int) -> int:
+        """Version of the nearest snapshot at or before version, 0 means there is none"""
+        checkpoint_size = LOG_BASE ** current_app.config["FILES_SNAPSHOT_RANK"]
+        return version - version % checkpoint_size
+
+    @classmethod
+    def create_from_current_files(cls, project_id: str, version: int) -> None:
+        """Create snapshot of current project files (which must be files of version)"""
+        query = """
+            INSERT INTO project_files_snapshot (project_id, version, file_history_ids)
+            SELECT
+                :project_id,
+                :version,
+                COALESCE(
+                    (SELECT array_agg(file_history_id) FROM current_project_file WHERE project_id = :project_id),
+                    ARRAY[]::BIGINT[]
+                )
+            ON CONFLICT DO NOTHING;
+        """
+        db.session.execute(text(query), {"project_id": project_id, "version": version})
+
+    @classmethod
+    def get_or_create(
+        cls, project_id: str, version: int
+    ) -> Optional[ProjectFilesSnapshot]:
+        """Get the nearest snapshot at or before version. If it is missing it is created from file history."""
+        snapshot_version = cls.snapshot_version(version)
+        if not snapshot_version:
+            return None
+
+        snapshot = cls.query.filter_by(
+            project_id=project_id, version=snapshot_version
+        ).first()
+        if snapshot:
+            return snapshot
+
+        pv = ProjectVersion.query.filter_by(
+            project_id=project_id, name=snapshot_version
+        ).first()
+        if not pv:
+            return None
+
+        if pv.name == pv.project.latest_version:
+            file_history_ids = [
+                row.file_history_id
+                for row in db.session.query(
+                    CurrentProjectFile.file_history_id
+                ).filter_by(project_id=project_id)
+            ]
+        else:
+            file_history_ids = [row.file_history_id for row in pv._files_from_history()]
+
+        # this is called from read paths which do not commit, hence snapshot is saved in its own short transaction,
+        # so it is kept regardless of the caller's transaction and concurrent readers do not wait for it
+        stmt = (
+            insert(cls.__table__)
+            .values(
+                project_id=project_id,
+                version=snapshot_version,
+                file_history_ids=file_history_ids,
+            )
+            .on_conflict_do_nothing()
+        )
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(stmt)
+        except SQLAlchemyError:
+            logging.exception(
+                f"Failed to save files snapshot of project {project_id} at version {snapshot_version}"
+            )
+        return cls(project_id, snapshot_version, file_history_ids)
+
+
 class ProjectVersion(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name = db.Column(db.Integer, index=True)
@@ -1523,48 +1572,97 @@ class ProjectVersion(db.Model):
         self.user_agent = user_agent
         self.ip_address = ip
         self.device_id = device_id
-
-        latest_files_map = {
-            fh.path: fh.id
-            for fh in FileHistory.query.filter(
-                FileHistory.id.in_(self.project.get_latest_files_cache())
-            ).all()
-        }
+        # new project has to be flushed before its first version records are created
+        db.session.add(project)
+        db.session.flush()
+        self.project_id = project.id
 
         changed_files_paths = set(change.path for change in changes)
-        existing_files_map = {
-            f.path: f
-            for f in ProjectFilePath.query.filter_by(project_id=self.project_id)
-            .filter(ProjectFilePath.path.in_(changed_files_paths))
+        # changed files which are no longer the latest ones
+        replaced_files = {
+            row.path: row
+            for row in db.session.query(
+                CurrentProjectFile.path,
+                CurrentProjectFile.size,
+            )
+            .filter(
+                CurrentProjectFile.project_id == self.project_id,
+                CurrentProjectFile.path.in_(changed_files_paths),
+            )
             .all()
         }
-        for item in changes:
-            # get existing DB file reference or create a new one (for added files)
-            db_file = existing_files_map.get(
-                item.path, ProjectFilePath(self.project_id, item.path)
+        # version, paths, file history and delta records are written by multi-row inserts,
+        # so that number of database round-trips does not depend on number of changes
+        db.session.add(self)
+        db.session.flush()
+        file_path_ids = dict(
+            db.session.query(ProjectFilePath.path, ProjectFilePath.id)
+            .filter(
+                ProjectFilePath.project_id == self.project_id,
+                ProjectFilePath.path.in_(changed_files_paths),
             )
-            fh = FileHistory(
-                file=db_file,
-                size=item.size,
-                checksum=item.checksum,
-                location=item.location,
-                diff=(
-                    asdict(item.diff)
-                    if (item.change is PushChangeType.UPDATE_DIFF and item.diff)
-                    else None
-                ),
-                change=item.change,
-                version_name=self.name,
+            .all()
+        )
+        new_paths = [c.path for c in changes if c.path not in file_path_ids]
+        if new_paths:
+            rows = db.session.execute(
+                insert(ProjectFilePath.__table__)
+                .values([{"project_id": self.project_id, "path": p} for p in new_paths])
+                .returning(ProjectFilePath.path, ProjectFilePath.id)
             )
-            fh.version = self
-            fh.project_version_name = self.name
-            db.session.add(fh)
-            db.session.flush()
+            file_path_ids.update({row.path: row.id for row in rows})
+
+        latest_files = []
+        removed_files = []
+        if changes:
+            rows = db.session.execute(
+                insert(FileHistory.__table__)
+                .values(
+                    [
+                        {
+                            "version_id": self.id,
+                            "file_path_id": file_path_ids[item.path],
+                            "size": item.size,
+                            "checksum": item.checksum,
+                            "location": item.location,
+                            "change": item.change.value,
+                            "project_version_name": self.name,
+                        }
+                        for item in changes
+                    ]
+                )
+                .returning(FileHistory.id, FileHistory.file_path_id, FileHistory.change)
+            )
+            for row in rows:
+                if row.change == PushChangeType.DELETE.value:
+                    removed_files.append(row.file_path_id)
+                else:
+                    latest_files.append(row.id)
 
-            if item.change is PushChangeType.DELETE:
-                latest_files_map.pop(fh.path, None)
-            else:
-                latest_files_map[fh.path] = fh.id
+        diff_changes = [
+            c for c in changes if c.change is PushChangeType.UPDATE_DIFF and c.diff
+        ]
+        if diff_changes:
+            basefiles = FileHistory.get_basefiles(
+                [file_path_ids[c.path] for c in diff_changes], self.name
+            )
+            db.session.execute(
+                insert(FileDiff.__table__).values(
+                    [
+                        {
+                            "file_path_id": file_path_ids[c.path],
+                            "basefile_id": basefiles[file_path_ids[c.path]],
+                            "path": c.diff.path,
+                            "rank": 0,
+                            "version": self.name,
+                            "location": os.path.join(f"v{self.name}", c.diff.path),
+                            "size": c.diff.size,
+                            "checksum": c.diff.checksum,
+                        }
+                        for c in diff_changes
+                    ]
+                )
+            )
 
         # cache changes data json for version checkpoints
         # rank 0 is for all changes from start to current version
@@ -1579,24 +1677,40 @@ class ProjectVersion(db.Model):
             )
             for c in changes
         ]
-        pvd = ProjectVersionDelta(
-            project_id=project.id,
-            version=name,
-            rank=0,
-            changes=DeltaChangeSchema(many=True).dump(delta_data),
+        db.session.execute(
+            insert(ProjectVersionDelta.__table__).values(
+                project_id=project.id,
+                version=name,
+                rank=0,
+                changes=DeltaChangeSchema(many=True).dump(delta_data),
+            )
         )
 
-        db.session.add(pvd)
-        db.session.flush()
-
-        # update cached values in project and push to transaction buffer so that self.files is up-to-date
-        self.project.latest_project_files.file_history_ids = latest_files_map.values()
-        db.session.flush()
-        self.project.disk_usage = (
-            sum(f.size for f in self.project.files) if self.project.files else 0
-        )
+        # update current project files by changed paths only and push to transaction buffer
+        CurrentProjectFile.remove(removed_files)
+        CurrentProjectFile.upsert(latest_files)
+        if name and ProjectFilesSnapshot.snapshot_version(name) == name:
+            ProjectFilesSnapshot.create_from_current_files(self.project_id, name)
+        # update cached project stats by changes rather than going through all project files
+        size_delta = 0
+        qgis_files_delta = 0
+        for item in changes:
+            replaced = replaced_files.get(item.path)
+            present = item.change is not PushChangeType.DELETE
+            size_delta += (item.size if present else 0) - (
+                replaced.size if replaced else 0
+            )
+            if is_qgis(item.path):
+                qgis_files_delta += int(present) - int(replaced is not None)
+        self.project.disk_usage = (self.project.disk_usage or 0) + size_delta
         self.project.latest_version = self.name
-        self.project.tags = self.resolve_tags()
+        if self.project.qgis_files_count is None:
+            self.project.qgis_files_count = sum(
+                1 for f in self.project.files if is_qgis(f.path)
+            )
+        else:
+            self.project.qgis_files_count += qgis_files_delta
+        self.project.tags = self.qgis_tags(self.project.qgis_files_count)
         self.project_size = self.project.disk_usage
         db.session.flush()
 
@@ -1633,6 +1747,7 @@ class ProjectVersion(db.Model):
                     fp.id
             )
             SELECT
+                fh.id AS file_history_id,
                 fp.path,
                 fh.size,
                 fh.location,
@@ -1658,10 +1773,6 @@ class ProjectVersion(db.Model):
         files that were delete after the version (and thus not necessarily present now). From these candidates
         get the latest file change before or at the specific version. If that change was not 'delete', file is present.
         """
-        # if we do not have cached file history ids use different strategy where it is not necessary
-        if self.project.latest_project_files.file_history_ids is None:
-            return self._files_from_start()
-
         query = f"""
             WITH files_changes_before_version AS (
                 WITH files_candidates AS (
@@ -1677,13 +1788,9 @@ class ProjectVersion(db.Model):
                     -- union with current files
                     UNION
                     SELECT
-                        fh.file_path_id AS file_id
-                    FROM file_history fh
-                    WHERE fh.id IN (
-                        SELECT unnest(file_history_ids)
-                        FROM latest_project_files
-                        WHERE project_id = :project_id
-                    )
+                        file_path_id AS file_id
+                    FROM current_project_file
+                    WHERE project_id = :project_id
                 )
                 SELECT
                     fs.file_id,
@@ -1697,6 +1804,7 @@ class ProjectVersion(db.Model):
                     fs.file_id
             )
             SELECT
+                fh.id AS file_history_id,
                 fp.path,
                 fh.size,
                 fh.location,
@@ -1717,16 +1825,78 @@ class ProjectVersion(db.Model):
         params = {"project_id": self.project_id, "version": self.name}
         return db.session.execute(text(query), params).fetchall()
 
+    def _files_from_history(self):
+        """Calculate version files from file history using more suitable strategy"""
+        if self.name < self.project.latest_version / 2:
+            return self._files_from_start()
+        return self._files_from_end()
+
+    def _files_from_snapshot(self, snapshot: ProjectFilesSnapshot):
+        """Calculate version files from the nearest snapshot and changes made since then
+        Strategy: Take files from the snapshot which were not changed since and add files which latest change
+        between the snapshot and version was not 'delete'.
+        """
+        query = f"""
+            WITH changes AS (
+                SELECT DISTINCT ON (fh.file_path_id)
+                    fh.file_path_id,
+                    fh.id,
+                    fh.change
+                FROM project_version pv
+                INNER JOIN file_history fh ON fh.version_id = pv.id
+                WHERE
+                    pv.project_id = :project_id
+                    AND pv.name > :snapshot_version
+                    AND pv.name <= :version
+                ORDER BY fh.file_path_id, fh.project_version_name DESC
+            ), version_files AS (
+                SELECT id
+                FROM changes
+                WHERE change != 'delete'
+                UNION ALL
+                SELECT fh.id
+                FROM file_history fh
+                WHERE
+                    fh.id = ANY(:file_history_ids)
+                    AND NOT EXISTS (SELECT 1 FROM changes ch WHERE ch.file_path_id = fh.file_path_id)
+            )
+            SELECT
+                fh.id AS file_history_id,
+                fp.path,
+                fh.size,
+                fh.location,
+                fh.checksum,
+                pv.created AS mtime,
+                fd.path as diff_path,
+                fd.size as diff_size,
+                fd.checksum as diff_checksum,
+                fd.location as diff_location
+            FROM version_files vf
+            INNER JOIN file_history fh ON fh.id = vf.id
+            INNER JOIN project_file_path fp ON fp.id = fh.file_path_id
+            INNER JOIN project_version pv ON pv.id = fh.version_id
+            LEFT OUTER JOIN file_diff fd ON fd.file_path_id = fh.file_path_id AND fd.version = fh.project_version_name and fd.rank = 0
+            ORDER BY fp.path;
+        """
+        params = {
+            "project_id": self.project_id,
+            "version": self.name,
+            "snapshot_version": snapshot.version,
+            "file_history_ids": snapshot.file_history_ids,
+        }
+        return db.session.execute(text(query), params).fetchall()
+
     @property
     def files(self) -> List[ProjectFile]:
         # return from cache
         if self.name == self.project.latest_version:
             return self.project.files
 
-        if self.name < self.project.latest_version / 2:
-            result = self._files_from_start()
+        snapshot = ProjectFilesSnapshot.get_or_create(self.project_id, self.name)
+        if snapshot:
+            result = self._files_from_snapshot(snapshot)
         else:
-            result = self._files_from_end()
+            result = self._files_from_history()
         files = [
             ProjectFile(
                 path=row.path,
@@ -1750,12 +1920,13 @@ class ProjectVersion(db.Model):
         return files
 
     def resolve_tags(self) -> List[str]:
+        return self.qgis_tags(sum(1 for f in self.files if is_qgis(f.path)))
+
+    @staticmethod
+    def qgis_tags(qgis_files_count: int) -> List[str]:
+        """Project tags based on number of QGIS project files"""
         tags = []
-        qgis_count = 0
-        for f in self.files:
-            if is_qgis(f.path):
-                qgis_count += 1
-        if qgis_count == 1:
+        if qgis_files_count == 1:
             tags.extend(["valid_qgis", "input_use"])
         return tags
 
@@ -1881,6 +2052,7 @@ class Upload(db.Model):
         """
         now = datetime.now(timezone.utc).replace(tzinfo=None)
         expiration = current_app.config["LOCKFILE_EXPIRATION"]
+        job_expiration = current_app.config["PUSH_JOB_LOCK_EXPIRATION"]
         new_tx_id = str(uuid.uuid4())
 
         # CTE captures the existing row's transaction_id BEFORE the upsert (pre-statement snapshot)
@@ -1916,8 +2088,15 @@ class Upload(db.Model):
                 "last_ping": now,
                 "changes": ChangesSchema().dump(changes),
             },
-            # ONLY update if the existing row is stale
-            where=(Upload.last_ping < (now - timedelta(seconds=expiration))),
+            # ONLY update if the existing row is stale and its push is not waiting to be finished by celery task
+            where=(
+                (Upload.last_ping < (now - timedelta(seconds=expiration)))
+                & ~db.exists().where(
+                    PushJob.id == Upload.transaction_id,
+                    PushJob.status == PushJobStatus.PENDING.value,
+                    PushJob.created > now - timedelta(seconds=job_expiration),
+                )
+            ),
         )
 
         upsert_stmt = upsert_stmt.returning(
@@ -2042,12 +2221,122 @@ class Upload(db.Model):
         except Exception:
             logging.exception(f"Failed to clear upload.")
 
+    def finish(
+        self,
+        user_id: int,
+        ip: str,
+        user_agent: str = None,
+        device_id: str = None,
+    ) -> Result:
+        """Process uploaded data and create a new project version from them. Upload is cleared afterwards.
+
+        Returns created project version or a tuple of error and http status code to respond with.
+        """
+        from .tasks import remove_transaction_chunks
+
+        project = self.project
+        next_version = project.next_version()
+        v_next_version = ProjectVersion.to_v_name(next_version)
+        version_dir = os.path.join(project.storage.project_dir, v_next_version)
+        pushed_files = self.changes["added"] + self.changes["updated"]
+
+        # this is the heavy work of processing upload data
+        file_changes, errors = self.process_chunks(use_shared_chunk_dir=True)
+        # files consistency or geodiff related issues, project push would never succeed, whole upload is aborted
+        if errors:
+            self.clear()
+            return Err((DataSyncError(failed_files=errors), 422))
+
+        if os.path.exists(version_dir):
+            if ProjectVersion.query.filter_by(
+                project_id=project.id, name=next_version
+            ).count():
+                return Err(
+                    (UploadError(error=f"Version {v_next_version} already exists"), 409)
+                )
+            move_to_tmp(version_dir)
+
+        try:
+            # let's keep upload alive until all work is done so no one else can claim it
+            with self.heartbeat(5):
+                pv = ProjectVersion(
+                    project,
+                    next_version,
+                    user_id,
+                    file_changes,
+                    ip,
+                    user_agent,
+                    device_id,
+                )
+                db.session.add(pv)
+                db.session.add(project)
+
+                # move files before committing so a filesystem failure leaves the DB clean
+                if pushed_files:
+                    temp_files_dir = os.path.join(
+                        self.upload_dir, "files", v_next_version
+                    )
+                    os.renames(temp_files_dir, version_dir)
+
+                db.session.commit()
+
+                # remove used chunks only after commit — chunks belong to the now-committed version
+                if pushed_files:
+                    chunks_ids = []
+                    for file in pushed_files:
+                        chunks_ids.extend(file.get("chunks", []))
+                    remove_transaction_chunks.delay(chunks_ids)
+
+                logging.info(
+                    f"Push finished for project: {project.id}, project version: {v_next_version}."
+                )
+                project_version_created.send(pv)
+                push_finished.send(pv)
+        except (
+            psycopg2.Error,
+            OSError,
+            IntegrityError,
+        ) as err:
+            db.session.rollback()
+            logging.exception(
+                f"Failed to finish push for project: {project.id}, project version: {v_next_version}: {str(err)}"
+            )
+            if (
+                os.path.exists(version_dir)
+                and not ProjectVersion.query.filter_by(
+                    project_id=project.id, name=next_version
+                ).count()
+            ):
+                move_to_tmp(version_dir)
+            return Err((UploadError(), 422))
+        # catch exception during pg transaction so we can rollback and prevent PendingRollbackError during upload clean up
+        except gevent.timeout.Timeout:
+            db.session.rollback()
+            if (
+                os.path.exists(version_dir)
+                and not ProjectVersion.query.filter_by(
+                    project_id=project.id, name=next_version
+                ).count()
+            ):
+                move_to_tmp(version_dir)
+            raise
+        finally:
+            # remove upload artifacts
+            self.clear()
+
+        return Ok(pv)
+
     def process_chunks(
-        self, use_shared_chunk_dir: bool
+        self, use_shared_chunk_dir: bool, workers: Optional[int] = None
     ) -> Tuple[List[ProjectFileChange], Dict]:
-        """Concatenate chunks into single file and apply gpkg updates if needed"""
+        """Concatenate chunks into single file and apply gpkg updates if needed.
+
+        Files are independent of each other, hence they can be processed concurrently by pool of workers.
+        """
         errors = {}
+        workers = workers or current_app.config["UPLOAD_PROCESSING_WORKERS"]
         project_path = get_project_path(self.project)
+        upload_dir = self.upload_dir
         v_next_version = ProjectVersion.to_v_name(self.project.next_version())
         chunks_map = {
             f["path"]: f["chunks"]
@@ -2055,129 +2344,202 @@ class Upload(db.Model):
         }
         file_changes = files_changes_from_upload(self.changes, v_next_version)
         to_remove = [i.path for i in file_changes if i.change == PushChangeType.DELETE]
-        current_files = [f for f in self.project.files if f.path not in to_remove]
+        current_files = {
+            f.path: f for f in self.project.files if f.path not in to_remove
+        }
+        to_process = [f for f in file_changes if f.change != PushChangeType.DELETE]
+
+        def _process(f: ProjectFileChange) -> Optional[str]:
+            # based on API version location for uploaded chunks differs
+            chunks = [
+                (
+                    get_chunk_location(chunk_id, self.project.workspace_id)
+                    if use_shared_chunk_dir
+                    else os.path.join(upload_dir, "chunks", chunk_id)
+                )
+                for chunk_id in chunks_map.get(f.path, [])
+            ]
+            return self._process_file(
+                f,
+                chunks,
+                current_files.get(f.path),
+                upload_dir,
+                v_next_version,
+                project_path,
+            )
 
         with self.heartbeat(5):
-            for f in file_changes:
-                if f.change == PushChangeType.DELETE:
-                    continue
+            if workers > 1 and len(to_process) > 1:
+                results = self._run_in_pool(_process, to_process, workers)
+            else:
+                results = [_process(f) for f in to_process]
 
-                f_location = (
-                    f.diff.location
-                    if f.change == PushChangeType.UPDATE_DIFF
-                    else f.location
-                )
-                temporary_location = os.path.join(self.upload_dir, "files", f_location)
-                os.makedirs(os.path.dirname(temporary_location), exist_ok=True)
-                with open(temporary_location, "wb") as dest:
-                    try:
-                        for chunk_id in chunks_map.get(f.path, []):
-                            # based on API version location for uploaded chunks differs
-                            if use_shared_chunk_dir:
-                                chunk_file = get_chunk_location(chunk_id)
-                            else:
-                                chunk_file = os.path.join(
-                                    self.upload_dir, "chunks", chunk_id
-                                )
-
-                            if not os.path.exists(chunk_file):
-                                errors[f.path] = FileSyncErrorType.CORRUPTED.value
-                                continue
-
-                            with open(chunk_file, "rb") as src:
-                                data = src.read(8192)
-                                while data:
-                                    dest.write(data)
-                                    data = src.read(8192)
-
-                    except IOError:
-                        logging.exception(
-                            f"Failed to process chunk: {chunk_id} in project {project_path}"
-                        )
-                        errors[f.path] = FileSyncErrorType.CORRUPTED.value
-                        continue
+        # merge results in order of changes to keep output stable
+        for f, error in zip(to_process, results):
+            if error:
+                errors[f.path] = error
+        return file_changes, errors
 
-                if (
-                    not f.change == PushChangeType.UPDATE_DIFF
-                    and not is_supported_type(temporary_location)
-                ):
-                    logging.info(f"Rejecting blacklisted file: {temporary_location}")
-                    errors[f.path] = FileSyncErrorType.UNSUPPORTED.value
-                    continue
+    def _run_in_pool(self, func, items: List, workers: int) -> List:
+        """Run func on items in bounded pool of native threads, with results in order of items.
 
-                # check if .gpkg file is valid
-                if is_versioned_file(temporary_location) and not f.is_valid_gpkg():
-                    errors[f.path] = FileSyncErrorType.CORRUPTED.value
-                    continue
+        Each worker has its own app context (and db session), database records created by workers
+        (e.g. geodiff action history) are handed over to the current session.
+        """
+        app = current_app._get_current_object()
+        # make sure storage (with lazily created geodiff instances) exists before going parallel
+        self.project.storage
+
+        def _worker(item):
+            with app.app_context():
+                result = func(item)
+                return result, list(db.session.new)
+
+        with thread_pool_executor(workers) as executor:
+            outputs = list(executor.map(_worker, items))
 
-                expected_size = (
-                    f.diff.size if f.change == PushChangeType.UPDATE_DIFF else f.size
+        results = []
+        for result, new_objects in outputs:
+            db.session.add_all(new_objects)
+            results.append(result)
+        return results
+
+    def _process_file(
+        self,
+        f: ProjectFileChange,
+        chunks: List[str],
+        current_file: Optional[ProjectFile],
+        upload_dir: str,
+        v_next_version: str,
+        project_path: str,
+    ) -> Optional[str]:
+        """Assemble single uploaded file from its chunks, validate it and apply gpkg updates if needed.
+        File change metadata are updated in place, returns error if file can not be accepted.
+        """
+        f_location = (
+            f.diff.location if f.change == PushChangeType.UPDATE_DIFF else f.location
+        )
+        temporary_location = os.path.join(upload_dir, "files", f_location)
+        if not all(os.path.exists(chunk) for chunk in chunks):
+            return FileSyncErrorType.CORRUPTED.value
+
+        try:
+            f.upload = assemble_chunks(chunks, temporary_location)
+        except IOError:
+            logging.exception(
+                f"Failed to process chunks of file {f.path} in project {project_path}"
+            )
+            return FileSyncErrorType.CORRUPTED.value
+
+        if not f.change == PushChangeType.UPDATE_DIFF and not is_supported_type(
+            temporary_location, f.upload.mime_type
+        ):
+            logging.info(f"Rejecting blacklisted file: {temporary_location}")
+            return FileSyncErrorType.UNSUPPORTED.value
+
+        # check if .gpkg file is valid
+        if is_versioned_file(temporary_location) and not f.is_valid_gpkg():
+            return FileSyncErrorType.CORRUPTED.value
+
+        expected = f.diff if f.change == PushChangeType.UPDATE_DIFF else f
+        if expected.size != f.upload.size or expected.checksum != f.upload.checksum:
+            logging.error(
+                f"Data integrity check has failed on file {f.path} in project {project_path}",
+                exc_info=True,
+            )
+            return FileSyncErrorType.CORRUPTED.value
+
+        # for updates try to apply diff to create a full updated gpkg file or from full .gpkg try to create corresponding diff
+        if f.change not in (
+            PushChangeType.UPDATE,
+            PushChangeType.UPDATE_DIFF,
+        ) or not is_versioned_file(f.path):
+            return
+
+        if not current_file:
+            return f"{FileSyncErrorType.SYNC_ERROR.value}: file not found on server"
+
+        if f.diff:
+            changeset = temporary_location
+            patched_file = os.path.join(upload_dir, "files", f.location)
+            result = self.project.storage.apply_diff(
+                current_file, changeset, patched_file
+            )
+            if not result.ok():
+                return f"{FileSyncErrorType.SYNC_ERROR.value}: project {project_path}, {result.value}"
+            f.checksum, f.size = result.value
+        else:
+            diff_name = mergin_secure_filename(f.path + "-diff-" + str(uuid.uuid4()))
+            changeset = os.path.join(upload_dir, "files", v_next_version, diff_name)
+            patched_file = temporary_location
+            result = self.project.storage.construct_diff(
+                current_file, changeset, patched_file
+            )
+            if result.ok():
+                checksum, size = result.value
+                f.diff = ProjectDiffFile(
+                    checksum=checksum,
+                    size=size,
+                    path=diff_name,
+                    location=os.path.join(v_next_version, diff_name),
                 )
-                if expected_size != os.path.getsize(temporary_location):
-                    logging.error(
-                        f"Data integrity check has failed on file {f.path} in project {project_path}",
-                        exc_info=True,
-                    )
-                    errors[f.path] = FileSyncErrorType.CORRUPTED.value
-                    continue
+                f.change = PushChangeType.UPDATE_DIFF
+            else:
+                # if diff cannot be constructed it would be a force update
+                logging.warning(f"Geodiff: create changeset error {result.value}")
 
-                # for updates try to apply diff to create a full updated gpkg file or from full .gpkg try to create corresponding diff
-                if f.change in (
-                    PushChangeType.UPDATE,
-                    PushChangeType.UPDATE_DIFF,
-                ) and is_versioned_file(f.path):
-                    current_file = next(
-                        (i for i in current_files if i.path == f.path), None
-                    )
-                    if not current_file:
-                        errors[f.path] = (
-                            f"{FileSyncErrorType.SYNC_ERROR.value}: file not found on server"
-                        )
-                        continue
 
-                    if f.diff:
-                        changeset = temporary_location
-                        patched_file = os.path.join(
-                            self.upload_dir, "files", f.location
-                        )
+class PushJobStatus(Enum):
+    PENDING = "pending"
+    FINISHED = "finished"
+    FAILED = "failed"
 
-                        result = self.project.storage.apply_diff(
-                            current_file, changeset, patched_file
-                        )
-                        if result.ok():
-                            checksum, size = result.value
-                            f.checksum = checksum
-                            f.size = size
-                        else:
-                            errors[f.path] = (
-                                f"{FileSyncErrorType.SYNC_ERROR.value}: project {self.project.workspace.name}/{self.project.name}, {result.value}"
-                            )
-                    else:
-                        diff_name = mergin_secure_filename(
-                            f.path + "-diff-" + str(uuid.uuid4())
-                        )
-                        changeset = os.path.join(
-                            self.upload_dir, "files", v_next_version, diff_name
-                        )
-                        patched_file = temporary_location
-                        result = self.project.storage.construct_diff(
-                            current_file, changeset, patched_file
-                        )
-                        if result.ok():
-                            checksum, size = result.value
-                            f.diff = ProjectDiffFile(
-                                checksum=checksum,
-                                size=size,
-                                path=diff_name,
-                                location=os.path.join(v_next_version, diff_name),
-                            )
-                            f.change = PushChangeType.UPDATE_DIFF
-                        else:
-                            # if diff cannot be constructed it would be a force update
-                            logging.warning(
-                                f"Geodiff: create changeset error {result.value}"
-                            )
-        return file_changes, errors
+    @classmethod
+    def values(cls):
+        return [member.value for member in cls.__members__.values()]
+
+
+class PushJob(db.Model):
+    """Project push finished asynchronously by celery task.
+    Job is identified by upload transaction and outlives the upload so the client can poll its result.
+    """
+
+    id = db.Column(UUID(as_uuid=True), primary_key=True)
+    project_id = db.Column(
+        UUID(as_uuid=True), db.ForeignKey("project.id", ondelete="CASCADE"), index=True
+    )
+    # project version to be created
+    version = db.Column(db.Integer, nullable=False)
+    user_id = db.Column(
+        db.Integer, db.ForeignKey("user.id", ondelete="SET NULL"), nullable=True
+    )
+    status = db.Column(
+        ENUM(*PushJobStatus.values(), name="push_job_status"),
+        nullable=False,
+        default=PushJobStatus.PENDING.value,
+        index=True,
+    )
+    # serialized response error for failed job
+    error = db.Column(JSONB, nullable=True)
+    created = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    finished = db.Column(db.DateTime, nullable=True)
+
+    project = db.relationship("Project", uselist=False)
+
+    def __init__(self, upload: Upload):
+        self.id = upload.transaction_id
+        self.project_id = upload.project_id
+        self.version = upload.version + 1
+        self.user_id = upload.user_id
+        self.status = PushJobStatus.PENDING.value
+
+    def finish(self, error: Optional[dict] = None):
+        """Mark job as done, either successfully or with response error"""
+        self.status = (
+            PushJobStatus.FAILED.value if error else PushJobStatus.FINISHED.value
+        )
+        self.error = error
+        self.finished = datetime.utcnow()
 
 
 class RequestStatus(Enum):
@@ -2327,10 +2689,12 @@ class ProjectUser(db.Model):
         db.ForeignKey("project.id", ondelete="CASCADE"),
         primary_key=True,
     )
+    # index of projects shared with user, used to look up projects accessible to user
     user_id = db.Column(
         db.Integer,
         db.ForeignKey("user.id", ondelete="CASCADE"),
         primary_key=True,
+        index=True,
     )
     role = db.Column(
         ENUM(
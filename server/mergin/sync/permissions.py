@@ -4,10 +4,10 @@
 
 import os
 from functools import wraps
-from typing import Optional
+from typing import Dict, List, Optional
 from flask import abort, current_app
 from flask_login import current_user
-from sqlalchemy import or_
+from sqlalchemy import union
 
 from .utils import is_valid_uuid
 from ..app import db
@@ -45,6 +45,9 @@ class ProjectPermissions:
             return True
 
     class Read(Base):
+        # minimal effective role of user in project with this permission
+        role = ProjectRole.READER
+
         @classmethod
         @_is_superuser
         def check(cls, project, user):
@@ -75,32 +78,32 @@ class ProjectPermissions:
                     for ws in all_workspaces
                     if ws.user_has_permissions(user, "read")
                 ]
-                subquery = (
-                    db.session.query(ProjectUser.project_id)
-                    .filter(ProjectUser.user_id == user.id)
-                    .subquery()
-                )
-                if public:
-                    query = query.filter(
-                        or_(
-                            Project.public.is_(True),
-                            Project.workspace_id.in_(user_workspace_ids),
-                            Project.id.in_(subquery),
-                        )
+                # projects accessible to user are collected by indexed lookups (projects shared with user,
+                # projects in user workspaces and public projects) and semi-joined, rather than filtered by disjunction
+                accessible = [
+                    db.select(ProjectUser.project_id.label("id")).where(
+                        ProjectUser.user_id == user.id
                     )
-                else:
-                    query = query.filter(
-                        or_(
-                            Project.workspace_id.in_(user_workspace_ids),
-                            Project.id.in_(subquery),
+                ]
+                if user_workspace_ids:
+                    accessible.append(
+                        db.select(Project.id).where(
+                            Project.workspace_id.in_(user_workspace_ids)
                         )
                     )
+                if public:
+                    accessible.append(
+                        db.select(Project.id).where(Project.public.is_(True))
+                    )
+                query = query.filter(Project.id.in_(union(*accessible)))
             else:
                 query = query.filter(Project.public.is_(True))
 
             return query
 
     class Edit(Base):
+        role = ProjectRole.EDITOR
+
         @classmethod
         @_is_superuser
         def check(self, project, user):
@@ -113,6 +116,8 @@ class ProjectPermissions:
             )
 
     class Upload(Base):
+        role = ProjectRole.WRITER
+
         @classmethod
         @_is_superuser
         def check(cls, project, user):
@@ -125,6 +130,8 @@ class ProjectPermissions:
             )
 
     class Update(Base):
+        role = ProjectRole.OWNER
+
         @classmethod
         @_is_superuser
         def check(cls, project, user):
@@ -137,6 +144,8 @@ class ProjectPermissions:
             )
 
     class Delete(Base):
+        role = ProjectRole.OWNER
+
         @classmethod
         @_is_superuser
         def check(cls, project, user):
@@ -149,6 +158,8 @@ class ProjectPermissions:
             )
 
     class All(Base):
+        role = ProjectRole.OWNER
+
         @classmethod
         @_is_superuser
         def check(cls, project, user):
@@ -167,16 +178,102 @@ class ProjectPermissions:
         """Get the highest role of user for given project.
         It can be based on local project settings or some global workspace settings.
         """
-        if self.All.check(project, user):
+        return ProjectPermissionsResolver(user, [project]).get_role(project)
+
+
+class ProjectPermissionsResolver:
+    """Resolve effective roles of user in projects once, e.g. for all projects serialized in a request.
+
+    Direct project roles are loaded for all projects by a single query and workspace permissions are checked
+    once per workspace, permission checks are then just lookups.
+    Resolved roles do not reflect later changes of project or workspace roles.
+    """
+
+    def __init__(self, user: User, projects: List[Project] = None):
+        self.user = user
+        self._roles: Dict[str, Optional[ProjectRole]] = {}
+        self._workspace_permissions: Dict[tuple, bool] = {}
+        if projects:
+            self.load(projects)
+
+    def load(self, projects: List[Project]) -> None:
+        """Resolve roles of user in projects which are not resolved yet"""
+        projects = [p for p in projects if p.id not in self._roles]
+        if not projects:
+            return
+
+        members = {}
+        if self.user.is_authenticated:
+            # use project members if they are already loaded (e.g. eagerly), otherwise query them at once
+            not_loaded = []
+            for project in projects:
+                if "project_users" in project.__dict__:
+                    member = project._member(self.user.id)
+                    members[project.id] = member.role if member else None
+                else:
+                    not_loaded.append(project.id)
+            if not_loaded:
+                members.update(
+                    db.session.query(ProjectUser.project_id, ProjectUser.role)
+                    .filter(
+                        ProjectUser.user_id == self.user.id,
+                        ProjectUser.project_id.in_(not_loaded),
+                    )
+                    .all()
+                )
+        for project in projects:
+            project_role = members.get(project.id)
+            self._roles[project.id] = self._resolve(
+                project, ProjectRole(project_role) if project_role else None
+            )
+
+    def _has_workspace_permissions(self, project: Project, permissions: str) -> bool:
+        key = (project.workspace_id, permissions)
+        if key not in self._workspace_permissions:
+            self._workspace_permissions[key] = check_project_workspace_permissions(
+                project, self.user, permissions
+            )
+        return self._workspace_permissions[key]
+
+    def _resolve(
+        self, project: Project, project_role: Optional[ProjectRole]
+    ) -> Optional[ProjectRole]:
+        """Highest role of user in project, see ProjectPermissions.get_user_project_role"""
+        if self.user.is_authenticated and self.user.is_admin:
             return ProjectRole.OWNER
-        if self.Upload.check(project, user):
-            return ProjectRole.WRITER
-        if self.Edit.check(project, user):
-            return ProjectRole.EDITOR
-        if self.Read.check(project, user):
+
+        if not ProjectPermissions.Base.check(project, self.user):
+            # public active projects can be read by anyone
+            if project.public and not project.removed_at:
+                return ProjectRole.READER
+            return None
+
+        for role, permissions in (
+            (ProjectRole.OWNER, "admin"),
+            (ProjectRole.WRITER, "write"),
+            (ProjectRole.EDITOR, "edit"),
+            (ProjectRole.READER, "read"),
+        ):
+            if (
+                project_role and project_role >= role
+            ) or self._has_workspace_permissions(project, permissions):
+                return role
+
+        if project.public:
             return ProjectRole.READER
         return None
 
+    def get_role(self, project: Project) -> Optional[ProjectRole]:
+        """Effective role of user in project"""
+        if project.id not in self._roles:
+            self.load([project])
+        return self._roles[project.id]
+
+    def check(self, project: Project, permission) -> bool:
+        """Equivalent of permission.check(project, user)"""
+        role = self.get_role(project)
+        return role is not None and role >= permission.role
+
 
 def is_active_workspace(workspace):
     """
@@ -249,18 +346,26 @@ def require_project_by_uuid(
 
 
 def check_project_permissions(
-    project: Project, permission: ProjectPermissions
+    project: Project,
+    permission: ProjectPermissions,
+    resolver: ProjectPermissionsResolver = None,
 ) -> int | None:
     """Check project permissions and return appropriate HTTP error code if check fails.
     :param project: project
     :type project: Project
     :param permission: permission to check
     :type permission: ProjectPermissions
+    :param resolver: resolver with already resolved roles of current user, optional
+    :type resolver: ProjectPermissionsResolver
     :return: HTTP error code if permission check fails, None otherwise
     :rtype: int | None
     """
+    if resolver:
+        allowed = resolver.check(project, permission)
+    else:
+        allowed = permission.check(project, current_user)
 
-    if not permission.check(project, current_user):
+    if not allowed:
         # logged in - NO, have acccess - NONE, public project - NO
         if current_user.is_anonymous:
             # we don't want to tell anonymous user if a private project exists
@@ -31,7 +31,12 @@ from .permissions import (
     ProjectPermissions,
     check_workspace_permissions,
 )
-from ..utils import parse_order_params, split_order_param, get_order_param
+from ..utils import (
+    parse_order_params,
+    split_order_param,
+    get_order_param,
+    paginate_query,
+)
 from .tasks import create_project_version_zip
 from .utils import prepare_download_response
 
@@ -184,7 +189,9 @@ def list_namespace_project_access_requests(
 
 
 @auth_required(permissions=["admin"])
-def list_projects(page, per_page, order_params=None, like=None):  # noqa: E501
+def list_projects(
+    page, per_page, order_params=None, like=None, cursor=None, count=True
+):  # noqa: E501
     projects = current_app.ws_handler.projects_query(like)
     # do not fetch from db what is not needed
     projects = projects.options(
@@ -205,11 +212,14 @@ def list_projects(page, per_page, order_params=None, like=None):  # noqa: E501
                 order_by_params.append(get_order_param(Project, order_param))
         projects = projects.order_by(*order_by_params)
 
-    paginate = projects.paginate(page=page, per_page=per_page)
-    result = paginate.items
-    total = paginate.total
+    try:
+        result, total, next_cursor = paginate_query(
+            projects, page, per_page, Project.id, cursor, count
+        )
+    except ValueError as e:
+        abort(400, str(e))
     data = AdminProjectSchema(many=True).dump(result)
-    data = {"items": data, "count": total}
+    data = {"items": data, "count": total, "next_cursor": next_cursor}
     return data, 200
 
 
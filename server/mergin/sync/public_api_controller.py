@@ -28,7 +28,6 @@ import re
 from sqlalchemy import and_, desc, asc, text, tuple_
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from sqlalchemy.orm import contains_eager, joinedload, load_only, selectinload
-from gevent import sleep
 import base64
 from werkzeug.exceptions import HTTPException, Conflict
 
@@ -55,12 +54,14 @@ from .files import (
     ProjectFileChange,
     ChangesSchema,
     ProjectFileSchema,
+    changes_size_delta,
     files_changes_from_upload,
+    index_files,
     mergin_secure_filename,
 )
 from .schemas import (
     ProjectSchema,
-    ProjectListSchema,
+    dump_project_list,
     ProjectVersionSchema,
     ProjectSchemaForVersion,
     UserWorkspaceSchema,
@@ -89,7 +90,7 @@ from .utils import (
     wkb2wkt,
 )
 from .errors import StorageLimitHit, ProjectLocked
-from ..utils import format_time_delta
+from ..utils import format_time_delta, paginate_query
 
 
 def parse_project_access_update_request(access: Dict) -> Dict:
@@ -498,7 +499,7 @@ def get_project_by_uuid(project_id):  # noqa: E501
 
 
 def get_paginated_project_versions(
-    page, per_page, namespace, project_name, descending=True
+    page, per_page, namespace, project_name, descending=True, cursor=None, count=True
 ):
     project = require_project(namespace, project_name, ProjectPermissions.Read)
     query = ProjectVersion.query.filter(
@@ -511,9 +512,12 @@ def get_paginated_project_versions(
         if descending
         else query.order_by(asc(ProjectVersion.name))
     )
-    paginate = query.paginate(page=page, per_page=per_page)
-    result = paginate.items
-    total = paginate.total
+    try:
+        result, total, next_cursor = paginate_query(
+            query, page, per_page, ProjectVersion.id, cursor, count
+        )
+    except ValueError as e:
+        abort(400, str(e))
 
     # batch-resolve workspace names for the page
     ws_ids = {v.project.workspace_id for v in result}
@@ -539,7 +543,7 @@ def get_paginated_project_versions(
 
     ctx = {"workspaces_map": workspaces_map}
     versions = ProjectVersionListSchema(many=True, context=ctx).dump(result)
-    data = {"versions": versions, "count": total}
+    data = {"versions": versions, "count": total, "next_cursor": next_cursor}
     return data, 200
 
 
@@ -551,13 +555,10 @@ def _precompute_has_conflict(projects):
     rows = db.session.execute(
         text(
             """
-            SELECT DISTINCT lpf.project_id
-            FROM latest_project_files lpf
-            CROSS JOIN unnest(lpf.file_history_ids) AS fh_id
-            JOIN file_history fh ON fh.id = fh_id
-            JOIN project_file_path fp ON fp.id = fh.file_path_id
-            WHERE lpf.project_id = ANY(:project_ids)
-            AND fp.path ~ :pattern
+            SELECT DISTINCT project_id
+            FROM current_project_file
+            WHERE project_id = ANY(:project_ids)
+            AND path ~ :pattern
         """
         ),
         {"project_ids": [p.id for p in projects], "pattern": conflict_regex},
@@ -630,11 +631,12 @@ def get_projects_by_names():  # noqa: E501
         _precompute_has_conflict(found_projects)
 
         ctx = {"users_map": users_map, "workspaces_map": workspaces_map}
+        data = dict(zip(found_map, dump_project_list(list(found_map.values()), ctx)))
 
         for key, workspace, name in valid_projects:
-            result = found_map.get((workspace.id, name))
+            result = data.get((workspace.id, name))
             if result:
-                results[key] = ProjectListSchema(context=ctx).dump(result)
+                results[key] = result
             else:
                 results[key] = (
                     {"error": 401}
@@ -677,7 +679,7 @@ def get_projects_by_uuids(uuids):  # noqa: E501
     }
     workspaces_map = {w.id: w.name for w in current_app.ws_handler.get_by_ids(ws_ids)}
     ctx = {"users_map": users_map, "workspaces_map": workspaces_map}
-    data = ProjectListSchema(many=True, context=ctx).dump(projects)
+    data = dump_project_list(projects, ctx)
     projects_map = {item["id"]: item for item in data}
     return projects_map, 200
 
@@ -697,6 +699,8 @@ def get_paginated_projects(
     as_admin=False,
     public=True,
     only_public=False,
+    cursor=None,
+    count=True,
 ):  # noqa: E501
     """List mergin projects
 
@@ -730,8 +734,12 @@ def get_paginated_projects(
     :type public: bool
     :param only_public: Return only public projects
     :type only_public: bool
+    :param cursor: Cursor of requested page returned with previous page, page number is ignored if provided
+    :type cursor: str
+    :param count: Return total number of projects
+    :type count: bool
 
-    :rtype: Dict[str: List[ProjectListItem], str: Integer]
+    :rtype: Dict[str: List[ProjectListItem], str: Integer, str: str]
     """
     projects = current_app.ws_handler.filter_projects(
         order_params,
@@ -747,11 +755,17 @@ def get_paginated_projects(
         public,
         only_public,
     )
-    pagination = projects.options(selectinload(Project.project_users)).paginate(
-        page=page, per_page=per_page
-    )
-    result = pagination.items
-    total = pagination.total
+    try:
+        result, total, next_cursor = paginate_query(
+            projects.options(selectinload(Project.project_users)),
+            page,
+            per_page,
+            Project.id,
+            cursor,
+            count,
+        )
+    except ValueError as e:
+        abort(400, str(e))
     _precompute_has_conflict(result)
 
     # create user map id:username passed to project schema to minimize queries to db
@@ -766,11 +780,8 @@ def get_paginated_projects(
     ws_ids = [p.workspace_id for p in result]
     workspaces_map = {w.id: w.name for w in current_app.ws_handler.get_by_ids(ws_ids)}
     ctx = {"users_map": users_map, "workspaces_map": workspaces_map}
-    sleep(
-        0
-    )  # temporary yield to gevent hub until serialization is fully resolved (#317)
-    data = ProjectListSchema(many=True, context=ctx).dump(result)
-    data = {"projects": data, "count": total}
+    data = dump_project_list(result, ctx)
+    data = {"projects": data, "count": total, "next_cursor": next_cursor}
     return data, 200
 
 
@@ -926,25 +937,14 @@ def project_push(namespace, project_name):
         msg = err.messages[0] if type(err.messages) == list else "Invalid input data"
         abort(400, msg)
 
+    project_files = index_files(project.files)
     for item in upload_changes["added"]:
         # check if same file is not already uploaded
-        if not all(ele.path != item["path"] for ele in project.files):
+        if item["path"] in project_files:
             abort(400, f"File {item['path']} has been already uploaded")
 
     # Check user data limit
-    updated_files = list(
-        filter(
-            lambda i: i.path in [f["path"] for f in upload_changes["updated"]],
-            project.files,
-        )
-    )
-    additional_disk_usage = (
-        sum(
-            file["size"] for file in upload_changes["added"] + upload_changes["updated"]
-        )
-        - sum(file.size for file in updated_files)
-        - sum(file["size"] for file in upload_changes["removed"])
-    )
+    additional_disk_usage = changes_size_delta(upload_changes, project_files)
     current_usage = ws.disk_usage()
     requested_storage = current_usage + additional_disk_usage
     if requested_storage > ws.storage:
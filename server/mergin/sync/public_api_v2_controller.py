@@ -5,34 +5,48 @@
 import os
 from datetime import datetime
 from typing import Optional
+import hashlib
 import uuid
-import gevent
 import logging
 import os
-import psycopg2
 from connexion import NoContent, request
 from datetime import datetime, timedelta, timezone
 from flask import abort, jsonify, current_app
 from flask_login import current_user
 from marshmallow import ValidationError
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
-
-from .schemas_v2 import BatchErrorSchema, ProjectSchema as ProjectSchemaV2
+from werkzeug.datastructures import ContentRange
+from werkzeug.exceptions import ClientDisconnected
+from werkzeug.http import parse_content_range_header
+
+from .schemas_v2 import (
+    BatchErrorSchema,
+    dump_projects,
+    ProjectSchema as ProjectSchemaV2,
+    PushJobSchema,
+)
 from ..app import db
 from ..auth import auth_required
 from ..auth.models import User
+from .delta import DeltaCache
 from .errors import (
     AnotherUploadRunning,
     BatchLimitError,
     BigChunkError,
-    DataSyncError,
+    ChunkOffsetMismatch,
     DiffDownloadError,
     ProjectLocked,
     ProjectVersionExists,
     StorageLimitHit,
     UploadError,
 )
-from .files import ChangesSchema, DeltaChangeRespSchema, ProjectFileSchema
+from .files import (
+    ChangesSchema,
+    DeltaChangeRespSchema,
+    ProjectFileSchema,
+    changes_size_delta,
+    index_files,
+)
 from .forms import project_name_validation
 from .models import (
     FileDiff,
@@ -40,12 +54,12 @@ from .models import (
     ProjectRole,
     ProjectMember,
     ProjectVersion,
+    PushJob,
     Upload,
-    project_version_created,
-    push_finished,
 )
 from .permissions import (
     ProjectPermissions,
+    ProjectPermissionsResolver,
     check_project_permissions,
     require_project_by_uuid,
     projects_query,
@@ -56,17 +70,22 @@ from .schemas import (
     UploadChunkSchema,
 )
 from .schemas_v2 import ProjectSchema as ProjectSchemaV2
-from .storages.disk import move_to_tmp, save_to_file
+from .storages.disk import exclusive_lock, save_to_file
+from .storages.storage import FileSizeLimitExceeded
 from .utils import (
     get_device_id,
     get_ip,
     get_user_agent,
+    generate_checksum,
     get_chunk_location,
+    is_content_addressed_chunk,
+    is_valid_uuid,
     prepare_download_response,
+    touch_file,
 )
-from .tasks import remove_transaction_chunks
+from .tasks import finish_project_version
 from .workspace import WorkspaceRole
-from ..utils import parse_order_params, get_schema_fields_map
+from ..utils import parse_order_params, get_schema_fields_map, paginate_query
 
 
 @auth_required
@@ -232,10 +251,6 @@ def create_project_version(id):
     if project.locked_until:
         return ProjectLocked().response(423)
 
-    next_version = project.next_version()
-    v_next_version = ProjectVersion.to_v_name(next_version)
-    version_dir = os.path.join(project.storage.project_dir, v_next_version)
-
     pv = project.get_latest_version()
     if pv and pv.name != version:
         return ProjectVersionExists(version, pv.name).response(409)
@@ -252,7 +267,8 @@ def create_project_version(id):
     to_be_removed_files = upload_changes["removed"]
 
     # check consistency of changes
-    current_files = set(file.path for file in project.files)
+    project_files = index_files(project.files)
+    current_files = project_files.keys()
     added_files = set(file["path"] for file in to_be_added_files)
     if added_files and added_files.issubset(current_files):
         return UploadError(
@@ -268,17 +284,7 @@ def create_project_version(id):
         ).response(422)
 
     # Check user data limit
-    updated_files = list(
-        filter(
-            lambda i: i.path in [f["path"] for f in to_be_updated_files],
-            project.files,
-        )
-    )
-    additional_disk_usage = (
-        sum(file["size"] for file in to_be_added_files + to_be_updated_files)
-        - sum(file.size for file in updated_files)
-        - sum(file["size"] for file in to_be_removed_files)
-    )
+    additional_disk_usage = changes_size_delta(upload_changes, project_files)
 
     current_usage = project.workspace.disk_usage()
     requested_storage = current_usage + additional_disk_usage
@@ -303,90 +309,28 @@ def create_project_version(id):
         logging.exception(f"Failed to create upload directory: {str(err)}")
         return UploadError().response(422)
 
-    # this is the heavy work of processing upload data
-    file_changes, errors = upload.process_chunks(use_shared_chunk_dir=True)
-    # files consistency or geodiff related issues, project push would never succeed, whole upload is aborted
-    if errors:
-        upload.clear()
-        return DataSyncError(failed_files=errors).response(422)
-
-    if os.path.exists(version_dir):
-        if ProjectVersion.query.filter_by(
-            project_id=project.id, name=next_version
-        ).count():
-            return UploadError(
-                error=f"Version {v_next_version} already exists"
-            ).response(409)
-        move_to_tmp(version_dir)
-
-    try:
-        # let's keep upload alive until all work is done so no one else can claim it
-        with upload.heartbeat(5):
-            pv = ProjectVersion(
-                project,
-                next_version,
-                current_user.id,
-                file_changes,
-                get_ip(request),
-                get_user_agent(request),
-                get_device_id(request),
-            )
-            db.session.add(pv)
-            db.session.add(project)
-
-            # move files before committing so a filesystem failure leaves the DB clean
-            if to_be_added_files or to_be_updated_files:
-                temp_files_dir = os.path.join(
-                    upload.upload_dir, "files", v_next_version
-                )
-                os.renames(temp_files_dir, version_dir)
-
-            db.session.commit()
-
-            # remove used chunks only after commit — chunks belong to the now-committed version
-            if to_be_added_files or to_be_updated_files:
-                chunks_ids = []
-                for file in to_be_added_files + to_be_updated_files:
-                    file_chunks = file.get("chunks", [])
-                    chunks_ids.extend(file_chunks)
-                remove_transaction_chunks.delay(chunks_ids)
-
-            logging.info(
-                f"Push finished for project: {project.id}, project version: {v_next_version}."
-            )
-            project_version_created.send(pv)
-            push_finished.send(pv)
-    except (
-        psycopg2.Error,
-        OSError,
-        IntegrityError,
-    ) as err:
-        db.session.rollback()
-        logging.exception(
-            f"Failed to finish push for project: {project.id}, project version: {v_next_version}: {str(err)}"
+    if request.json.get("async", False):
+        # heavy work is done in background, upload is kept alive by the task until version is created
+        job = PushJob(upload)
+        db.session.add(job)
+        db.session.commit()
+        finish_project_version.delay(
+            str(job.id),
+            get_ip(request),
+            get_user_agent(request),
+            get_device_id(request),
         )
-        if (
-            os.path.exists(version_dir)
-            and not ProjectVersion.query.filter_by(
-                project_id=project.id, name=next_version
-            ).count()
-        ):
-            move_to_tmp(version_dir)
-        return UploadError().response(422)
-    # catch exception during pg transaction so we can rollback and prevent PendingRollbackError during upload clean up
-    except gevent.timeout.Timeout:
-        db.session.rollback()
-        if (
-            os.path.exists(version_dir)
-            and not ProjectVersion.query.filter_by(
-                project_id=project.id, name=next_version
-            ).count()
-        ):
-            move_to_tmp(version_dir)
-        raise
-    finally:
-        # remove upload artifacts
-        upload.clear()
+        return PushJobSchema().dump(job), 202
+
+    result = upload.finish(
+        current_user.id,
+        get_ip(request),
+        get_user_agent(request),
+        get_device_id(request),
+    )
+    if not result.ok():
+        error, status = result.value
+        return error.response(status)
 
     result = ProjectSchemaV2().dump(project)
     result["files"] = ProjectFileSchema(
@@ -395,34 +339,191 @@ def create_project_version(id):
     return result, 201
 
 
+@auth_required
+def get_project_version_job(id, job_id):
+    """Get status of asynchronous project push"""
+    project = require_project_by_uuid(id, ProjectPermissions.Upload)
+    job = PushJob.query.filter_by(id=job_id, project_id=project.id).first_or_404()
+    return PushJobSchema().dump(job), 200
+
+
 @auth_required
 def upload_chunk(id: str):
     """
     Push chunk to chunks location.
+
+    If client provides sha1 checksum of chunk (as 'checksum' query parameter), chunk is stored by its content
+    and can be reused by subsequent uploads without transfer of data.
     """
     project = require_project_by_uuid(id, ProjectPermissions.Edit)
     if project.locked_until:
         return ProjectLocked().response(423)
-    # generate uuid for chunk
-    chunk_id = str(uuid.uuid4())
-    dest_file = get_chunk_location(chunk_id)
+
+    checksum = request.args.get("checksum")
+    if checksum is not None:
+        checksum = checksum.lower()
+        if not is_content_addressed_chunk(checksum):
+            return UploadError(error="Invalid chunk checksum").response(400)
+
+    content_range = request.headers.get("Content-Range")
+    if content_range:
+        return _upload_chunk_range(project, content_range, checksum)
+
+    if checksum:
+        chunk_id = checksum
+        if touch_file(get_chunk_location(chunk_id, project.workspace_id)):
+            return _chunk_response(chunk_id), 200
+    else:
+        # generate uuid for chunk
+        chunk_id = str(uuid.uuid4())
+
+    dest_file = get_chunk_location(chunk_id, project.workspace_id)
+    # content addressed chunk is written aside and moved into place only once verified
+    tmp_file = dest_file + f".{uuid.uuid4()}" if checksum else dest_file
+    hasher = hashlib.sha1() if checksum else None
     try:
         # we could have used request.data here, but it could eventually cause OOM issue
-        save_to_file(request.stream, dest_file, current_app.config["MAX_CHUNK_SIZE"])
+        save_to_file(
+            request.stream, tmp_file, current_app.config["MAX_CHUNK_SIZE"], hasher
+        )
     except IOError:
+        if checksum and os.path.exists(tmp_file):
+            os.remove(tmp_file)
         return BigChunkError().response(413)
     except Exception as e:
         return UploadError(error="Error saving chunk").response(400)
 
-    # Add valid_until timestamp to the response, remove tzinfo for compatibility with DateTimeWithZ
+    if checksum:
+        if hasher.hexdigest() != checksum:
+            os.remove(tmp_file)
+            return UploadError(error="Chunk checksum mismatch").response(400)
+        # identical chunk might have been uploaded concurrently, replace is atomic and harmless then
+        os.replace(tmp_file, dest_file)
+
+    return _chunk_response(chunk_id), 200
+
+
+def _upload_chunk_range(
+    project: Project, content_range: str, checksum: Optional[str] = None
+):
+    """Resumable upload of chunk by byte ranges.
+
+    Data are appended to partially stored chunk (identified by 'id' query parameter, generated on first request)
+    and response contains offset of data stored so far, so interrupted upload can continue from there.
+    Request with 'bytes */<length>' range only reports the current offset.
+    Once all data are received chunk is moved to its final location and can be used in push.
+    """
+    byte_range = parse_content_range_header(content_range)
+    if not byte_range or byte_range.units != "bytes" or byte_range.length is None:
+        return UploadError(error="Invalid Content-Range header").response(400)
+    if byte_range.length > current_app.config["MAX_CHUNK_SIZE"]:
+        return BigChunkError().response(413)
+
+    chunk_id = request.args.get("id") or checksum or str(uuid.uuid4())
+    if not (is_valid_uuid(chunk_id) or is_content_addressed_chunk(chunk_id)):
+        return UploadError(error="Invalid chunk id").response(400)
+    if checksum and chunk_id != checksum:
+        return UploadError(error="Chunk id does not match its checksum").response(400)
+
+    dest_file = get_chunk_location(chunk_id, project.workspace_id)
+    if touch_file(dest_file):
+        return _chunk_response(chunk_id, byte_range.length), 200
+
+    partial_file = dest_file + ".part"
+    if byte_range.start is None:
+        offset = os.path.getsize(partial_file) if os.path.exists(partial_file) else 0
+        return _chunk_response(chunk_id, offset), 202
+
+    # concurrent requests for the same chunk must not interleave their writes
+    os.makedirs(os.path.dirname(dest_file), exist_ok=True)
+    lock_file = dest_file + ".lock"
+    try:
+        with exclusive_lock(lock_file):
+            data, status = _append_chunk_range(
+                chunk_id, byte_range, dest_file, partial_file, checksum
+            )
+    except BlockingIOError:
+        return AnotherUploadRunning().response(409)
+    # once chunk is complete there is nothing to lock anymore
+    if status == 200 and os.path.exists(lock_file):
+        os.remove(lock_file)
+    return data, status
+
+
+def _append_chunk_range(
+    chunk_id: str,
+    byte_range: ContentRange,
+    dest_file: str,
+    partial_file: str,
+    checksum: Optional[str] = None,
+):
+    """Append range of data to partially stored chunk, caller must hold the lock of chunk"""
+    # chunk could have been completed by another request meanwhile
+    if os.path.exists(dest_file):
+        return _chunk_response(chunk_id, byte_range.length), 200
+
+    offset = os.path.getsize(partial_file) if os.path.exists(partial_file) else 0
+    if byte_range.start != offset:
+        return ChunkOffsetMismatch(offset).response(416)
+
+    try:
+        save_to_file(
+            request.stream,
+            partial_file,
+            byte_range.stop - byte_range.start,
+            append=True,
+        )
+    except FileSizeLimitExceeded:
+        return UploadError(error="Data exceed Content-Range").response(400)
+    except ClientDisconnected:
+        # data stored so far are kept to resume from
+        logging.warning(f"Interrupted upload of chunk {chunk_id}")
+
+    offset = os.path.getsize(partial_file)
+    if offset < byte_range.length:
+        return _chunk_response(chunk_id, offset), 202
+
+    if checksum and generate_checksum(partial_file) != checksum:
+        os.remove(partial_file)
+        return UploadError(error="Chunk checksum mismatch").response(400)
+    os.replace(partial_file, dest_file)
+    return _chunk_response(chunk_id, offset), 200
+
+
+def _chunk_response(chunk_id: str, offset: Optional[int] = None) -> dict:
+    """Chunk upload response with valid_until timestamp"""
+    # remove tzinfo for compatibility with DateTimeWithZ
     valid_until = (
         datetime.now(timezone.utc)
         + timedelta(seconds=current_app.config["UPLOAD_CHUNKS_EXPIRATION"])
     ).replace(tzinfo=None)
-    return (
-        UploadChunkSchema().dump({"id": chunk_id, "valid_until": valid_until}),
-        200,
-    )
+    data = {"id": chunk_id, "valid_until": valid_until}
+    if offset is not None:
+        data["offset"] = offset
+    return UploadChunkSchema().dump(data)
+
+
+@auth_required
+def check_chunks(id: str, body):
+    """Find out which of content addressed chunks are already available on server.
+    Found chunks are kept alive for another expiration period.
+    """
+    project = require_project_by_uuid(id, ProjectPermissions.Edit)
+    if project.locked_until:
+        return ProjectLocked().response(423)
+
+    # remove duplicates while preserving the order
+    checksums = list(dict.fromkeys(c.lower() for c in body.get("checksums", [])))
+    if len(checksums) > current_app.config.get("MAX_BATCH_SIZE", 100):
+        return BatchLimitError().response(400)
+
+    chunks = [
+        _chunk_response(checksum)
+        for checksum in checksums
+        if is_content_addressed_chunk(checksum)
+        and touch_file(get_chunk_location(checksum, project.workspace_id))
+    ]
+    return {"chunks": chunks}, 200
 
 
 def get_project_delta(id: str, since: str, to: Optional[str] = None):
@@ -449,8 +550,15 @@ def get_project_delta(id: str, since: str, to: Optional[str] = None):
             f"""The 'since' parameter must be less than or equal to the {"'to' parameter" if to_provided else 'latest project version'}""",
         )
 
+    # versions are immutable, so delta of the same range can be reused by all clients
+    cache: DeltaCache = current_app.delta_cache
+    cache_key = DeltaCache.key(project.id, since_version, to_version)
+    data = cache.get(cache_key)
+    if data is not None:
+        return current_app.response_class(data, 200, mimetype="application/json")
+
     try:
-        delta_changes = project.get_delta_changes(since_version, to_version) or []
+        delta_changes = project.get_delta_changes(since_version, to_version)
     except ValueError:
         logging.exception(
             f"Failed to get delta changes for project {project.id} between versions {since_version} and {to_version}"
@@ -462,16 +570,21 @@ def get_project_delta(id: str, since: str, to: Optional[str] = None):
         )
         abort(422)
 
-    return (
+    data = current_app.json.dumps(
         DeltaChangeRespSchema().dump(
-            {"to_version": f"v{to_version}", "items": delta_changes}
-        ),
-        200,
+            {"to_version": f"v{to_version}", "items": delta_changes or []}
+        )
     )
+    # do not keep result of failed delta computation
+    if delta_changes is not None or since_version == to_version:
+        cache.set(cache_key, data)
+    return current_app.response_class(data, 200, mimetype="application/json")
 
 
 @auth_required
-def list_workspace_projects(workspace_id, page, per_page, order_params=None, q=None):
+def list_workspace_projects(
+    workspace_id, page, per_page, order_params=None, q=None, cursor=None, count=True
+):
     """Paginate over workspace projects with optional filtering.
 
     :param workspace_id: ID of the workspace to list projects from
@@ -484,8 +597,12 @@ def list_workspace_projects(workspace_id, page, per_page, order_params=None, q=N
     :type order_params: str
     :param q: Filter by name with ilike pattern
     :type q: str
+    :param cursor: Cursor of requested page returned with previous page, page number is ignored if provided
+    :type cursor: str
+    :param count: Return total number of projects
+    :type count: bool
 
-    :rtype: Dict[str: List[Project], str: Integer, str: Integer, str: Integer]
+    :rtype: Dict[str: List[Project], str: Integer, str: Integer, str: Integer, str: str]
     """
     ws = current_app.ws_handler.get(workspace_id)
     if not (ws and ws.is_active):
@@ -514,12 +631,24 @@ def list_workspace_projects(workspace_id, page, per_page, order_params=None, q=N
         )
         projects = projects.order_by(*order_by_params)
 
-    pagination = projects.paginate(page=page, per_page=per_page)
-    result = pagination.items
-    total = pagination.total
+    try:
+        result, total, next_cursor = paginate_query(
+            projects, page, per_page, Project.id, cursor, count
+        )
+    except ValueError as e:
+        abort(400, str(e))
 
-    data = ProjectSchemaV2(many=True).dump(result)
-    return jsonify(projects=data, count=total, page=page, per_page=per_page), 200
+    data = dump_projects(result)
+    return (
+        jsonify(
+            projects=data,
+            count=total,
+            page=page,
+            per_page=per_page,
+            next_cursor=next_cursor,
+        ),
+        200,
+    )
 
 
 def list_batch_projects(body):
@@ -538,6 +667,7 @@ def list_batch_projects(body):
     projects = current_app.project_handler.get_projects_by_uuids(ids)
     by_id = {str(project.id): project for project in projects}
 
+    resolver = ProjectPermissionsResolver(current_user, projects)
     filtered_projects = []
     for uuid in ids:
         project = by_id.get(uuid)
@@ -548,12 +678,14 @@ def list_batch_projects(body):
             )
             continue
 
-        err = check_project_permissions(project, ProjectPermissions.Read)
+        err = check_project_permissions(project, ProjectPermissions.Read, resolver)
         if err is not None:
             filtered_projects.append(
                 BatchErrorSchema().dump({"id": uuid, "error": err})
             )
         else:
-            filtered_projects.append(ProjectSchemaV2().dump(project))
+            filtered_projects.append(
+                dump_projects([project], {"permissions_resolver": resolver})[0]
+            )
 
     return jsonify(projects=filtered_projects), 200
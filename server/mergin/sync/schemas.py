@@ -2,12 +2,14 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-MerginMaps-Commercial
 
-from marshmallow import fields, ValidationError, Schema, post_dump
+from typing import Dict, List
+
+from marshmallow import fields, ValidationError, Schema, post_dump, pre_dump
 from flask_login import current_user
 from flask import current_app
 
 from .files import ProjectFileSchema, FileSchema
-from .permissions import ProjectPermissions
+from .permissions import ProjectPermissions, ProjectPermissionsResolver
 from .models import (
     Project,
     ProjectVersion,
@@ -17,7 +19,7 @@ from .models import (
     ProjectRole,
 )
 from .workspace import WorkspaceRole
-from ..app import DateTimeWithZ, ma
+from ..app import DateTimeWithZ, datetime_with_z, ma
 from ..auth.models import User
 
 
@@ -49,26 +51,54 @@ class ProjectAccessSchema(ma.SQLAlchemyAutoSchema):
                 ).all()
             }
 
-        for field in ("owners", "writers", "editors", "readers"):
-            new_key = field + "names"
-            data[new_key] = []
-            users_ids = data[field]
-            for uid in users_ids:
-                if uid not in users_map:
-                    data[field].remove(uid)
-                    continue
-                username = users_map[uid]
-                data[new_key].append(username)
-        return data
+        return insert_access_usernames(data, users_map)
+
+
+ACCESS_ROLES = (
+    ("owners", ProjectRole.OWNER),
+    ("writers", ProjectRole.WRITER),
+    ("editors", ProjectRole.EDITOR),
+    ("readers", ProjectRole.READER),
+)
+
+
+# access levels (serialized fields) of project role
+ACCESS_FIELDS = {
+    role.value: [field for field, min_role in ACCESS_ROLES if role >= min_role]
+    for role in ProjectRole
+}
 
 
-def project_user_permissions(project):
+def insert_access_usernames(data: dict, users_map: Dict[int, str]) -> dict:
+    """Add usernames to user ids in access levels of serialized project access"""
+    for field, _ in ACCESS_ROLES:
+        new_key = field + "names"
+        data[new_key] = []
+        users_ids = data[field]
+        for uid in users_ids:
+            if uid not in users_map:
+                data[field].remove(uid)
+                continue
+            username = users_map[uid]
+            data[new_key].append(username)
+    return data
+
+
+def permissions_resolver(context: dict) -> ProjectPermissionsResolver:
+    """Resolver of current user permissions shared by schema fields, it can be passed in schema context"""
+    if "permissions_resolver" not in context:
+        context["permissions_resolver"] = ProjectPermissionsResolver(current_user)
+    return context["permissions_resolver"]
+
+
+def project_user_permissions(project, context=None):
+    resolver = permissions_resolver(context if context is not None else {})
     return {
         # This mapping (upload) is used by mobile and mergin client to check if it is possible to make push to server.
         # We can rename it in future upload -> Edit and add new Write key.
-        "upload": ProjectPermissions.Edit.check(project, current_user),
-        "update": ProjectPermissions.Update.check(project, current_user),
-        "delete": ProjectPermissions.Delete.check(project, current_user),
+        "upload": resolver.check(project, ProjectPermissions.Edit),
+        "update": resolver.check(project, ProjectPermissions.Update),
+        "delete": resolver.check(project, ProjectPermissions.Delete),
     }
 
 
@@ -125,7 +155,7 @@ class ProjectSchemaForVersion(ma.SQLAlchemyAutoSchema):
     role = fields.Method("_role")
 
     def _role(self, obj):
-        role = ProjectPermissions.get_user_project_role(obj.project, current_user)
+        role = permissions_resolver(self.context).get_role(obj.project)
         if not role:
             return None
         return role.value
@@ -134,7 +164,7 @@ class ProjectSchemaForVersion(ma.SQLAlchemyAutoSchema):
         return [u.transaction_id for u in obj.project.uploads.all()]
 
     def _permissions(self, obj):
-        return project_user_permissions(obj.project)
+        return project_user_permissions(obj.project, self.context)
 
     def _disk_usage(self, obj):
         return sum(f.size for f in obj.files)
@@ -172,8 +202,14 @@ class ProjectSchema(ma.SQLAlchemyAutoSchema):
     uploads = fields.Method("_uploads")
     role = fields.Method("_role")
 
+    @pre_dump(pass_many=True)
+    def resolve_permissions(self, data, many, **kwargs):
+        if self.dump_fields.keys() & {"permissions", "role"}:
+            permissions_resolver(self.context).load(data if many else [data])
+        return data
+
     def _role(self, obj):
-        role = ProjectPermissions.get_user_project_role(obj, current_user)
+        role = permissions_resolver(self.context).get_role(obj)
         if not role:
             return None
         return role.value
@@ -201,6 +237,12 @@ class ProjectListSchema(ma.SQLAlchemyAutoSchema):
     tags = fields.List(fields.Str())
     has_conflict = fields.Function(lambda obj: obj._has_conflict)
 
+    @pre_dump(pass_many=True)
+    def resolve_permissions(self, data, many, **kwargs):
+        if self.dump_fields.keys() & {"permissions", "role"}:
+            permissions_resolver(self.context).load(data if many else [data])
+        return data
+
     def get_access(self, obj):
         return ProjectAccessSchema(context=self.context).dump(obj)
 
@@ -221,6 +263,65 @@ class ProjectListSchema(ma.SQLAlchemyAutoSchema):
         return workspace_name
 
 
+def dump_project_list(projects: List[Project], context: dict = None) -> List[dict]:
+    """Serialize projects with the same output as ProjectListSchema(many=True, context=context).dump(projects).
+
+    Output is built directly from project attributes rather than dispatched field by field by marshmallow,
+    and lookups (workspace names, usernames, permissions) are done once for all projects.
+    """
+    context = context if context is not None else {}
+    resolver = permissions_resolver(context)
+    resolver.load(projects)
+
+    access = []
+    for project in projects:
+        item = {field: [] for field, _ in ACCESS_ROLES}
+        for member in project.project_users:
+            for field in ACCESS_FIELDS[member.role]:
+                item[field].append(member.user_id)
+        item["public"] = project.public
+        access.append(item)
+
+    users_map = context.get("users_map")
+    if users_map is None:
+        user_ids = {
+            uid for item in access for field, _ in ACCESS_ROLES for uid in item[field]
+        }
+        users_map = (
+            {
+                u.id: u.username
+                for u in User.query.filter(User.id.in_(user_ids), User.active).all()
+            }
+            if user_ids
+            else {}
+        )
+
+    workspaces_map = context.get("workspaces_map")
+    if workspaces_map is None:
+        ws_ids = {p.workspace_id for p in projects}
+        workspaces_map = {
+            w.id: w.name for w in current_app.ws_handler.get_by_ids(ws_ids)
+        }
+
+    return [
+        {
+            "id": str(project.id),
+            "name": project.name,
+            "namespace": workspaces_map.get(project.workspace_id, ""),
+            "access": insert_access_usernames(item, users_map),
+            "permissions": project_user_permissions(project, context),
+            "version": ProjectVersion.to_v_name(project.latest_version),
+            "updated": project.updated if project.updated else project.created,
+            "created": datetime_with_z(project.created),
+            "creator": project.creator_id,
+            "disk_usage": project.disk_usage,
+            "tags": list(project.tags) if project.tags is not None else None,
+            "has_conflict": project._has_conflict,
+        }
+        for project, item in zip(projects, access)
+    ]
+
+
 class ProjectVersionSchema(ma.SQLAlchemyAutoSchema):
     project_name = fields.Function(lambda obj: obj.project.name)
     namespace = fields.Function(lambda obj: obj.project.workspace.name)
@@ -405,5 +506,8 @@ class ProjectMemberSchema(Schema):
 class UploadChunkSchema(Schema):
     """Schema for chunk upload response"""
 
-    id = fields.UUID()
+    # either uuid or sha1 checksum of content addressed chunk
+    id = fields.String()
     valid_until = DateTimeWithZ()
+    # number of bytes stored so far for resumable upload
+    offset = fields.Integer()
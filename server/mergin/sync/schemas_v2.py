@@ -2,15 +2,17 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-MerginMaps-Commercial
 
-from marshmallow import fields
-from flask_login import current_user
+from typing import List
 
-from ..app import DateTimeWithZ, ma
-from .permissions import ProjectPermissions
+from flask import current_app
+from marshmallow import fields, pre_dump
+
+from ..app import DateTimeWithZ, datetime_with_z, ma
 from .models import (
     Project,
     ProjectVersion,
 )
+from .schemas import permissions_resolver
 
 
 class ProjectSchema(ma.SQLAlchemyAutoSchema):
@@ -28,8 +30,14 @@ class ProjectSchema(ma.SQLAlchemyAutoSchema):
     )
     role = fields.Method("_role")
 
+    @pre_dump(pass_many=True)
+    def resolve_permissions(self, data, many, **kwargs):
+        if self.dump_fields.keys() & {"permissions", "role"}:
+            permissions_resolver(self.context).load(data if many else [data])
+        return data
+
     def _role(self, obj):
-        role = ProjectPermissions.get_user_project_role(obj, current_user)
+        role = permissions_resolver(self.context).get_role(obj)
         return role.value if role else None
 
     class Meta:
@@ -48,6 +56,48 @@ class ProjectSchema(ma.SQLAlchemyAutoSchema):
         )
 
 
+def dump_projects(projects: List[Project], context: dict = None) -> List[dict]:
+    """Serialize projects with the same output as ProjectSchema(many=True, context=context).dump(projects)
+    without marshmallow dispatch of fields, see also dump_project_list.
+    """
+    context = context if context is not None else {}
+    resolver = permissions_resolver(context)
+    resolver.load(projects)
+    workspaces = {
+        ws.id: ws
+        for ws in current_app.ws_handler.get_by_ids({p.workspace_id for p in projects})
+    }
+    result = []
+    for project in projects:
+        role = resolver.get_role(project)
+        result.append(
+            {
+                "id": str(project.id),
+                "name": project.name,
+                "version": ProjectVersion.to_v_name(project.latest_version),
+                "public": project.public,
+                "size": project.disk_usage,
+                "created_at": datetime_with_z(project.created),
+                "updated_at": datetime_with_z(project.updated),
+                "workspace": {
+                    "id": workspaces[project.workspace_id].id,
+                    "name": workspaces[project.workspace_id].name,
+                },
+                "role": role.value if role else None,
+            }
+        )
+    return result
+
+
 class BatchErrorSchema(ma.Schema):
     id = fields.UUID(required=True)
     error = fields.Integer(required=True)
+
+
+class PushJobSchema(ma.Schema):
+    id = fields.UUID()
+    status = fields.String()
+    version = fields.Function(lambda obj: ProjectVersion.to_v_name(obj.version))
+    error = fields.Dict(allow_none=True)
+    created_at = DateTimeWithZ(attribute="created")
+    finished_at = DateTimeWithZ(attribute="finished", allow_none=True)
@@ -1,58 +1,177 @@
 # Copyright (C) Lutra Consulting Limited
 #
 # SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-MerginMaps-Commercial
+import fcntl
 import os
 import io
 import tempfile
 import time
 import uuid
 import logging
+import hashlib
+import magic
 from contextlib import contextmanager
+from typing import Tuple
 
 from flask import current_app
+from gevent.monkey import get_original
 from pygeodiff import GeoDiff, GeoDiffLibError
 from pygeodiff.geodifflib import GeoDiffLibConflictError
-from gevent import sleep
 from result import Err, Ok, Result
 
-from .storage import ProjectStorage, FileNotFound, InitializationError
+from .storage import (
+    ProjectStorage,
+    FileNotFound,
+    FileSizeLimitExceeded,
+    InitializationError,
+)
 from ...app import db
+from ..config import Configuration
 from ..utils import (
+    TimeSlicedYield,
     generate_checksum,
     is_versioned_file,
 )
-from ..files import mergin_secure_filename, ProjectFile, File
+from ..files import mergin_secure_filename, ProjectFile, File, UploadedFile
+
+# size of file header kept in memory to detect mimetype of assembled file. It is smaller than what recent
+# libmagic may inspect (bytes max is 7 MB), as a trade-off for memory, since file types are recognized by their header
+MIME_HEADER_SIZE = 1024 * 1024
+# ioctl request to clone file extents (copy-on-write), see linux/fs.h
+FICLONE = 0x40049409
+# seconds between attempts to get lock which is held by someone else
+LOCK_POLL_INTERVAL = 0.1
 
 
-def save_to_file(stream, path, max_size=None):
+def save_to_file(
+    stream, path, max_size=None, hasher=None, append=False, block_size=None
+):
     """Save readable object in file while yielding to gevent hub.
 
     :param stream: object implementing readable interface
     :param path: destination file path
-    :param max_size: limit for file size
+    :param max_size: limit for size of saved data
+    :param hasher: optional hashlib object updated with saved data
+    :param append: append data to existing file instead of overwriting it
+    :param block_size: size of blocks to read, defaults to IO_BLOCK_SIZE
+    :raises FileSizeLimitExceeded: if stream contains more data than max_size
     """
     directory = os.path.abspath(os.path.dirname(path))
     os.makedirs(directory, exist_ok=True)
-    with open(path, "wb") as output:
-        writer = io.BufferedWriter(output, buffer_size=32768)
+    block_size = block_size or Configuration.IO_BLOCK_SIZE
+    cooperative_yield = TimeSlicedYield()
+    with open(path, "ab" if append else "wb") as output:
         size = 0
         while True:
-            part = stream.read(4096)
-            sleep(0)  # to unblock greenlet
-            if part:
-                size += len(part)
-                if max_size and size > max_size:
-                    raise IOError()
-                writer.write(part)
-            else:
-                writer.flush()
+            part = stream.read(block_size)
+            cooperative_yield()  # to unblock greenlet
+            if not part:
                 break
+            size += len(part)
+            if max_size and size > max_size:
+                raise FileSizeLimitExceeded(f"Data exceed maximum size {max_size}")
+            output.write(part)
+            if hasher:
+                hasher.update(part)
+
+
+@contextmanager
+def exclusive_lock(path, wait=False, timeout=0):
+    """Hold exclusive advisory lock of (lock) file, the file is created if it does not exist.
+
+    Lock is not waited for by default, as it would block gevent hub, BlockingIOError is raised if it is held by someone else.
+    Waiting is only safe outside of gevent hub (e.g. in native thread or child process).
+    With timeout (in seconds) lock is polled with sleeps in between, which yield to gevent hub if it is monkey patched.
+    """
+    with open(path, "a") as lock_file:
+        if wait:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        else:
+            deadline = time.monotonic() + timeout
+            while True:
+                try:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() >= deadline:
+                        raise
+                    time.sleep(LOCK_POLL_INTERVAL)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def _reflink(fsrc, fdst) -> bool:
+    """Clone file extents of opened source file to destination (copy-on-write), if filesystem supports it"""
+    try:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        return True
+    except OSError:
+        return False
+
+
+def kernel_copy(src, dest) -> bool:
+    """Copy file without passing data through user space.
+
+    Tries to clone file (reflink on copy-on-write filesystems like btrfs or xfs),
+    then in-kernel copy by copy_file_range or sendfile. Returns False if none of them is supported,
+    in which case nothing was copied.
+
+    :params src: abs path to file
+    :type src: str, path-like object
+    :params dest: abs path to destination file
+    :type dest: str, path-like object
+    """
+    with open(src, "rb") as fsrc, open(dest, "wb") as fdst:
+        if _reflink(fsrc, fdst):
+            return True
+
+        size = os.fstat(fsrc.fileno()).st_size
+        block_size = Configuration.IO_BLOCK_SIZE
+        cooperative_yield = TimeSlicedYield()
+        methods = []
+        if hasattr(os, "copy_file_range"):
+            methods.append(
+                lambda offset: os.copy_file_range(
+                    fsrc.fileno(), fdst.fileno(), block_size, offset, offset
+                )
+            )
+        if hasattr(os, "sendfile"):
+            methods.append(
+                lambda offset: os.sendfile(
+                    fdst.fileno(), fsrc.fileno(), offset, block_size
+                )
+            )
+
+        for method in methods:
+            offset = 0
+            try:
+                while offset < size:
+                    copied = method(offset)
+                    if not copied:
+                        break
+                    offset += copied
+                    cooperative_yield()  # to unblock greenlet
+            except OSError:
+                # not supported for these files (e.g. across filesystems), try another method
+                if offset == 0:
+                    continue
+                raise
+            if offset == size:
+                return True
+            # some filesystems silently do not support in-kernel copy
+            if offset == 0:
+                continue
+            # file was truncated in the meantime
+            raise IOError(f"Unexpected end of file {src}")
+    return False
 
 
 def copy_file(src, dest):
-    """Custom implementation of copying file by chunk with yielding to gevent hub.
+    """Custom implementation of copying file by blocks with yielding to gevent hub.
 
-    see save_to_file
+    Kernel copy offload is used if enabled and supported, otherwise see save_to_file.
 
     :params src: abs path to file
     :type src: str, path-like object
@@ -63,10 +182,90 @@ def copy_file(src, dest):
         raise FileNotFoundError(src)
     directory = os.path.abspath(os.path.dirname(dest))
     os.makedirs(directory, exist_ok=True)
+    if Configuration.IO_COPY_OFFLOAD and kernel_copy(src, dest):
+        return
     with open(src, "rb") as input:
         save_to_file(input, dest)
 
 
+def clone_file(src, dest, strategies=None) -> str:
+    """Copy immutable file (e.g. project file in version folder) in the cheapest possible way.
+
+    Strategies are tried in given order and regular copy is used as a fallback:
+    reflink - copy-on-write clone sharing data blocks with source (e.g. btrfs, xfs)
+    hardlink - another name for the same data, only safe for files which are never modified in place
+
+    :params src: abs path to file
+    :type src: str, path-like object
+    :params dest: abs path to destination file
+    :type dest: str, path-like object
+    :params strategies: list of strategies, defaults to CLONE_COPY_STRATEGIES
+    :return: name of used strategy
+    """
+    if not os.path.isfile(src):
+        raise FileNotFoundError(src)
+    directory = os.path.abspath(os.path.dirname(dest))
+    os.makedirs(directory, exist_ok=True)
+    if strategies is None:
+        strategies = Configuration.CLONE_COPY_STRATEGIES
+    for strategy in strategies:
+        if strategy == "reflink":
+            with open(src, "rb") as fsrc, open(dest, "wb") as fdst:
+                if _reflink(fsrc, fdst):
+                    return strategy
+        elif strategy == "hardlink":
+            try:
+                if os.path.lexists(dest):
+                    os.remove(dest)
+                os.link(src, dest)
+                return strategy
+            except OSError:
+                # e.g. across filesystems or link limit reached
+                pass
+    copy_file(src, dest)
+    return "copy"
+
+
+def assemble_chunks(chunks, path, block_size=None) -> UploadedFile:
+    """Concatenate chunk files into a single file in one pass over data while yielding to gevent hub.
+
+    Checksum, size and mimetype (sniffed from file header) are collected on the way,
+    hence there is no need to read the assembled file again.
+
+    :param chunks: list of paths to chunk files, in order
+    :param path: destination file path
+    :param block_size: size of read/write buffer, defaults to IO_BLOCK_SIZE
+    :return: metadata of assembled file
+    """
+    directory = os.path.abspath(os.path.dirname(path))
+    os.makedirs(directory, exist_ok=True)
+    checksum = hashlib.sha1()
+    size = 0
+    header = b""
+    buffer = bytearray(block_size or Configuration.IO_BLOCK_SIZE)
+    view = memoryview(buffer)
+    cooperative_yield = TimeSlicedYield()
+    with open(path, "wb") as dest:
+        for chunk in chunks:
+            with open(chunk, "rb") as src:
+                while True:
+                    length = src.readinto(buffer)
+                    cooperative_yield()  # to unblock greenlet
+                    if not length:
+                        break
+                    data = view[:length]
+                    dest.write(data)
+                    checksum.update(data)
+                    if len(header) < MIME_HEADER_SIZE:
+                        header += bytes(data[: MIME_HEADER_SIZE - len(header)])
+                    size += length
+    return UploadedFile(
+        checksum=checksum.hexdigest(),
+        size=size,
+        mime_type=magic.from_buffer(header, mime=True),
+    )
+
+
 def copy_dir(src, dest):
     """Custom implementation of recursive copy of directory with yielding to gevent hub.
 
@@ -129,8 +328,6 @@ class DiskStorage(ProjectStorage):
         super(DiskStorage, self).__init__(project)
         self.projects_dir = current_app.config["LOCAL_PROJECTS"]
         self.project_dir = self._project_dir()
-        self.geodiff = GeoDiff()
-        self.gediff_log = io.StringIO()
         self.geodiff_working_dir = os.path.abspath(
             os.path.join(
                 current_app.config["GEODIFF_WORKING_DIR"],
@@ -139,17 +336,37 @@ class DiskStorage(ProjectStorage):
             )
         )
         self.diffs_dir = os.path.join(self.project_dir, "diffs")
+        # geodiff context and its logger are not shared between native threads (e.g. when processing push in parallel)
+        self._local = get_original("threading", "local")()
+
+    def _init_geodiff(self):
+        """Create geodiff instance with its own logger for current thread"""
+        self._local.geodiff = GeoDiff()
+        self._local.log = io.StringIO()
+        log = self._local.log
 
         def _logger_callback(level, text_bytes):
             text = text_bytes.decode()
             if level == GeoDiff.LevelError:
-                self.gediff_log.write(f"GEODIFF ERROR: {text} \n")
+                log.write(f"GEODIFF ERROR: {text} \n")
             elif level == GeoDiff.LevelWarning:
-                self.gediff_log.write(f"GEODIFF WARNING: {text} \n")
+                log.write(f"GEODIFF WARNING: {text} \n")
             else:
-                self.gediff_log.write(f"GEODIFF INFO: {text} \n")
+                log.write(f"GEODIFF INFO: {text} \n")
+
+        self._local.geodiff.set_logger_callback(_logger_callback)
+
+    @property
+    def geodiff(self) -> GeoDiff:
+        if not hasattr(self._local, "geodiff"):
+            self._init_geodiff()
+        return self._local.geodiff
 
-        self.geodiff.set_logger_callback(_logger_callback)
+    @property
+    def gediff_log(self) -> io.StringIO:
+        if not hasattr(self._local, "log"):
+            self._init_geodiff()
+        return self._local.log
 
     @contextmanager
     def geodiff_copy(self, file):
@@ -212,7 +429,8 @@ class DiskStorage(ProjectStorage):
                 if not os.path.isfile(src):
                     self.restore_versioned_file(file, template_project.latest_version)
                 try:
-                    copy_file(src, dest)
+                    # files in version folders are never modified, so data can be shared
+                    clone_file(src, dest)
                 except (FileNotFoundError, IOError):
                     self.delete()
                     raise InitializationError(
@@ -234,18 +452,20 @@ class DiskStorage(ProjectStorage):
             raise FileNotFound("File {} not found.".format(file))
         return path
 
-    def read_file(self, path, block_size=4096):
+    def read_file(self, path, block_size=None):
         file_path = os.path.join(self.project_dir, path)
+        block_size = block_size or Configuration.IO_BLOCK_SIZE
 
         # do input validation outside generator to execute immediately
         if not os.path.exists(file_path):
             raise FileNotFound("File {} not found.".format(path))
 
         def _generator():
+            cooperative_yield = TimeSlicedYield()
             with open(file_path, "rb") as f:
                 while True:
                     data = f.read(block_size)
-                    sleep(0)
+                    cooperative_yield()
                     if data:
                         yield data
                     else:
@@ -259,9 +479,53 @@ class DiskStorage(ProjectStorage):
         """Apply geodiff diff file on current gpkg basefile. Creates GeodiffActionHistory record of the action.
         Returns checksum and size of generated file. If action fails it returns geodiff error message.
         """
-        from ..models import GeodiffActionHistory, ProjectVersion
+        if Configuration.GEODIFF_IN_PLACE:
+            try:
+                return self._apply_diff_in_place(current_file, diff_file, patched_file)
+            except OSError as e:
+                logging.warning(
+                    f"Apply changes in place failed, using geodiff working dir: {str(e)}"
+                )
+        return self._apply_diff_in_working_dir(current_file, diff_file, patched_file)
+
+    def _apply_diff_in_place(
+        self, current_file: ProjectFile, diff_file: str, patched_file: str
+    ) -> Result:
+        """Apply diff on clone of basefile created next to patched file which is then atomically moved in place."""
+        basefile = os.path.join(self.project_dir, current_file.location)
+        patchedfile_tmp = patched_file + "_tmp"
+        logging.info(f"Apply changes: cloning {basefile} to {patchedfile_tmp}")
+        start = time.time()
+        try:
+            clone_file(basefile, patchedfile_tmp, strategies=["reflink"])
+            copy_time = time.time() - start
+            logging.info(f"Cloning finished in {copy_time} s")
+            self.flush_geodiff_logger()
+            logging.info(
+                f"Geodiff: apply changeset {diff_file} of size {os.path.getsize(diff_file)} with changes to {patched_file}"
+            )
+            start = time.time()
+            self.geodiff.apply_changeset(patchedfile_tmp, diff_file)
+            geodiff_apply_time = time.time() - start
+            logging.info(f"Changeset applied in {geodiff_apply_time} s")
+            os.replace(patchedfile_tmp, patched_file)
+        except (GeoDiffLibError, GeoDiffLibConflictError):
+            move_to_tmp(diff_file)
+            return Err(self.gediff_log.getvalue())
+        finally:
+            if os.path.exists(patchedfile_tmp):
+                os.remove(patchedfile_tmp)
+
+        return Ok(
+            self._patched_file_info(
+                current_file, diff_file, patched_file, copy_time, geodiff_apply_time
+            )
+        )
 
-        v_name = ProjectVersion.to_v_name(self.project.next_version())
+    def _apply_diff_in_working_dir(
+        self, current_file: ProjectFile, diff_file: str, patched_file: str
+    ) -> Result:
+        """Apply diff on copy of basefile in geodiff working dir which is then copied to patched file."""
         basefile = os.path.join(self.project_dir, current_file.location)
         # create local copy of basefile which will be updated in next version and changeset needed
         # TODO this can potentially fail for large files
@@ -281,44 +545,55 @@ class DiskStorage(ProjectStorage):
                 start = time.time()
                 self.geodiff.apply_changeset(patchedfile_tmp, changeset_tmp)
                 geodiff_apply_time = time.time() - start
-                # track performance of geodiff action
-                base_version = current_file.location.split("/")[0]
-                gh = GeodiffActionHistory(
-                    self.project.id,
-                    base_version,
-                    current_file.path,
-                    current_file.size,
-                    v_name,
-                    "apply_changes",
-                    diff_file,
-                )
-                gh.copy_time = copy_time
-                gh.geodiff_time = geodiff_apply_time
                 logging.info(f"Changeset applied in {geodiff_apply_time} s")
                 # move constructed file where is belongs
                 logging.info(f"Apply changes: moving patchfile {patchedfile_tmp}")
                 start = time.time()
                 copy_file(patchedfile_tmp, patched_file)
-                gh.copy_time = copy_time + (time.time() - start)
-
-                # TODO this can potentially fail for large files
-                logging.info(f"Apply changes: calculating checksum of {patched_file}")
-                start = time.time()
-                checksum = generate_checksum(patchedfile_tmp)
-                checksumming_time = time.time() - start
-                gh.checksum_time = checksumming_time
-                logging.info(f"Checksum calculated in {checksumming_time} s")
-                db.session.add(gh)
-                return Ok(
-                    (
-                        checksum,
-                        os.path.getsize(patchedfile_tmp),
-                    )
-                )
+                copy_time += time.time() - start
             except (GeoDiffLibError, GeoDiffLibConflictError):
                 move_to_tmp(diff_file)
                 return Err(self.gediff_log.getvalue())
 
+        return Ok(
+            self._patched_file_info(
+                current_file, diff_file, patched_file, copy_time, geodiff_apply_time
+            )
+        )
+
+    def _patched_file_info(
+        self,
+        current_file: ProjectFile,
+        diff_file: str,
+        patched_file: str,
+        copy_time: float,
+        geodiff_time: float,
+    ) -> Tuple[str, int]:
+        """Calculate checksum and size of patched file and track performance of geodiff action."""
+        from ..models import GeodiffActionHistory, ProjectVersion
+
+        # TODO this can potentially fail for large files
+        logging.info(f"Apply changes: calculating checksum of {patched_file}")
+        start = time.time()
+        checksum = generate_checksum(patched_file)
+        checksumming_time = time.time() - start
+        logging.info(f"Checksum calculated in {checksumming_time} s")
+        base_version = current_file.location.split("/")[0]
+        gh = GeodiffActionHistory(
+            self.project.id,
+            base_version,
+            current_file.path,
+            current_file.size,
+            ProjectVersion.to_v_name(self.project.next_version()),
+            "apply_changes",
+            diff_file,
+        )
+        gh.copy_time = copy_time
+        gh.geodiff_time = geodiff_time
+        gh.checksum_time = checksumming_time
+        db.session.add(gh)
+        return checksum, os.path.getsize(patched_file)
+
     def construct_diff(
         self,
         current_file: ProjectFile,
@@ -328,6 +603,54 @@ class DiskStorage(ProjectStorage):
         """Construct geodiff diff file from uploaded gpkg and current basefile. Returns diff metadata as a result.
         If action fails it returns geodiff error message.
         """
+        if Configuration.GEODIFF_IN_PLACE:
+            try:
+                return self._construct_diff_in_place(
+                    current_file, diff_file, uploaded_file
+                )
+            except OSError as e:
+                logging.warning(
+                    f"Construct diff in place failed, using geodiff working dir: {str(e)}"
+                )
+        return self._construct_diff_in_working_dir(
+            current_file, diff_file, uploaded_file
+        )
+
+    def _construct_diff_in_place(
+        self,
+        current_file: ProjectFile,
+        diff_file: str,
+        uploaded_file: str,
+    ) -> Result:
+        """Construct diff from uploaded file and clone of basefile, both next to diff file.
+        Diff file is atomically moved in place once created.
+        """
+        basefile = os.path.join(self.project_dir, current_file.location)
+        basefile_tmp = diff_file + "_base"
+        changeset_tmp = diff_file + "_tmp"
+        try:
+            clone_file(basefile, basefile_tmp, strategies=["reflink"])
+            self.flush_geodiff_logger()
+            logging.info(f"Geodiff: create changeset {diff_file} from {uploaded_file}")
+            self.geodiff.create_changeset(basefile_tmp, uploaded_file, changeset_tmp)
+            os.replace(changeset_tmp, diff_file)
+        except (GeoDiffLibError, GeoDiffLibConflictError):
+            # diff is not possible to create - file will be overwritten
+            move_to_tmp(diff_file)
+            return Err(self.gediff_log.getvalue())
+        finally:
+            for file in (basefile_tmp, changeset_tmp):
+                if os.path.exists(file):
+                    os.remove(file)
+        return Ok((generate_checksum(diff_file), os.path.getsize(diff_file)))
+
+    def _construct_diff_in_working_dir(
+        self,
+        current_file: ProjectFile,
+        diff_file: str,
+        uploaded_file: str,
+    ) -> Result:
+        """Construct diff from copies of uploaded file and basefile in geodiff working dir"""
         basefile = os.path.join(self.project_dir, current_file.location)
         diff_name = os.path.basename(diff_file)
         with self.geodiff_copy(basefile) as basefile_tmp, self.geodiff_copy(
@@ -15,6 +15,12 @@ class InitializationError(Exception):
     pass
 
 
+class FileSizeLimitExceeded(IOError):
+    """Saved data exceed expected maximum size"""
+
+    pass
+
+
 class StorageFile(object):
     def __init__(self, storage, file):
         self.storage = storage
@@ -10,11 +10,32 @@ from datetime import datetime, timedelta, timezone
 from typing import List, Optional
 from zipfile import ZIP_DEFLATED, ZipFile
 from flask import current_app
+from result import Err
+from sqlalchemy import and_, or_
+from sqlalchemy.exc import IntegrityError
 
-from .models import Project, ProjectVersion, FileHistory
+from .errors import UploadError
+from .models import (
+    FileDiff,
+    Project,
+    ProjectFilePath,
+    ProjectVersion,
+    ProjectVersionDelta,
+    FileHistory,
+    PushJob,
+    PushJobStatus,
+    Upload,
+    construct_diff_checkpoints,
+)
 from .storages.disk import move_to_tmp
 from .config import Configuration
-from .utils import get_chunk_location, remove_outdated_files
+from .utils import (
+    WORKSPACES_CHUNKS_DIR,
+    Checkpoint,
+    get_chunk_location,
+    is_content_addressed_chunk,
+    remove_outdated_files,
+)
 from ..celery import celery
 from ..app import db
 
@@ -169,21 +190,176 @@ def remove_projects_archives():
 @celery.task
 def remove_unused_chunks():
     """Remove old chunks in shared directory. These are basically just residual from failed uploads."""
-    small_hash_dirs = os.listdir(Configuration.UPLOAD_CHUNKS_DIR)
     time_delta = timedelta(seconds=Configuration.UPLOAD_CHUNKS_EXPIRATION)
-    for _dir in small_hash_dirs:
-        dir = os.path.join(Configuration.UPLOAD_CHUNKS_DIR, _dir)
+    chunks_dirs = [Configuration.UPLOAD_CHUNKS_DIR]
+    # content addressed chunks have the same layout within directory of each workspace
+    workspaces_dir = os.path.join(
+        Configuration.UPLOAD_CHUNKS_DIR, WORKSPACES_CHUNKS_DIR
+    )
+    if os.path.isdir(workspaces_dir):
+        chunks_dirs.extend(
+            os.path.join(workspaces_dir, ws_dir)
+            for ws_dir in os.listdir(workspaces_dir)
+        )
+    for chunks_dir in chunks_dirs:
+        if not os.path.isdir(chunks_dir):
+            continue
+        for _dir in os.listdir(chunks_dir):
+            dir = os.path.join(chunks_dir, _dir)
+            if not os.path.isdir(dir):
+                continue
+            remove_outdated_files(dir, time_delta)
+
+
+@celery.task
+def remove_unused_checksums():
+    """Remove checksum cache entries which have not been used recently, e.g. for files which were modified or removed."""
+    if not Configuration.CHECKSUM_CACHE_DIR or not os.path.isdir(
+        Configuration.CHECKSUM_CACHE_DIR
+    ):
+        return
+    time_delta = timedelta(days=Configuration.CHECKSUM_CACHE_EXPIRATION)
+    for _dir in os.listdir(Configuration.CHECKSUM_CACHE_DIR):
+        dir = os.path.join(Configuration.CHECKSUM_CACHE_DIR, _dir)
         if not os.path.isdir(dir):
             continue
         remove_outdated_files(dir, time_delta)
 
 
+@celery.task
+def remove_push_jobs():
+    """Remove asynchronous push jobs which finished (or got lost in queue) long ago, their result is not polled anymore"""
+    expiration = datetime.utcnow() - timedelta(days=Configuration.PUSH_JOB_EXPIRATION)
+    PushJob.query.filter(
+        or_(
+            PushJob.finished < expiration,
+            and_(PushJob.finished.is_(None), PushJob.created < expiration),
+        )
+    ).delete(synchronize_session=False)
+    db.session.commit()
+
+
 @celery.task
 def remove_transaction_chunks(chunks: Optional[List[str]] = None):
-    """Remove chunks related to a specific sync transaction"""
+    """Remove chunks related to a specific sync transaction.
+    Content addressed chunks can be shared with other uploads, those are left to expire.
+    """
     if not chunks:
         return
     for chunk in chunks:
+        if is_content_addressed_chunk(chunk):
+            continue
         chunk_path = get_chunk_location(chunk)
         if os.path.exists(chunk_path):
             os.remove(chunk_path)
+
+
+@celery.task
+def finish_project_version(
+    job_id: str, ip: str, user_agent: str = None, device_id: str = None
+):
+    """Process uploaded data and create project version for push finished asynchronously"""
+    job = PushJob.query.get(job_id)
+    if not job or job.status != PushJobStatus.PENDING.value:
+        return
+
+    upload = Upload.query.filter_by(transaction_id=job_id).first()
+    if not upload:
+        # upload expired while task was waiting in queue and it was taken over by another push
+        job.finish(
+            UploadError(error="Push artefact removed by subsequent push").to_dict()
+        )
+        db.session.commit()
+        return
+
+    # claim upload again as task could wait in queue for a while
+    upload.last_ping = datetime.utcnow()
+    db.session.commit()
+    try:
+        result = upload.finish(job.user_id, ip, user_agent, device_id)
+    except Exception as e:
+        db.session.rollback()
+        logging.exception(f"Failed to finish push job {job_id}: {str(e)}")
+        upload.clear()
+        result = Err((UploadError(), 422))
+
+    if result.ok():
+        job.finish()
+        db.session.commit()
+    else:
+        error, _ = result.value
+        job.finish(error.to_dict())
+        job.project.sync_failed(
+            user_agent, "project_push", job.error["detail"], job.user_id
+        )
+
+
+@celery.task
+def create_checkpoints(project_id: str, version: int):
+    """Create delta checkpoints completed by project version, so pulls find them cached rather than build them.
+
+    Merged diff files of versioned files in these checkpoints are constructed as well if configured.
+    """
+    db.session.info["msg"] = "create_checkpoints"
+    project = (
+        Project.query.filter_by(id=project_id)
+        .filter(Project.storage_params.isnot(None))
+        .first()
+    )
+    if not project or project.latest_version < version:
+        return
+
+    checkpoints = Checkpoint.completed_by(version)
+    existing = {
+        d.rank
+        for d in ProjectVersionDelta.query.filter_by(
+            project_id=project.id, version=version
+        ).filter(ProjectVersionDelta.rank > 0)
+    }
+    for checkpoint in checkpoints:
+        if checkpoint.rank in existing:
+            continue
+        try:
+            delta = ProjectVersionDelta.create_checkpoint(project.id, checkpoint)
+        except IntegrityError:
+            # checkpoint created meanwhile by pull, lower rank ones would be there too
+            db.session.rollback()
+            continue
+        if not delta:
+            logging.error(
+                f"Failed to create {checkpoint} for project {project.id} after push"
+            )
+            return
+
+    if not current_app.config["EAGER_CHECKPOINT_DIFFS"]:
+        return
+
+    diffs = (
+        FileDiff.query.join(ProjectFilePath)
+        .filter(
+            ProjectFilePath.project_id == project.id,
+            FileDiff.version == version,
+            FileDiff.rank > 0,
+        )
+        .order_by(FileDiff.rank)
+        .all()
+    )
+    # plan merged diffs of all files first, so independent merges can be run concurrently
+    steps = []
+    for diff in diffs:
+        if os.path.exists(diff.abs_path):
+            continue
+        plan = diff.checkpoint_plan()
+        planned = plan.prepare([diff]) if plan else None
+        if planned is None:
+            logging.error(
+                f"Failed to construct merged diff {diff.path} of rank {diff.rank} for project {project.id}"
+            )
+            continue
+        steps.extend(planned)
+
+    if not construct_diff_checkpoints(
+        steps, workers=current_app.config["CHECKPOINT_WORKERS"]
+    ):
+        logging.error(f"Failed to construct merged diffs for project {project.id}")
+    db.session.commit()
@@ -5,11 +5,14 @@
 from __future__ import annotations
 import logging
 import math
+import mmap
 import os
 import hashlib
 import re
 import secrets
+import time
 from binaryornot.check import is_binary
+from concurrent.futures import Executor, ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
 from threading import Timer
@@ -17,7 +20,9 @@ from urllib.parse import quote
 from uuid import UUID
 from shapely import wkb
 from shapely.errors import ShapelyError
-from gevent import sleep
+from gevent import get_hub, sleep
+from gevent.monkey import is_module_patched
+from gevent.threadpool import ThreadPoolExecutor as NativeThreadPoolExecutor
 from flask import Request, Response, make_response, send_from_directory
 from typing import List, Optional
 from flask import Request
@@ -37,24 +42,119 @@ from .config import Configuration
 
 # log base for caching strategy, diff checkpoints, etc.
 LOG_BASE = 4
+# subdirectory of UPLOAD_CHUNKS_DIR with content addressed chunks of workspaces
+WORKSPACES_CHUNKS_DIR = "workspaces"
 
 
-def generate_checksum(file, chunk_size=4096):
+class TimeSlicedYield:
+    """Yield to gevent hub once given time slice has passed since the last yield.
+
+    Used in I/O loops to let other greenlets run without paying for context switch on every block.
+    """
+
+    def __init__(self, interval: Optional[int] = None):
+        """:param interval: time slice in milliseconds, defaults to IO_YIELD_INTERVAL"""
+        interval = Configuration.IO_YIELD_INTERVAL if interval is None else interval
+        self.interval = interval / 1000
+        self.last_yield = time.monotonic()
+
+    def __call__(self):
+        now = time.monotonic()
+        if now - self.last_yield >= self.interval:
+            sleep(0)
+            self.last_yield = time.monotonic()
+
+
+def thread_pool_executor(workers: int) -> Executor:
+    """Pool of native threads for blocking calls (e.g. geodiff or file I/O).
+
+    With gevent monkey patching, threads of standard executor are greenlets of a single OS thread,
+    hence blocking calls would run one after another and block the hub. Use pool of native threads instead.
+    """
+    if is_module_patched("threading"):
+        return NativeThreadPoolExecutor(max_workers=workers)
+    return ThreadPoolExecutor(max_workers=workers)
+
+
+def _sha1_file(file: str, chunk_size: int, cooperative_yield=None) -> str:
+    """Calculate sha1 of file using memory mapped read, file is hashed in slices of chunk_size."""
+    checksum = hashlib.sha1()
+    with open(file, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return checksum.hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            with memoryview(mm) as view:
+                for offset in range(0, len(view), chunk_size):
+                    checksum.update(view[offset : offset + chunk_size])
+                    if cooperative_yield:
+                        cooperative_yield()
+    return checksum.hexdigest()
+
+
+def checksum_cache_location(stat: os.stat_result) -> Optional[str]:
+    """Get location of cached checksum for file with given stat result, None if cache is disabled.
+
+    Entry is keyed by (device, inode, mtime, size) so any modification of file invalidates it.
+    """
+    if not Configuration.CHECKSUM_CACHE_DIR:
+        return None
+    key = hashlib.sha1(
+        f"{stat.st_dev}:{stat.st_ino}:{stat.st_mtime_ns}:{stat.st_size}".encode()
+    ).hexdigest()
+    return os.path.join(Configuration.CHECKSUM_CACHE_DIR, key[0:2], key[2:])
+
+
+def _read_cached_checksum(path: str) -> Optional[str]:
+    try:
+        with open(path, "r") as f:
+            checksum = f.read()
+    except OSError:
+        return None
+    if not re.fullmatch(r"[0-9a-f]{40}", checksum):
+        return None
+    touch_file(path)  # keep used entries from expiration
+    return checksum
+
+
+def _write_cached_checksum(path: str, checksum: str) -> None:
+    tmp_path = f"{path}.{secrets.token_hex(4)}"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, "w") as f:
+            f.write(checksum)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logging.warning(f"Unable to cache checksum in {path}: {str(e)}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def generate_checksum(file, chunk_size=None):
     """
     Generate checksum for file from chunks.
 
+    File is read memory mapped, hashing runs in native thread pool when running under gevent
+    so other greenlets are not blocked. Result is optionally cached in CHECKSUM_CACHE_DIR.
+
     :param file: file to calculate checksum
-    :param chunk_size: size of chunk
+    :param chunk_size: size of chunk, defaults to IO_BLOCK_SIZE
     :return: sha1 checksum
     """
-    checksum = hashlib.sha1()
-    with open(file, "rb") as f:
-        while True:
-            chunk = f.read(chunk_size)
-            sleep(0)  # to unblock greenlet
-            if not chunk:
-                return checksum.hexdigest()
-            checksum.update(chunk)
+    chunk_size = chunk_size or Configuration.IO_BLOCK_SIZE
+    cache_path = checksum_cache_location(os.stat(file))
+    if cache_path:
+        checksum = _read_cached_checksum(cache_path)
+        if checksum:
+            return checksum
+
+    if Configuration.CHECKSUM_THREADPOOL and is_module_patched("threading"):
+        checksum = get_hub().threadpool.apply(_sha1_file, (file, chunk_size))
+    else:
+        checksum = _sha1_file(file, chunk_size, TimeSlicedYield())
+
+    if cache_path:
+        _write_cached_checksum(cache_path, checksum)
+    return checksum
 
 
 def is_qgis(path: str) -> bool:
@@ -269,10 +369,6 @@ def files_size():
     files_size = text(
         f"""
         WITH partials AS (
-            WITH latest_files AS (
-                SELECT distinct unnest(file_history_ids) AS file_id
-                FROM latest_project_files pf
-            )
             SELECT
                 SUM(size)
             FROM file_history
@@ -284,9 +380,8 @@ def files_size():
             UNION
             SELECT
                 SUM(size)
-            FROM latest_files lf
-            LEFT OUTER JOIN file_history fh ON fh.id = lf.file_id
-            WHERE fh.change = 'update_diff'::push_change_type
+            FROM current_project_file
+            WHERE diff_path IS NOT NULL
         )
         SELECT COALESCE(SUM(sum), 0) FROM partials;
         """
@@ -488,11 +583,14 @@ FORBIDDEN_MIME_TYPES = {
 }
 
 
-def is_supported_type(filepath) -> bool:
-    """Check whether the file mimetype is supported."""
+def is_supported_type(filepath, mime_type: Optional[str] = None) -> bool:
+    """Check whether the file mimetype is supported.
+
+    Mimetype is detected from file header unless it is already known (e.g. sniffed during upload).
+    """
     if check_skip_validation(filepath):
         return True
-    mime_type = get_mimetype(filepath)
+    mime_type = mime_type or get_mimetype(filepath)
     return mime_type.startswith("image/") or mime_type not in FORBIDDEN_MIME_TYPES
 
 
@@ -612,20 +710,53 @@ class Checkpoint:
 
         return levels
 
+    @classmethod
+    def completed_by(cls, version: int) -> List[Checkpoint]:
+        """Checkpoints of higher ranks (> 0) which end with given version, ordered by rank"""
+        levels = []
+        rank = 1
+        while version > 0 and version % LOG_BASE**rank == 0:
+            levels.append(cls(rank=rank, index=version // LOG_BASE**rank))
+            rank += 1
+        return levels
 
-def get_chunk_location(id: str):
+
+def get_chunk_location(id: str, workspace_id: Optional[int] = None):
     """
     Get file location for chunk on FS
 
     Splits the given identifier into two parts where the first two characters of the identifier are the small hash,
     and the remaining characters is a file identifier.
+
+    Content addressed chunks are stored separately for each workspace, so that their existence can not be probed
+    (and their content referenced in push) from other workspaces.
     """
     chunk_dir = current_app.config.get("UPLOAD_CHUNKS_DIR")
+    if is_content_addressed_chunk(id):
+        if workspace_id is None:
+            raise ValueError("Workspace is required for content addressed chunk")
+        chunk_dir = os.path.join(chunk_dir, WORKSPACES_CHUNKS_DIR, str(workspace_id))
     small_hash = id[:2]
     file_name = id[2:]
     return os.path.join(chunk_dir, small_hash, file_name)
 
 
+def is_content_addressed_chunk(id: str) -> bool:
+    """Check whether chunk id is sha1 checksum of its content (rather than random uuid).
+    Such chunks can be shared by several uploads.
+    """
+    return bool(re.fullmatch(r"[0-9a-f]{40}", id))
+
+
+def touch_file(path: str) -> bool:
+    """Update file access and modification times to postpone its expiration, returns False if file does not exist"""
+    try:
+        os.utime(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
 def remove_outdated_files(dir: str, time_delta: timedelta):
     """Remove all files within directory where last access time passed expiration date"""
     for file in os.listdir(dir):
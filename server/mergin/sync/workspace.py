@@ -2,6 +2,7 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-MerginMaps-Commercial
 
+import time
 from datetime import datetime, timedelta, timezone
 from typing import Dict, Tuple, Optional, Set, List
 from flask_login import current_user
@@ -29,7 +30,7 @@ class GlobalWorkspace(AbstractWorkspace):
 
     def __init__(self):
         self.name = Configuration.GLOBAL_WORKSPACE
-        self.storage = Configuration.GLOBAL_STORAGE
+        self._storage = None
         self.id = 1
 
     @property
@@ -50,6 +51,9 @@ class GlobalWorkspace(AbstractWorkspace):
 
     @property
     def storage(self):
+        # workspace object can be cached, storage limit follows configuration unless it is set explicitly
+        if self._storage is None:
+            return Configuration.GLOBAL_STORAGE
         return self._storage
 
     @storage.setter
@@ -265,6 +269,8 @@ class GlobalWorkspaceHandler(WorkspaceHandler):
             if isinstance(order_attr, Column):
                 order_attr = order_attr.desc() if descending else order_attr.asc()
                 projects = projects.order_by(order_attr)
+        # projects with equal sort keys (or not sorted at all) are listed in order of creation
+        projects = projects.order_by(Project.created.asc())
         return projects
 
     @staticmethod
@@ -391,3 +397,72 @@ class GlobalWorkspaceHandler(WorkspaceHandler):
     def sso_connections_count() -> int:
         """Number of SSO connections for the server"""
         return 0
+
+
+class CachedWorkspaceHandler:
+    """Wrapper of global workspace handler which caches workspaces looked up by id or name for limited time.
+
+    Cache is shared by whole process, hence only GlobalWorkspaceHandler can be wrapped as its workspaces
+    are built from configuration, they are not bound to db session and they are not modified at runtime.
+    Other methods are passed to the wrapped handler.
+    """
+
+    def __init__(self, handler: GlobalWorkspaceHandler, ttl: int):
+        if not isinstance(handler, GlobalWorkspaceHandler):
+            raise TypeError("Only global workspace handler can be cached")
+        self.handler = handler
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # cache entries are tuples (expiration, workspace)
+        self._by_id = {}
+        self._by_name = {}
+
+    def __getattr__(self, name):
+        return getattr(self.handler, name)
+
+    def _get_cached(self, cache: Dict, key):
+        entry = cache.get(key)
+        if entry and entry[0] > time.monotonic():
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+
+    def _set_cached(self, workspace) -> None:
+        entry = (time.monotonic() + self.ttl, workspace)
+        self._by_id[workspace.id] = entry
+        self._by_name[workspace.name] = entry
+
+    def get(self, id_):
+        workspace = self._get_cached(self._by_id, id_)
+        if workspace:
+            return workspace
+        workspace = self.handler.get(id_)
+        if workspace:
+            self._set_cached(workspace)
+        return workspace
+
+    def get_by_name(self, name):
+        workspace = self._get_cached(self._by_name, name)
+        if workspace:
+            return workspace
+        workspace = self.handler.get_by_name(name)
+        if workspace:
+            self._set_cached(workspace)
+            self._by_name[name] = self._by_id[workspace.id]
+        return workspace
+
+    def get_by_ids(self, ids):
+        workspaces = {}
+        missing = []
+        for id_ in dict.fromkeys(ids):
+            workspace = self._get_cached(self._by_id, id_)
+            if workspace:
+                workspaces[id_] = workspace
+            else:
+                missing.append(id_)
+        if missing:
+            for workspace in self.handler.get_by_ids(missing):
+                self._set_cached(workspace)
+                workspaces[workspace.id] = workspace
+        return list(workspaces.values())
@@ -0,0 +1,19 @@
+# Copyright (C) Lutra Consulting Limited
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-MerginMaps-Commercial
+
+"""Micro-benchmarks for performance sensitive code paths, not collected by pytest.
+
+Run them as modules, e.g. python -m mergin.tests.benchmarks.bench_disk_io
+"""
+
+import time
+from contextlib import contextmanager
+
+
+@contextmanager
+def timer(results: dict, name: str):
+    """Measure wall time of the block and store it in results under given name"""
+    start = time.perf_counter()
+    yield
+    results[name] = time.perf_counter() - start
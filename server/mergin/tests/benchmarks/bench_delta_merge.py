@@ -0,0 +1,84 @@
+# Copyright (C) Lutra Consulting Limited
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-MerginMaps-Commercial
+
+"""Merge of delta changes as done for pull of long version range, changes json is loaded by DeltaChangeSchema
+and merged as dataclasses, compared to direct decoding into delta records and their merge.
+
+Changes are generated in memory as chunks of changes json (one per version), so database is not involved.
+"""
+
+import argparse
+import random
+
+from . import timer
+from ...sync.delta import decode_changes, merge_records
+from ...sync.files import DeltaChangeSchema
+from ...sync.models import ProjectVersionDelta
+
+
+def build_changes(count: int, files: int, per_version: int = 10) -> list:
+    """Changes json of versions with count changes in total of a given number of files"""
+    rnd = random.Random(count)
+    chunks = []
+    version = 0
+    while count > 0:
+        version += 1
+        chunk = []
+        for i in rnd.sample(range(files), min(files, per_version, count)):
+            versioned = i % 2
+            path = f"data/file_{i}.gpkg" if versioned else f"data/file_{i}.txt"
+            change = rnd.choice(
+                ["create", "update", "delete", "update_diff"]
+                if versioned
+                else ["create", "update", "delete"]
+            )
+            item = {
+                "path": path,
+                "size": rnd.randint(1, 10**6),
+                "checksum": f"{rnd.getrandbits(160):040x}",
+                "change": change,
+                "version": version,
+            }
+            if change == "update_diff":
+                item["diff"] = f"{path}-diff-{version}"
+            chunk.append(item)
+        count -= len(chunk)
+        chunks.append(chunk)
+    return chunks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--changes",
+        type=int,
+        nargs="+",
+        default=[1000, 10000, 100000],
+        help="number of changes to merge",
+    )
+    args = parser.parse_args()
+
+    print("changes    schema + dataclasses    records")
+    for count in args.changes:
+        chunks = build_changes(count, max(10, count // 100))
+        results = {}
+        with timer(results, "schema"):
+            items = []
+            for chunk in chunks:
+                items.extend(DeltaChangeSchema(many=True).load(chunk))
+            merged = ProjectVersionDelta.merge_changes(items)
+        with timer(results, "records"):
+            records = []
+            for chunk in chunks:
+                records.extend(decode_changes(chunk))
+            merged_records = merge_records(records)
+
+        assert [r.to_merged() for r in merged_records] == merged
+        print(
+            f"{count:<10} {results['schema'] * 1000:17.2f} ms {results['records'] * 1000:8.2f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+# Copyright (C) Lutra Consulting Limited
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-MerginMaps-Commercial
+
+"""Throughput of file copy and checksum helpers, compared to the former implementation
+with 4 KB blocks and yield to gevent hub on every block.
+"""
+
+import argparse
+import hashlib
+import io
+import os
+import tempfile
+from unittest.mock import patch
+
+from gevent import sleep
+
+from . import timer
+from ...sync.config import Configuration
+from ...sync.storages.disk import copy_file
+from ...sync.utils import generate_checksum
+
+
+def legacy_copy_file(src, dest):
+    """Former copy_file implementation"""
+    with open(src, "rb") as stream, open(dest, "wb") as output:
+        writer = io.BufferedWriter(output, buffer_size=32768)
+        while True:
+            part = stream.read(4096)
+            sleep(0)
+            if not part:
+                writer.flush()
+                break
+            writer.write(part)
+
+
+def legacy_generate_checksum(file):
+    """Former generate_checksum implementation"""
+    checksum = hashlib.sha1()
+    with open(file, "rb") as f:
+        while True:
+            chunk = f.read(4096)
+            sleep(0)
+            if not chunk:
+                return checksum.hexdigest()
+            checksum.update(chunk)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size", type=int, default=256, help="file size in MB")
+    parser.add_argument("--dir", default=tempfile.gettempdir(), help="working dir")
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp_dir:
+        src = os.path.join(tmp_dir, "src.bin")
+        with open(src, "wb") as f:
+            for _ in range(args.size):
+                f.write(os.urandom(1024 * 1024))
+
+        with timer(results, "copy (4 KB blocks, yield per block)"):
+            legacy_copy_file(src, os.path.join(tmp_dir, "legacy.bin"))
+        with patch.object(Configuration, "IO_COPY_OFFLOAD", False):
+            with timer(results, "copy (large blocks, time sliced yield)"):
+                copy_file(src, os.path.join(tmp_dir, "streamed.bin"))
+        with timer(results, "copy (kernel offload)"):
+            copy_file(src, os.path.join(tmp_dir, "offload.bin"))
+        with timer(results, "checksum (4 KB blocks, yield per block)"):
+            legacy_generate_checksum(src)
+        with timer(results, "checksum (large blocks, time sliced yield)"):
+            generate_checksum(src)
+
+    for name, duration in results.items():
+        print(f"{name:<45} {args.size / duration:10.1f} MB/s")
+
+
+if __name__ == "__main__":
+    main()
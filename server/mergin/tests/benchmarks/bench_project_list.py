@@ -0,0 +1,105 @@
+# Copyright (C) Lutra Consulting Limited
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-MerginMaps-Commercial
+
+"""Serialization of project listings by marshmallow schemas, compared to the fast path serializers
+dump_project_list and dump_projects.
+
+Projects and their members are built in memory with all lookups (usernames, workspace names, permissions)
+passed in context, so only the serialization itself is measured.
+"""
+
+import argparse
+import uuid
+from datetime import datetime, timedelta
+
+from flask_login import AnonymousUserMixin
+
+from . import timer
+from ...app import create_app
+from ...auth.models import User
+from ...sync.models import Project, ProjectRole, ProjectUser
+from ...sync.permissions import ProjectPermissionsResolver
+from ...sync.schemas import ProjectListSchema, dump_project_list
+from ...sync.schemas_v2 import ProjectSchema as ProjectSchemaV2, dump_projects
+from ...sync.workspace import GlobalWorkspace
+
+
+def build_projects(count: int, members: int) -> list:
+    """In-memory projects with members in all roles"""
+    workspace = GlobalWorkspace()
+    creator = User("creator", "creator@example.com")
+    creator.id = 1
+    roles = list(ProjectRole)
+    created = datetime(2024, 1, 1)
+    projects = []
+    for i in range(count):
+        project = Project(
+            f"project_{i}", {"type": "local"}, creator, workspace, public=True
+        )
+        project.id = uuid.uuid4()
+        project.creator_id = creator.id
+        project.created = created + timedelta(minutes=i)
+        project.updated = project.created + timedelta(days=1)
+        project.latest_version = i
+        project.disk_usage = i * 1024
+        project.tags = ["valid_qgis", "input_use"]
+        project.project_users = [
+            ProjectUser(user_id=j + 1, role=roles[j % len(roles)].value)
+            for j in range(members)
+        ]
+        project.__dict__["_has_conflict"] = False
+        projects.append(project)
+    return projects
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--projects", type=int, default=100, help="projects per page")
+    parser.add_argument("--members", type=int, default=10, help="members per project")
+    parser.add_argument("--repeat", type=int, default=20, help="dumps of the page")
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.test_request_context():
+        projects = build_projects(args.projects, args.members)
+        users_map = {j + 1: f"user_{j}" for j in range(args.members)}
+        workspaces_map = {p.workspace_id: "workspace" for p in projects}
+
+        def context():
+            return {
+                "users_map": users_map,
+                "workspaces_map": workspaces_map,
+                "permissions_resolver": ProjectPermissionsResolver(
+                    AnonymousUserMixin()
+                ),
+            }
+
+        assert dump_project_list(projects, context()) == ProjectListSchema(
+            many=True, context=context()
+        ).dump(projects)
+        assert dump_projects(projects, context()) == ProjectSchemaV2(
+            many=True, context=context()
+        ).dump(projects)
+
+        results = {}
+        with timer(results, "ProjectListSchema"):
+            for _ in range(args.repeat):
+                ProjectListSchema(many=True, context=context()).dump(projects)
+        with timer(results, "dump_project_list"):
+            for _ in range(args.repeat):
+                dump_project_list(projects, context())
+        with timer(results, "ProjectSchema (v2)"):
+            for _ in range(args.repeat):
+                ProjectSchemaV2(many=True, context=context()).dump(projects)
+        with timer(results, "dump_projects (v2)"):
+            for _ in range(args.repeat):
+                dump_projects(projects, context())
+
+    print(f"{args.projects} projects with {args.members} members, time per dump")
+    for name, duration in results.items():
+        print(f"{name:<30} {duration * 1000 / args.repeat:10.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+# Copyright (C) Lutra Consulting Limited
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-MerginMaps-Commercial
+
+"""Consistency and quota checks of push request for large projects, compared to the former implementation
+scanning list of project files for every changed file.
+
+Project files are in memory here, former implementation also evaluated project.files (SQL query)
+for every added file which is not included.
+"""
+
+import argparse
+
+from . import timer
+from ...sync.files import ProjectFile, changes_size_delta, index_files
+
+
+def legacy_checks(changes: dict, files: list) -> int:
+    """Former checks done in project_push"""
+    for item in changes["added"]:
+        if not all(ele.path != item["path"] for ele in files):
+            raise ValueError(f"File {item['path']} has been already uploaded")
+
+    updated_files = list(
+        filter(
+            lambda i: i.path in [f["path"] for f in changes["updated"]],
+            files,
+        )
+    )
+    return (
+        sum(file["size"] for file in changes["added"] + changes["updated"])
+        - sum(file.size for file in updated_files)
+        - sum(file["size"] for file in changes["removed"])
+    )
+
+
+def indexed_checks(changes: dict, files: list) -> int:
+    """Current checks done in project_push"""
+    project_files = index_files(files)
+    for item in changes["added"]:
+        if item["path"] in project_files:
+            raise ValueError(f"File {item['path']} has been already uploaded")
+    return changes_size_delta(changes, project_files)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=20000, help="project files")
+    parser.add_argument("--changes", type=int, default=500, help="files per change")
+    args = parser.parse_args()
+
+    files = [
+        ProjectFile(
+            path=f"data/file_{i}.txt",
+            checksum="0" * 40,
+            size=i,
+            diff=None,
+            mtime=None,
+            location=f"v1/data/file_{i}.txt",
+        )
+        for i in range(args.files)
+    ]
+    changes = {
+        "added": [
+            {"path": f"new/file_{i}.txt", "size": 1} for i in range(args.changes)
+        ],
+        "updated": [
+            {"path": f"data/file_{i}.txt", "size": 1} for i in range(args.changes)
+        ],
+        "removed": [
+            {"path": f"data/file_{args.files - i - 1}.txt", "size": 1}
+            for i in range(args.changes)
+        ],
+    }
+
+    results = {}
+    with timer(results, "list scan per changed file"):
+        expected = legacy_checks(changes, files)
+    with timer(results, "path index"):
+        assert indexed_checks(changes, files) == expected
+
+    print(f"{args.files} project files, {args.changes} added/updated/removed files")
+    for name, duration in results.items():
+        print(f"{name:<30} {duration * 1000:10.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
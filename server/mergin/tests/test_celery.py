@@ -2,6 +2,7 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-MerginMaps-Commercial
 
+import hashlib
 import math
 import os
 import uuid
@@ -18,6 +19,8 @@ from ..sync.models import (
     AccessRequest,
     ProjectRole,
     ProjectVersion,
+    ProjectVersionDelta,
+    push_finished,
 )
 from ..celery import send_email_async
 from ..sync.config import Configuration as SyncConfiguration
@@ -27,10 +30,17 @@ from ..sync.tasks import (
     create_project_version_zip,
     remove_projects_archives,
     remove_unused_chunks,
+    remove_unused_checksums,
+    create_checkpoints,
 )
 from ..sync.storages.disk import move_to_tmp
 from . import test_project, test_workspace_name, test_workspace_id
-from ..sync.utils import get_chunk_location
+from ..sync.utils import (
+    Checkpoint,
+    checksum_cache_location,
+    generate_checksum,
+    get_chunk_location,
+)
 from . import (
     test_project,
     test_workspace_name,
@@ -41,6 +51,7 @@ from . import (
 from .utils import (
     CHUNK_SIZE,
     add_user,
+    create_blank_version,
     create_workspace,
     create_project,
     login,
@@ -225,6 +236,15 @@ def test_remove_chunks(app):
             with open(chunk_location, "wb") as out_file:
                 out_file.write(in_file.read(CHUNK_SIZE))
             chunks.append(chunk_location)
+    # content addressed chunk stored in workspace directory
+    data = b"content addressed chunk"
+    chunk_location = get_chunk_location(
+        hashlib.sha1(data).hexdigest(), test_workspace_id
+    )
+    os.makedirs(os.path.dirname(chunk_location), exist_ok=True)
+    with open(chunk_location, "wb") as out_file:
+        out_file.write(data)
+    chunks.append(chunk_location)
 
     remove_unused_chunks()
     assert all(os.path.exists(chunk) for chunk in chunks)
@@ -239,3 +259,89 @@ def test_remove_chunks(app):
     with patch("os.path.getatime", _atime_mock):
         remove_unused_chunks()
         assert not any(os.path.exists(chunk) for chunk in chunks)
+
+
+def test_remove_unused_checksums(tmp_path):
+    """Test cleanup of outdated checksum cache entries"""
+    src_file = os.path.join(test_project_dir, "base.gpkg")
+    with patch.object(SyncConfiguration, "CHECKSUM_CACHE_DIR", str(tmp_path)):
+        generate_checksum(src_file)
+        cache_file = checksum_cache_location(os.stat(src_file))
+        assert os.path.exists(cache_file)
+        remove_unused_checksums()
+        assert os.path.exists(cache_file)
+
+        def _atime_mock(path: str) -> float:
+            """Mock file stats to be already expired"""
+            return (
+                datetime.now(timezone.utc)
+                - timedelta(days=SyncConfiguration.CHECKSUM_CACHE_EXPIRATION)
+            ).timestamp() - 1
+
+        with patch("os.path.getatime", _atime_mock):
+            remove_unused_checksums()
+            assert not os.path.exists(cache_file)
+
+
+def test_create_checkpoints(client):
+    """Test delta checkpoints are created in background after push"""
+    assert Checkpoint.completed_by(3) == []
+    assert Checkpoint.completed_by(32) == [Checkpoint(1, 8), Checkpoint(2, 2)]
+
+    user = User.query.filter_by(username="mergin").first()
+    project = create_project("checkpoints", create_workspace(), user)
+    for _ in range(15):
+        create_blank_version(project)
+
+    with patch("mergin.sync.tasks.create_checkpoints.delay") as task_mock:
+        push_finished.send(
+            ProjectVersion.query.filter_by(project_id=project.id, name=15).first()
+        )
+        task_mock.assert_not_called()
+        create_blank_version(project)
+        pv = project.get_latest_version()
+        push_finished.send(pv)
+        task_mock.assert_called_once_with(str(project.id), 16)
+        task_mock.reset_mock()
+        with patch.dict(current_app.config, {"EAGER_CHECKPOINTS": False}):
+            push_finished.send(pv)
+            task_mock.assert_not_called()
+
+    create_checkpoints(str(project.id), 16)
+    deltas = (
+        ProjectVersionDelta.query.filter_by(project_id=project.id)
+        .filter(ProjectVersionDelta.rank > 0)
+        .all()
+    )
+    assert sorted((d.rank, d.version) for d in deltas) == [
+        (1, 4),
+        (1, 8),
+        (1, 12),
+        (1, 16),
+        (2, 16),
+    ]
+    # pull finds all checkpoints in place
+    with patch.object(ProjectVersionDelta, "create_checkpoint") as checkpoint_mock:
+        assert project.get_delta_changes(0, 16) == []
+        checkpoint_mock.assert_not_called()
+    # already existing checkpoints are skipped
+    create_checkpoints(str(project.id), 16)
+    assert (
+        ProjectVersionDelta.query.filter_by(project_id=project.id)
+        .filter(ProjectVersionDelta.rank > 0)
+        .count()
+        == 5
+    )
+    # merged diffs are constructed only if configured
+    with patch(
+        "mergin.sync.tasks.construct_diff_checkpoints"
+    ) as construct_mock, patch.dict(
+        current_app.config, {"EAGER_CHECKPOINT_DIFFS": False}
+    ):
+        create_checkpoints(str(project.id), 16)
+        construct_mock.assert_not_called()
+        current_app.config["EAGER_CHECKPOINT_DIFFS"] = True
+        create_checkpoints(str(project.id), 16)
+        construct_mock.assert_called_once_with(
+            [], workers=current_app.config["CHECKPOINT_WORKERS"]
+        )
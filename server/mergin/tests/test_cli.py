@@ -613,3 +613,34 @@ def test_create_checkpoint(runner, project_name, since, to, output, diff_project
         assert checkpoints > 0
     else:
         assert checkpoints == 0
+
+
+def test_check_stats(runner, diff_project):
+    """Test 'project check-stats' command"""
+    project_name = f"{test_workspace_name}/{test_project}"
+    disk_usage = sum(f.size for f in diff_project.files)
+    assert diff_project.disk_usage == disk_usage
+    assert diff_project.qgis_files_count == 1
+    assert diff_project.tags == ["valid_qgis", "input_use"]
+    result = runner.invoke(args=["project", "check-stats", project_name])
+    assert result.exit_code == 0
+    assert "Project stats are consistent" in result.output
+
+    diff_project.disk_usage = 0
+    diff_project.qgis_files_count = None
+    db.session.commit()
+    result = runner.invoke(args=["project", "check-stats"])
+    assert result.exit_code == 1
+    assert "Found 1 inconsistent project(s)" in result.output
+    assert f"disk usage 0 (expected {disk_usage})" in result.output
+
+    result = runner.invoke(args=["project", "check-stats", project_name, "--fix"])
+    assert result.exit_code == 0
+    assert "Fixed 1 project(s)" in result.output
+    project = Project.query.get(diff_project.id)
+    assert project.disk_usage == disk_usage
+    assert project.qgis_files_count == 1
+
+    result = runner.invoke(args=["project", "check-stats", "foo/bar"])
+    assert result.exit_code == 1
+    assert "ERROR: Workspace does not exist" in result.output
@@ -14,7 +14,7 @@ from ..sync.models import (
     RequestStatus,
     FileHistory,
     ProjectFilePath,
-    LatestProjectFiles,
+    CurrentProjectFile,
     ProjectRole,
     ProjectUser,
 )
@@ -154,12 +154,7 @@ def test_remove_project(client, diff_project):
     assert (
         Project.query.filter_by(id=project_id).first().creator_id == original_creator_id
     )
-    assert (
-        LatestProjectFiles.query.filter_by(project_id=project_id)
-        .first()
-        .file_history_ids
-        == []
-    )
+    assert CurrentProjectFile.query.filter_by(project_id=project_id).count() == 0
 
     # try to remove the deleted project
     assert diff_project.delete() is None
@@ -4,14 +4,30 @@
 
 import errno
 import logging
+import magic
 import os
 import tempfile
+import threading
+import time
 import shutil
 import pytest
 from unittest.mock import patch
-from ..sync.storages.disk import copy_file, copy_dir, move_to_tmp
-from ..sync.utils import generate_checksum
-from . import test_project_dir
+from pygeodiff import GeoDiff, GeoDiffLibError
+from ..sync.checkpoints import CheckpointExecutor, DiffMerge, merge_diffs
+from ..sync.config import Configuration
+from ..sync.storages.disk import (
+    assemble_chunks,
+    clone_file,
+    copy_file,
+    copy_dir,
+    exclusive_lock,
+    kernel_copy,
+    move_to_tmp,
+    DiskStorage,
+)
+from ..sync.models import Project
+from ..sync.utils import generate_checksum, get_mimetype
+from . import test_project, test_project_dir, test_workspace_id
 
 
 def test_copy_remove_file(app):
@@ -107,3 +123,238 @@ def test_move_to_tmp_full_disk_on_fallback(app, tmp_path, caplog):
     assert result is None
     assert "Failed to move" in caplog.text
     assert str(src) in caplog.text
+
+
+def test_assemble_chunks(tmp_path):
+    """Chunks are concatenated in single pass with metadata of resulting file"""
+    src = os.path.join(test_project_dir, "logo.jpeg")
+    with open(src, "rb") as f:
+        data = f.read()
+    # split file into uneven chunks smaller than the read buffer
+    chunks = []
+    for i in range(0, len(data), 1000):
+        chunk = tmp_path / f"chunk_{i}"
+        chunk.write_bytes(data[i : i + 1000])
+        chunks.append(str(chunk))
+
+    dest = str(tmp_path / "files" / "logo.jpeg")
+    uploaded = assemble_chunks(chunks, dest, block_size=256)
+    assert uploaded.size == len(data) == os.path.getsize(dest)
+    assert uploaded.checksum == generate_checksum(src) == generate_checksum(dest)
+    assert uploaded.mime_type == get_mimetype(src) == "image/jpeg"
+
+    # mimetype detected from limited header matches detection from the whole file
+    for root, _, files in os.walk(test_project_dir):
+        for file in files:
+            src = os.path.join(root, file)
+            # libmagic reports empty file as inode rather than application type
+            if not os.path.getsize(src):
+                continue
+            uploaded = assemble_chunks([src], str(tmp_path / "files" / file))
+            assert uploaded.mime_type == magic.from_file(src, mime=True), file
+
+    # empty file without any chunks
+    uploaded = assemble_chunks([], str(tmp_path / "empty.txt"))
+    assert uploaded.size == 0
+    assert os.path.exists(tmp_path / "empty.txt")
+
+    with pytest.raises(FileNotFoundError):
+        assemble_chunks([str(tmp_path / "missing")], str(tmp_path / "missing.txt"))
+
+
+def test_copy_file_offload(tmp_path):
+    """Kernel copy falls back to other methods if not supported"""
+    src = os.path.join(test_project_dir, "base.gpkg")
+    checksum = generate_checksum(src)
+    not_supported = OSError(errno.EOPNOTSUPP, "Operation not supported")
+
+    dest = str(tmp_path / "copy.gpkg")
+    assert kernel_copy(src, dest)
+    assert generate_checksum(dest) == checksum
+
+    with patch("mergin.sync.storages.disk.fcntl.ioctl", side_effect=not_supported):
+        with patch(
+            "mergin.sync.storages.disk.os.copy_file_range", side_effect=not_supported
+        ):
+            dest = str(tmp_path / "sendfile.gpkg")
+            assert kernel_copy(src, dest)
+            assert generate_checksum(dest) == checksum
+
+            with patch(
+                "mergin.sync.storages.disk.os.sendfile", side_effect=not_supported
+            ):
+                dest = str(tmp_path / "fallback.gpkg")
+                assert not kernel_copy(src, dest)
+                # streamed copy is used instead
+                copy_file(src, dest)
+                assert generate_checksum(dest) == checksum
+
+    with patch.object(Configuration, "IO_COPY_OFFLOAD", False), patch(
+        "mergin.sync.storages.disk.kernel_copy"
+    ) as mock_copy:
+        dest = str(tmp_path / "streamed.gpkg")
+        copy_file(src, dest)
+        assert not mock_copy.called
+        assert generate_checksum(dest) == checksum
+
+
+def test_clone_file(tmp_path):
+    """Immutable files are cloned by the cheapest available strategy"""
+    src = str(tmp_path / "src.gpkg")
+    copy_file(os.path.join(test_project_dir, "base.gpkg"), src)
+    checksum = generate_checksum(src)
+
+    dest = str(tmp_path / "v1" / "hardlink.gpkg")
+    assert clone_file(src, dest, ["hardlink"]) == "hardlink"
+    assert os.path.samefile(src, dest)
+
+    # reflink is not supported by every filesystem, then it falls back to the next strategy
+    dest = str(tmp_path / "v1" / "reflink.gpkg")
+    with patch(
+        "mergin.sync.storages.disk.fcntl.ioctl",
+        side_effect=OSError(errno.EOPNOTSUPP, "Operation not supported"),
+    ):
+        assert clone_file(src, dest, ["reflink", "hardlink"]) == "hardlink"
+    assert os.path.samefile(src, dest)
+
+    with patch(
+        "mergin.sync.storages.disk.os.link",
+        side_effect=OSError(errno.EXDEV, "Invalid cross-device link"),
+    ):
+        dest = str(tmp_path / "v1" / "copy.gpkg")
+        assert clone_file(src, dest, ["hardlink"]) == "copy"
+        assert not os.path.samefile(src, dest)
+        assert generate_checksum(dest) == checksum
+
+    with pytest.raises(FileNotFoundError):
+        clone_file(str(tmp_path / "missing.gpkg"), dest)
+
+
+def test_apply_diff_in_place(app, tmp_path):
+    """Test diffs are applied and constructed in upload dir without copies in geodiff working dir"""
+    project = Project.query.filter_by(
+        workspace_id=test_workspace_id, name=test_project
+    ).first()
+    current_file = next(f for f in project.files if f.path == "base.gpkg")
+    modified_file = os.path.join(test_project_dir, "inserted_1_A.gpkg")
+    diff_file = str(tmp_path / "base.gpkg-diff")
+    project.storage.geodiff.create_changeset(
+        os.path.join(project.storage.project_dir, current_file.location),
+        modified_file,
+        diff_file,
+    )
+
+    patched_file = str(tmp_path / "base.gpkg")
+    with patch.object(
+        DiskStorage, "geodiff_copy", side_effect=OSError("Mocked: unused")
+    ) as mock_copy:
+        result = project.storage.apply_diff(current_file, diff_file, patched_file)
+        assert result.ok()
+        assert result.value == (
+            generate_checksum(patched_file),
+            os.path.getsize(patched_file),
+        )
+        assert set(os.listdir(tmp_path)) == {"base.gpkg", "base.gpkg-diff"}
+
+        changeset = str(tmp_path / "v2" / "base.gpkg-diff-new")
+        result = project.storage.construct_diff(current_file, changeset, modified_file)
+        assert result.ok()
+        assert result.value == (
+            generate_checksum(changeset),
+            os.path.getsize(changeset),
+        )
+        assert os.listdir(tmp_path / "v2") == ["base.gpkg-diff-new"]
+        assert not mock_copy.called
+
+    # fallback to geodiff working dir if file cannot be cloned next to target
+    os.remove(patched_file)
+    with patch(
+        "mergin.sync.storages.disk.clone_file", side_effect=OSError("Mocked")
+    ), patch.object(
+        DiskStorage, "geodiff_copy", wraps=project.storage.geodiff_copy
+    ) as mock_copy:
+        result = project.storage.apply_diff(current_file, diff_file, patched_file)
+        assert result.ok()
+        assert result.value[0] == generate_checksum(patched_file)
+        assert mock_copy.call_count == 2
+        assert not os.path.exists(project.storage.geodiff_working_dir)
+
+
+def test_checkpoint_executor(tmp_path):
+    """Test independent diffs merges are run in pool of processes and locked checkpoints are not rebuilt"""
+    geodiff = GeoDiff()
+    base = os.path.join(test_project_dir, "base.gpkg")
+    diffs = []
+    for i, modified in enumerate(["inserted_1_A.gpkg", "modified_1_geom.gpkg"]):
+        diffs.append(str(tmp_path / f"diff-{i}"))
+        geodiff.create_changeset(
+            base if i == 0 else os.path.join(test_project_dir, "inserted_1_A.gpkg"),
+            os.path.join(test_project_dir, modified),
+            diffs[-1],
+        )
+    merged_diff = str(tmp_path / "merged-diff")
+    geodiff.concat_changes(diffs, merged_diff)
+
+    merges = [
+        DiffMerge(diffs, str(tmp_path / "diffs" / "checkpoint-1")),
+        DiffMerge(diffs[:1], str(tmp_path / "diffs" / "checkpoint-2")),
+    ]
+    with CheckpointExecutor(2) as executor:
+        results = executor.run(merges, GeoDiff)
+    assert [r.error for r in results] == [None, None]
+    assert [r.sources_count for r in results] == [2, 1]
+    assert results[0].size == os.path.getsize(merged_diff)
+    assert results[0].checksum == generate_checksum(merged_diff)
+    # single diff is just copied
+    assert results[1].checksum == generate_checksum(diffs[0])
+    assert all(r.duration > 0 for r in results)
+    # locks are released and removed
+    assert sorted(os.listdir(tmp_path / "diffs")) == ["checkpoint-1", "checkpoint-2"]
+
+    # checkpoint which is already built is not merged again
+    with patch.object(geodiff, "concat_changes") as concat_mock:
+        with CheckpointExecutor() as executor:
+            results = executor.run(merges[:1], lambda: geodiff)
+        assert results[0].checksum == generate_checksum(merged_diff)
+        assert not concat_mock.called
+
+    # checkpoint being constructed by other worker for too long
+    merge = DiffMerge(diffs, str(tmp_path / "diffs" / "checkpoint-3"))
+    with exclusive_lock(f"{merge.output}.lock"), patch(
+        "mergin.sync.checkpoints.LOCK_TIMEOUT", 0
+    ):
+        result = merge_diffs(merge, geodiff)
+    assert result.error and not result.size
+    assert not os.path.exists(merge.output)
+
+    # checkpoint constructed by other worker meanwhile, lock is polled until it is released
+    def other_worker(locked):
+        with exclusive_lock(f"{merge.output}.lock"):
+            locked.set()
+            time.sleep(0.3)
+            shutil.copy(merged_diff, merge.output)
+            os.remove(f"{merge.output}.lock")
+
+    locked = threading.Event()
+    worker = threading.Thread(target=other_worker, args=(locked,))
+    worker.start()
+    locked.wait()
+    with patch.object(geodiff, "concat_changes") as concat_mock:
+        result = merge_diffs(merge, geodiff)
+    worker.join()
+    assert not concat_mock.called
+    assert not result.error
+    assert result.checksum == generate_checksum(merged_diff)
+
+    # geodiff failure, partially written checkpoint is not left behind
+    def failing_concat(sources, output):
+        with open(output, "w") as f:
+            f.write("partial")
+        raise GeoDiffLibError("failure")
+
+    merge = DiffMerge(diffs, str(tmp_path / "diffs" / "checkpoint-4"))
+    with patch.object(geodiff, "concat_changes", side_effect=failing_concat):
+        result = merge_diffs(merge, geodiff)
+    assert result.error.startswith("Geodiff")
+    assert not os.path.exists(merge.output)
+    assert not any(f.startswith("checkpoint-4") for f in os.listdir(tmp_path / "diffs"))
@@ -13,6 +13,7 @@ from ..sync.permissions import (
     require_project,
     check_project_permissions,
     ProjectPermissions,
+    ProjectPermissionsResolver,
 )
 from ..sync.models import Project, ProjectRole
 from ..auth.models import User
@@ -174,3 +175,95 @@ def test_check_project_permissions(client):
         client.get("/")
         assert check_project_permissions(priv_proj, ProjectPermissions.Read) == 404
         assert check_project_permissions(pub_proj, ProjectPermissions.Read) is None
+
+
+def test_project_permissions_resolver(client):
+    """Test resolver gives the same results as permission checks of individual projects"""
+    owner = add_user("owner", "pwd")
+    user = add_user("user", "pwd")
+    admin = User.query.filter_by(username=DEFAULT_USER[0]).first()
+    test_workspace = create_workspace()
+    projects = []
+    for role in (ProjectRole.OWNER, ProjectRole.WRITER, ProjectRole.READER, None):
+        project = create_project(
+            f"resolver_{role.value if role else 'none'}", test_workspace, owner
+        )
+        if role:
+            project.set_role(user.id, role)
+        projects.append(project)
+    projects[-1].public = True
+    removed = create_project("resolver_removed", test_workspace, owner)
+    removed.set_role(user.id, ProjectRole.OWNER)
+    removed.removed_at = datetime.datetime.utcnow()
+    projects.append(removed)
+    db.session.commit()
+
+    permissions = [
+        ProjectPermissions.Read,
+        ProjectPermissions.Edit,
+        ProjectPermissions.Upload,
+        ProjectPermissions.Update,
+        ProjectPermissions.Delete,
+        ProjectPermissions.All,
+    ]
+    for global_read, global_write in ((False, False), (True, False), (True, True)):
+        with patch.object(Configuration, "GLOBAL_READ", global_read), patch.object(
+            Configuration, "GLOBAL_WRITE", global_write
+        ), patch.object(Configuration, "GLOBAL_ADMIN", False):
+            for u in (owner, user, admin, AnonymousUserMixin()):
+                resolver = ProjectPermissionsResolver(u, projects)
+                for project in projects:
+                    for permission in permissions:
+                        assert resolver.check(project, permission) == permission.check(
+                            project, u
+                        )
+
+    # direct project roles are loaded for all projects at once
+    db.session.expire_all()
+    projects = Project.query.filter(Project.name.like("resolver_%")).all()
+    with patch.object(
+        ProjectPermissionsResolver, "_resolve", return_value=None
+    ) as resolve_mock:
+        ProjectPermissionsResolver(user, projects)
+    roles = {c.args[0].name: c.args[1] for c in resolve_mock.call_args_list}
+    assert roles["resolver_writer"] == ProjectRole.WRITER
+    assert roles["resolver_none"] is None
+
+
+def test_read_projects_query(client):
+    """Test query of projects accessible to user"""
+    owner = add_user("owner", "pwd")
+    user = add_user("user", "pwd")
+    test_workspace = create_workspace()
+    shared = create_project("shared", test_workspace, owner)
+    shared.set_role(user.id, ProjectRole.READER)
+    public = create_project("public", test_workspace, owner)
+    public.public = True
+    create_project("private", test_workspace, owner)
+    db.session.commit()
+
+    def accessible(**kwargs):
+        query = ProjectPermissions.Read.query(user, **kwargs)
+        return sorted(
+            p.name for p in query.filter(Project.creator_id == owner.id).all()
+        )
+
+    with patch.object(Configuration, "GLOBAL_READ", False), patch.object(
+        Configuration, "GLOBAL_WRITE", False
+    ), patch.object(Configuration, "GLOBAL_ADMIN", False):
+        assert accessible() == ["public", "shared"]
+        assert accessible(public=False) == ["shared"]
+        # project shared with user which is also public is listed once
+        shared.public = True
+        db.session.commit()
+        assert accessible() == ["public", "shared"]
+    with patch.object(Configuration, "GLOBAL_READ", True), patch.object(
+        Configuration, "GLOBAL_WRITE", False
+    ), patch.object(Configuration, "GLOBAL_ADMIN", False):
+        assert accessible(public=False) == ["private", "public", "shared"]
+    assert sorted(
+        p.name
+        for p in ProjectPermissions.Read.query(AnonymousUserMixin()).filter(
+            Project.creator_id == owner.id
+        )
+    ) == ["public", "shared"]
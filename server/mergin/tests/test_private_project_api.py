@@ -418,6 +418,32 @@ def test_admin_project_list(client):
     resp = client.get("/app/admin/projects?page=1&per_page=15&like=mergin")
     assert len(resp.json["items"]) == 15
 
+    # paginate with cursor
+    resp = client.get("/app/admin/projects?page=1&per_page=10&order_params=name ASC")
+    assert resp.json["next_cursor"]
+    resp = client.get(
+        f"/app/admin/projects?page=1&per_page=10&order_params=name ASC&count=false&cursor={resp.json['next_cursor']}"
+    )
+    assert resp.status_code == 200
+    assert resp.json["count"] is None
+    assert [p["name"] for p in resp.json["items"]] == [
+        "foo6",
+        "foo7",
+        "foo8",
+        "foo9",
+        "test",
+    ]
+    assert resp.json["next_cursor"] is None
+    # cursor is not supported for sorting by workspace name
+    resp = client.get(
+        "/app/admin/projects?page=1&per_page=10&order_params=workspace ASC"
+    )
+    assert resp.json["next_cursor"] is None
+    resp = client.get(
+        "/app/admin/projects?page=1&per_page=10&order_params=workspace ASC&cursor=W10="
+    )
+    assert resp.status_code == 400
+
     # delete project permanently
     p.delete()
     resp = client.get("/app/admin/projects?page=1&per_page=15&like=mergin")
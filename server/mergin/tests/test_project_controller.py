@@ -2,6 +2,7 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-MerginMaps-Commercial
 
+import base64
 import datetime
 import os
 from dataclasses import asdict
@@ -23,7 +24,7 @@ from pygeodiff import GeoDiff
 from flask import url_for, current_app
 import tempfile
 
-from sqlalchemy import desc
+from sqlalchemy import desc, event
 from ..app import db
 from ..sync.models import (
     FileDiff,
@@ -37,10 +38,15 @@ from ..sync.models import (
     FileHistory,
     PushChangeType,
     ProjectFilePath,
+    CurrentProjectFile,
+    ProjectFilesSnapshot,
 )
 from ..sync.storages.disk import copy_file as real_copy_file
+from ..sync.checkpoints import CheckpointExecutor
 from ..sync.files import files_changes_from_upload
-from ..sync.schemas import ProjectListSchema
+from ..sync.permissions import ProjectPermissionsResolver
+from ..sync.schemas import ProjectListSchema, dump_project_list
+from ..sync.schemas_v2 import ProjectSchema as ProjectSchemaV2, dump_projects
 from ..sync.utils import Checkpoint, generate_checksum, is_versioned_file
 from ..auth.models import User
 
@@ -55,6 +61,7 @@ from . import (
 )
 from .utils import (
     add_user,
+    create_blank_version,
     create_project,
     create_workspace,
     DateTimeEncoder,
@@ -62,6 +69,7 @@ from .utils import (
     login,
     file_info,
     login_as_admin,
+    push_change,
     upload_file_to_project,
 )
 from ..config import Configuration
@@ -1685,7 +1693,7 @@ def test_push_no_diff_finish(client):
             raise OSError("Mocked: copy to geodiff dir failed")
         return real_copy_file(src, dest)
 
-    with patch(
+    with patch.object(SyncConfiguration, "GEODIFF_IN_PLACE", False), patch(
         "mergin.sync.storages.disk.copy_file",
         side_effect=copy_file_failing_for_geodiff,
     ):
@@ -2019,6 +2027,68 @@ def test_file_diffs_chain(diff_project):
     assert not diffs
 
 
+def test_diff_checkpoints_plan(diff_project):
+    """Test merged diffs of the whole checkpoints tree are planned with constant number of queries"""
+    file_path_id = (
+        ProjectFilePath.query.filter_by(project_id=diff_project.id, path="test.gpkg")
+        .first()
+        .id
+    )
+    basefile = FileHistory.get_basefile(file_path_id, 10)
+    assert basefile.project_version_name == 9
+    # fake individual diffs v49-v64 of file with basefile at v9
+    for version in range(49, 65):
+        diff = FileDiff(
+            basefile, f"test.gpkg-diff-{uuid.uuid4()}", rank=0, version=version
+        )
+        db.session.add(diff)
+        diff.file = basefile.file
+        os.makedirs(os.path.dirname(diff.abs_path), exist_ok=True)
+        with open(diff.abs_path, "w") as f:
+            f.write(str(version))
+    db.session.commit()
+
+    def concat_changes(paths, output):
+        with open(output, "w") as f:
+            f.write(",".join(open(p).read() for p in paths))
+
+    # merged diff v49-v64 which requires missing lower rank diffs v49-v52, v53-v56 and v57-v60
+    checkpoint = FileDiff(
+        basefile, f"test.gpkg-diff-{uuid.uuid4()}", rank=2, version=64
+    )
+    db.session.add(checkpoint)
+    db.session.commit()
+    statements = []
+
+    def count_statements(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with patch.object(
+        diff_project.storage.geodiff, "concat_changes", side_effect=concat_changes
+    ) as mock, patch.object(
+        CheckpointExecutor, "run", autospec=True, side_effect=CheckpointExecutor.run
+    ) as run_mock:
+        event.listen(db.engine, "before_cursor_execute", count_statements)
+        assert checkpoint.construct_checkpoint()
+        event.remove(db.engine, "before_cursor_execute", count_statements)
+
+    assert mock.call_count == 4
+    # independent lower rank diffs are merged together, then the merged diff from them
+    assert [len(c.args[1]) for c in run_mock.call_args_list] == [3, 1]
+    lower_diffs = (
+        FileDiff.query.filter_by(file_path_id=file_path_id, rank=1)
+        .order_by(FileDiff.version)
+        .all()
+    )
+    assert [d.version for d in lower_diffs] == [52, 56, 60]
+    assert all(os.path.exists(d.abs_path) and d.checksum for d in lower_diffs)
+    with open(checkpoint.abs_path) as f:
+        assert f.read() == ",".join(str(v) for v in range(49, 65))
+    # history and diffs are loaded once, missing diffs are inserted at once
+    assert len([s for s in statements if s.startswith("SELECT")]) <= 6
+    assert len([s for s in statements if s.startswith("INSERT INTO file_diff")]) == 1
+
+
 changeset_data = [
     ("v1", "test.gpkg", 404),
     ("v1", "test.txt", 404),
@@ -2095,6 +2165,63 @@ def test_get_projects_by_uuids(client):
     assert resp.status_code == 400
 
 
+def test_get_paginated_projects_by_cursor(client):
+    user = User.query.filter_by(username="mergin").first()
+    test_workspace = create_workspace()
+    for i in range(14):
+        create_project("foo" + str(i), test_workspace, user)
+    # projects with the same sort key
+    Project.query.update({Project.disk_usage: 0})
+    db.session.commit()
+
+    for order_params in ("created_asc", "updated_desc", "disk_usage_desc"):
+        url = f"/v1/project/paginated?page=1&per_page=4&order_params={order_params}"
+        expected = [
+            p["name"]
+            for p in client.get(
+                f"/v1/project/paginated?page=1&per_page=15&order_params={order_params}"
+            ).json["projects"]
+        ]
+        resp = client.get(url)
+        assert resp.json["count"] == 15
+        names = [p["name"] for p in resp.json["projects"]]
+        cursor = resp.json["next_cursor"]
+        while cursor:
+            resp = client.get(url + f"&cursor={cursor}&count=false")
+            assert resp.status_code == 200
+            assert resp.json["count"] is None
+            names.extend(p["name"] for p in resp.json["projects"])
+            cursor = resp.json["next_cursor"]
+        assert names == expected
+
+    resp = client.get("/v1/project/paginated?page=1&per_page=15")
+    assert resp.json["next_cursor"] is None
+    resp = client.get("/v1/project/paginated?page=1&per_page=10&cursor=invalid")
+    assert resp.status_code == 400
+    # cursor values must match types of sort columns
+    for values in (["foo", "bar"], [1, True], [None, 1]):
+        cursor = base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+        resp = client.get(
+            f"/v1/project/paginated?page=1&per_page=10&order_params=disk_usage_desc&cursor={cursor}"
+        )
+        assert resp.status_code == 400
+
+    project = Project.query.filter_by(name="foo0").first()
+    for _ in range(5):
+        add_project_version(project, {})
+    url = f"/v1/project/versions/paginated/{test_workspace.name}/foo0?page=1&per_page=2"
+    resp = client.get(url)
+    assert resp.json["count"] == 5
+    versions = [v["name"] for v in resp.json["versions"]]
+    cursor = resp.json["next_cursor"]
+    while cursor:
+        resp = client.get(url + f"&cursor={cursor}")
+        assert resp.json["count"] == 5
+        versions.extend(v["name"] for v in resp.json["versions"])
+        cursor = resp.json["next_cursor"]
+    assert versions == ["v5", "v4", "v3", "v2", "v1"]
+
+
 versions_test_data = [
     (
         {"page": 1, "per_page": 5, "desc": False},
@@ -2178,6 +2305,55 @@ def test_project_conflict_files(diff_project, file):
     assert project_info["has_conflict"]
 
 
+def test_dump_project_list(client):
+    """Test fast path of project listing serialization is equivalent to schemas"""
+    admin = User.query.filter_by(username=DEFAULT_USER[0]).first()
+    user = add_user("user", "user")
+    inactive = add_user("inactive", "inactive")
+    test_workspace = create_workspace()
+    shared = create_project("shared", test_workspace, admin)
+    shared.set_role(user.id, ProjectRole.WRITER)
+    shared.set_role(inactive.id, ProjectRole.READER)
+    shared.tags = ["input_use"]
+    public = create_project("public", test_workspace, admin)
+    public.public = True
+    public.updated = None
+    inactive.active = False
+    db.session.commit()
+    add_project_version(
+        shared,
+        {
+            "added": [
+                {
+                    "checksum": "89469a6482267de394c7c7270cb7ffafe694ea76",
+                    "mtime": "2021-04-14T17:33:32.766731Z",
+                    "path": "test.gpkg_conflict_copy",
+                    "size": 98304,
+                }
+            ]
+        },
+    )
+    projects = Project.query.order_by(Project.created).all()
+    assert len(projects) == 3
+
+    ws_ids = [p.workspace_id for p in projects]
+    workspaces_map = {w.id: w.name for w in current_app.ws_handler.get_by_ids(ws_ids)}
+    for u in (admin, user):
+        for ctx in ({}, {"workspaces_map": workspaces_map}):
+
+            def context():
+                return {**ctx, "permissions_resolver": ProjectPermissionsResolver(u)}
+
+            expected = ProjectListSchema(many=True, context=context()).dump(projects)
+            data = dump_project_list(projects, context())
+            assert data == expected
+            assert data[1]["has_conflict"]
+            assert "inactive" not in data[1]["access"]["readersnames"]
+            assert dump_projects(projects, context()) == ProjectSchemaV2(
+                many=True, context=context()
+            ).dump(projects)
+
+
 def test_orphan_project(client):
     """Test project whose creator was removed"""
     user = add_user("tests", "tests")
@@ -2498,6 +2674,70 @@ def test_version_files(client, diff_project):
         )
 
 
+def test_version_files_from_snapshot(client, diff_project):
+    """Test version files resolved from files snapshot and replayed changes"""
+
+    def files_key(rows):
+        return sorted(
+            (r.path, r.checksum, r.location, r.diff_path, r.diff_checksum) for r in rows
+        )
+
+    with patch.dict(current_app.config, {"FILES_SNAPSHOT_RANK": 1}):
+        assert not ProjectFilesSnapshot.query.count()
+        versions = (
+            ProjectVersion.query.filter_by(project_id=diff_project.id)
+            .order_by(ProjectVersion.name)
+            .all()
+        )
+        for version in versions[:-1]:
+            # snapshots are created on demand
+            files = version.files
+            snapshot = ProjectFilesSnapshot.get_or_create(diff_project.id, version.name)
+            if version.name < 4:
+                assert snapshot is None
+                continue
+            assert snapshot.version == version.name - version.name % 4
+            assert files_key(version._files_from_snapshot(snapshot)) == files_key(
+                version._files_from_start()
+            )
+            assert sorted((f.path, f.checksum) for f in files) == sorted(
+                (r.path, r.checksum) for r in version._files_from_start()
+            )
+        assert ProjectFilesSnapshot.query.count() == (len(versions) - 1) // 4
+
+        # on demand snapshot is kept even if the caller's transaction is rolled back
+        ProjectFilesSnapshot.query.delete()
+        db.session.commit()
+        version = next(v for v in versions if v.name == 4)
+        files = version.files
+        db.session.rollback()
+        snapshot = ProjectFilesSnapshot.query.filter_by(
+            project_id=diff_project.id, version=4
+        ).first()
+        assert snapshot
+        assert sorted(snapshot.file_history_ids) == sorted(
+            r.file_history_id for r in version._files_from_start()
+        )
+        assert len(files) == len(snapshot.file_history_ids)
+
+        # snapshot is created with new version at the checkpoint end
+        while diff_project.next_version() % 4:
+            create_blank_version(diff_project)
+        push_change(diff_project, "removed", "test.txt", test_project_dir)
+        latest_version = diff_project.get_latest_version()
+        snapshot = ProjectFilesSnapshot.query.filter_by(
+            project_id=diff_project.id, version=latest_version.name
+        ).first()
+        assert snapshot
+        assert sorted(snapshot.file_history_ids) == sorted(
+            f.file_history_id
+            for f in CurrentProjectFile.query.filter_by(project_id=diff_project.id)
+        )
+        assert files_key(latest_version._files_from_snapshot(snapshot)) == files_key(
+            latest_version._files_from_start()
+        )
+
+
 def test_delete_diff_file(client):
     """Test file history in case of diff file removal"""
     # prepare: add .gpkg and update with diff
@@ -2548,21 +2788,153 @@ def test_delete_diff_file(client):
 
 
 def test_cache_files_ids(client):
-    """Test caching latest project files when it is None"""
+    """Test caching latest project files when project is updated"""
     user = User.query.filter_by(username="mergin").first()
     test_workspace = create_workspace()
     project = create_project("no_file_history", test_workspace, user)
     db.session.commit()
-    assert project.latest_project_files.file_history_ids is not None
-    project.latest_project_files.file_history_ids = None
-    db.session.commit()
-    assert project.latest_project_files.file_history_ids is None
+    assert project.files == []
     # uploading to project caches
     filename = "test.txt"
     upload_file_to_project(project, filename, client)
     fp = ProjectFilePath.query.filter_by(project_id=project.id, path=filename).first()
     fh = FileHistory.query.filter_by(file_path_id=fp.id).first()
-    assert project.latest_project_files.file_history_ids == [fh.id]
+    assert [
+        f.file_history_id
+        for f in CurrentProjectFile.query.filter_by(project_id=project.id).all()
+    ] == [fh.id]
+    assert [f.path for f in project.files] == [filename]
+
+
+def test_memoize_project_files(client):
+    """Test project files are resolved only once until project version changes"""
+    project = Project.query.filter_by(
+        workspace_id=test_workspace_id, name=test_project
+    ).first()
+    with patch.object(
+        Project, "_get_files", autospec=True, side_effect=Project._get_files
+    ) as mock_get_files:
+        files = project.files
+        assert project.files == files
+        assert project.files is not files
+        assert mock_get_files.call_count == 1
+
+        push_change(project, "removed", "test.txt", test_project_dir)
+        assert mock_get_files.call_count == 2
+        assert len(project.files) == len(files) - 1
+        assert "test.txt" not in [f.path for f in project.files]
+        assert mock_get_files.call_count == 2
+
+    # cache is bound to project instance, i.e. db session
+    db.session.expunge_all()
+    project = Project.query.filter_by(
+        workspace_id=test_workspace_id, name=test_project
+    ).first()
+    with patch.object(
+        Project, "_get_files", autospec=True, side_effect=Project._get_files
+    ) as mock_get_files:
+        assert len(project.files) == len(files) - 1
+        assert mock_get_files.call_count == 1
+
+
+def test_current_project_files(diff_project):
+    """Test current project files table is in sync with file history"""
+
+    def files_from_history(project):
+        pv = project.get_latest_version()
+        return sorted(
+            (row.path, row.size, row.checksum, row.location, row.diff_path)
+            for row in pv._files_from_start()
+        )
+
+    def current_files(project):
+        return sorted(
+            (f.path, f.size, f.checksum, f.location, f.diff.path if f.diff else None)
+            for f in project.files
+        )
+
+    # diff project has history with updates, diffs and removals
+    assert current_files(diff_project) == files_from_history(diff_project)
+    push_change(diff_project, "removed", "test.txt", test_project_dir)
+    push_change(diff_project, "added", "test.txt", test_project_dir)
+    assert current_files(diff_project) == files_from_history(diff_project)
+    assert CurrentProjectFile.query.filter_by(
+        project_id=diff_project.id
+    ).count() == len(diff_project.files)
+
+    # cached project stats are updated by changes
+    qgs_size = next(f.size for f in diff_project.files if f.path == "test.qgs")
+    disk_usage = diff_project.disk_usage
+    assert disk_usage == sum(f.size for f in diff_project.files)
+    assert diff_project.qgis_files_count == 1
+    push_change(diff_project, "removed", "test.qgs", test_project_dir)
+    assert diff_project.disk_usage == disk_usage - qgs_size
+    assert diff_project.qgis_files_count == 0
+    assert diff_project.tags == []
+    push_change(diff_project, "added", "test.qgs", test_project_dir)
+    assert diff_project.disk_usage == disk_usage
+    assert diff_project.qgis_files_count == 1
+    assert diff_project.tags == ["valid_qgis", "input_use"]
+
+    # table is rebuilt from file history
+    CurrentProjectFile.query.filter_by(project_id=diff_project.id).delete()
+    db.session.commit()
+    diff_project.cache_latest_files()
+    assert current_files(diff_project) == files_from_history(diff_project)
+
+    # removed project files are removed together with file paths
+    diff_project.delete()
+    db.session.commit()
+    assert not CurrentProjectFile.query.filter_by(project_id=diff_project.id).count()
+
+
+def test_version_bulk_write(client):
+    """Test number of queries to create project version does not depend on number of changes"""
+    workspace = create_workspace()
+    user = User.query.filter_by(username=DEFAULT_USER[0]).first()
+    project = create_project("bulk-write", workspace, user)
+    statements = []
+
+    def count_statements(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    def push_files(count):
+        changes = {
+            "added": [
+                {
+                    "path": f"{project.next_version()}/file_{i}.txt",
+                    "size": i,
+                    "checksum": hashlib.sha1(str(i).encode()).hexdigest(),
+                    "chunks": [],
+                }
+                for i in range(count)
+            ],
+            "updated": [],
+            "removed": [],
+        }
+        file_changes = files_changes_from_upload(
+            changes, location_dir=f"v{project.next_version()}"
+        )
+        version, author_id = project.next_version(), user.id
+        statements.clear()
+        event.listen(db.engine, "before_cursor_execute", count_statements)
+        pv = ProjectVersion(project, version, author_id, file_changes, "127.0.0.1")
+        event.remove(db.engine, "before_cursor_execute", count_statements)
+        db.session.commit()
+        return pv, len(statements)
+
+    pv, queries = push_files(5)
+    assert pv.changes.count() == 5
+    pv, bulk_queries = push_files(50)
+    assert bulk_queries == queries
+    assert pv.changes.count() == 50
+    assert ProjectFilePath.query.filter_by(project_id=project.id).count() == 55
+    assert len(project.files) == 55
+    assert project.disk_usage == sum(range(5)) + sum(range(50))
+    delta = ProjectVersionDelta.query.filter_by(
+        project_id=project.id, version=pv.name, rank=0
+    ).first()
+    assert len(delta.changes) == 50
 
 
 def test_signals(client):
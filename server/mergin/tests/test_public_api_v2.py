@@ -2,7 +2,11 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-MerginMaps-Commercial
 
-from mergin.sync.tasks import remove_transaction_chunks
+from mergin.sync.tasks import (
+    finish_project_version,
+    remove_push_jobs,
+    remove_transaction_chunks,
+)
 from . import DEFAULT_USER
 from .utils import (
     add_user,
@@ -16,12 +20,16 @@ from .utils import (
 )
 
 from ..auth.models import User
+import errno
 import os
 import shutil
 from typing import List
 from unittest.mock import patch
 import uuid
+from flask import current_app
+from werkzeug.exceptions import ClientDisconnected, InternalServerError
 from pygeodiff import GeoDiffLibError
+import redis
 
 from .utils import (
     add_user,
@@ -44,19 +52,24 @@ from ..sync.models import (
     ProjectRole,
     ProjectVersionDelta,
 )
-from ..sync.files import DeltaChange, PushChangeType
+from ..sync.delta import DeltaCache, decode_changes, merge_records
+from ..sync.files import DeltaChange, DeltaChangeSchema, PushChangeType
 from ..sync.utils import Checkpoint, is_versioned_file
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import ObjectDeletedError
 import pytest
 from datetime import datetime, timedelta, timezone
+import hashlib
 import json
 import uuid
 
 from mergin.app import db
 from mergin.config import Configuration
 from mergin.sync.errors import (
+    BatchLimitError,
     BigChunkError,
+    ChunkOffsetMismatch,
+    DataSyncError,
     DiffDownloadError,
     ProjectLocked,
     ProjectVersionExists,
@@ -66,13 +79,16 @@ from mergin.sync.errors import (
 )
 from mergin.sync.files import ChangesSchema
 from mergin.sync.models import (
+    GeodiffActionHistory,
     Project,
     ProjectRole,
     ProjectVersion,
+    PushJob,
     SyncFailuresHistory,
     Upload,
 )
-from mergin.sync.utils import get_chunk_location
+from mergin.sync.storages.disk import exclusive_lock
+from mergin.sync.utils import generate_checksum, get_chunk_location
 from . import TMP_DIR, test_project, test_workspace_id, test_project_dir
 from .test_project_controller import (
     CHUNK_SIZE,
@@ -533,6 +549,75 @@ def test_delta_merge_changes():
     assert merged[0].checksum == delete8.checksum
 
 
+def test_delta_records():
+    """Test changes json is decoded to records and merged the same way as changes loaded by schema"""
+    changes = [
+        {
+            "path": "file1.gpkg",
+            "size": 100,
+            "checksum": "abc",
+            "version": 1,
+            "change": "create",
+        },
+        {
+            "path": "file2.txt",
+            "size": 1,
+            "checksum": "a",
+            "version": 1,
+            "change": "create",
+        },
+        {
+            "path": "file3.txt",
+            "size": 1,
+            "checksum": "b",
+            "version": 1,
+            "change": "update",
+        },
+        {
+            "path": "file2.txt",
+            "size": 0,
+            "checksum": "c",
+            "version": 2,
+            "change": "delete",
+        },
+        {
+            "path": "file3.txt",
+            "size": 0,
+            "checksum": "d",
+            "version": 3,
+            "change": "delete",
+        },
+    ] + [
+        {
+            "path": "file4.gpkg",
+            "size": 100 + i,
+            "checksum": f"diff{i}",
+            "version": i,
+            "change": "update_diff",
+            "diff": f"file4.gpkg-diff{i}",
+        }
+        for i in range(1, 6)
+    ]
+    records = decode_changes(changes)
+    assert [r.to_json(r.diffs[0] if r.diffs else None) for r in records] == changes
+
+    merged = merge_records(decode_changes(changes))
+    assert [r.to_merged() for r in merged] == ProjectVersionDelta.merge_changes(
+        DeltaChangeSchema(many=True).load(changes)
+    )
+    # file created and removed within range is excluded, removed existing file is kept
+    assert [(r.path, r.change, r.version) for r in merged] == [
+        ("file1.gpkg", PushChangeType.CREATE, 1),
+        ("file3.txt", PushChangeType.DELETE, 3),
+        ("file4.gpkg", PushChangeType.UPDATE_DIFF, 5),
+    ]
+    assert merged[2].diffs == [f"file4.gpkg-diff{i}" for i in range(1, 6)]
+    assert merged[2].to_merged().diffs[0].id == "file4.gpkg-diff1"
+    assert merged[2].to_json("checkpoint-diff")["diff"] == "checkpoint-diff"
+    with pytest.raises(AssertionError):
+        merged[2].to_json()
+
+
 def test_delta_cross_checkpoint_create_delete_recreate(client):
     """
     Setup (rank-1 chunks cover 4 versions each, 4^1=4):
@@ -997,9 +1082,7 @@ def test_create_version(client, data, expected, err_code):
                     chunks.append(chunk_location)
                     chunk_ids.append(chunk)
 
-    with patch(
-        "mergin.sync.public_api_v2_controller.remove_transaction_chunks.delay"
-    ) as mock_remove:
+    with patch("mergin.sync.tasks.remove_transaction_chunks.delay") as mock_remove:
         response = client.post(f"v2/projects/{project.id}/versions", json=data)
     assert response.status_code == expected
     if expected == 201:
@@ -1022,6 +1105,159 @@ def test_create_version(client, data, expected, err_code):
                 assert failure.error_type == "project_push"
 
 
+def test_process_chunks_in_parallel(client):
+    """Test push files are processed concurrently with the same outcome as sequential processing"""
+    project = Project.query.filter_by(
+        workspace_id=test_workspace_id, name=test_project
+    ).first()
+    changes = _get_changes_with_diff(test_project_dir)
+    # mimic chunks were uploaded, except for the first file
+    for f in changes["updated"][1:]:
+        src_file = (
+            os.path.join(TMP_DIR, f["diff"]["path"])
+            if f.get("diff")
+            else os.path.join(test_project_dir, f["path"])
+        )
+        with open(src_file, "rb") as in_file:
+            for chunk in f["chunks"]:
+                chunk_location = get_chunk_location(chunk)
+                os.makedirs(os.path.dirname(chunk_location), exist_ok=True)
+                with open(chunk_location, "wb") as out_file:
+                    out_file.write(in_file.read(CHUNK_SIZE))
+
+    upload = Upload.create_upload(project.id, 1, changes, 1)
+    file_changes, errors = upload.process_chunks(use_shared_chunk_dir=True, workers=4)
+    assert [f.path for f in file_changes] == [
+        f["path"] for f in changes["updated"] + changes["removed"]
+    ]
+    assert errors == {changes["updated"][0]["path"]: "corrupted"}
+    gpkg = next(f for f in file_changes if f.path == "base.gpkg")
+    assert gpkg.change == PushChangeType.UPDATE_DIFF
+    patched_file = os.path.join(upload.upload_dir, "files", gpkg.location)
+    assert gpkg.checksum == generate_checksum(patched_file)
+    # geodiff action history created in worker is tracked in current session
+    db.session.commit()
+    assert GeodiffActionHistory.query.filter_by(project_id=project.id).count() == 1
+
+
+def test_process_chunks_checksum_mismatch(client):
+    """Test uploaded file is rejected if its checksum differs from declared one"""
+    project = Project.query.filter_by(
+        workspace_id=test_workspace_id, name=test_project
+    ).first()
+    f = file_info(test_project_dir, "test.txt", chunk_size=CHUNK_SIZE)
+    with open(os.path.join(test_project_dir, "test.txt"), "rb") as in_file:
+        for chunk in f["chunks"]:
+            chunk_location = get_chunk_location(chunk)
+            os.makedirs(os.path.dirname(chunk_location), exist_ok=True)
+            with open(chunk_location, "wb") as out_file:
+                out_file.write(in_file.read(CHUNK_SIZE))
+
+    changes = {"added": [], "updated": [f], "removed": []}
+    upload = Upload.create_upload(project.id, 1, changes, 1)
+    _, errors = upload.process_chunks(use_shared_chunk_dir=True)
+    assert not errors
+
+    f["checksum"] = hashlib.sha1(b"tampered").hexdigest()
+    upload.changes = ChangesSchema().dump(changes)
+    _, errors = upload.process_chunks(use_shared_chunk_dir=True)
+    assert errors == {"test.txt": "corrupted"}
+    upload.clear()
+
+
+def test_create_version_async(client):
+    """Test project push finished in background task"""
+    project = Project.query.filter_by(
+        workspace_id=test_workspace_id, name=test_project
+    ).first()
+    changes = _get_changes_without_added(test_project_dir)
+    for f in changes["updated"]:
+        with open(os.path.join(test_project_dir, f["path"]), "rb") as in_file:
+            for chunk in f["chunks"]:
+                chunk_location = get_chunk_location(chunk)
+                os.makedirs(os.path.dirname(chunk_location), exist_ok=True)
+                with open(chunk_location, "wb") as out_file:
+                    out_file.write(in_file.read(CHUNK_SIZE))
+
+    data = {"version": "v1", "changes": changes, "async": True}
+    with patch(
+        "mergin.sync.public_api_v2_controller.finish_project_version.delay"
+    ) as mock_finish:
+        response = client.post(f"v2/projects/{project.id}/versions", json=data)
+    assert response.status_code == 202
+    job_id = response.json["id"]
+    assert response.json["status"] == "pending"
+    assert response.json["version"] == "v2"
+    assert mock_finish.call_args.args[0] == job_id
+    # project is locked by upload until job is done
+    upload = Upload.query.filter_by(project_id=project.id).first()
+    assert str(upload.transaction_id) == job_id
+    response = client.post(f"v2/projects/{project.id}/versions", json=data)
+    assert response.status_code == 409
+    assert project.latest_version == 1
+    # upload is not taken over while its job waits in queue, even without heartbeat
+    upload.last_ping = datetime.utcnow() - timedelta(
+        seconds=client.application.config["LOCKFILE_EXPIRATION"] + 1
+    )
+    db.session.commit()
+    response = client.post(f"v2/projects/{project.id}/versions", json=data)
+    assert response.status_code == 409
+    assert Upload.query.filter_by(project_id=project.id).count() == 1
+
+    url = f"v2/projects/{project.id}/versions/jobs/{job_id}"
+    assert client.get(url).json["status"] == "pending"
+    with patch("mergin.sync.tasks.remove_transaction_chunks.delay"):
+        finish_project_version(*mock_finish.call_args.args)
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.json["status"] == "finished"
+    assert response.json["error"] is None
+    assert project.latest_version == 2
+    assert not Upload.query.filter_by(project_id=project.id).count()
+    # job does not belong to other project
+    assert (
+        client.get(f"v2/projects/{uuid.uuid4()}/versions/jobs/{job_id}").status_code
+        == 404
+    )
+    assert (
+        client.get(f"v2/projects/{project.id}/versions/jobs/{uuid.uuid4()}").status_code
+        == 404
+    )
+
+    # failed job, chunks are not available anymore
+    data["version"] = "v2"
+    data["changes"]["removed"] = []
+    with patch(
+        "mergin.sync.public_api_v2_controller.finish_project_version.delay"
+    ) as mock_finish:
+        response = client.post(f"v2/projects/{project.id}/versions", json=data)
+    assert response.status_code == 202
+    for f in changes["updated"]:
+        for chunk in f["chunks"]:
+            os.remove(get_chunk_location(chunk))
+    finish_project_version(*mock_finish.call_args.args)
+    job = client.get(
+        f"v2/projects/{project.id}/versions/jobs/{response.json['id']}"
+    ).json
+    assert job["status"] == "failed"
+    assert job["error"]["code"] == DataSyncError.code
+    assert project.latest_version == 2
+    assert not Upload.query.filter_by(project_id=project.id).count()
+    failure = SyncFailuresHistory.query.filter_by(project_id=project.id).first()
+    assert failure.error_type == "project_push"
+
+    # finished jobs are removed after a while
+    remove_push_jobs()
+    assert PushJob.query.filter_by(project_id=project.id).count() == 2
+    PushJob.query.filter_by(id=job_id).update(
+        {"finished": datetime.utcnow() - timedelta(days=8)}
+    )
+    db.session.commit()
+    remove_push_jobs()
+    assert PushJob.query.filter_by(project_id=project.id).count() == 1
+    assert not PushJob.query.get(job_id)
+
+
 def test_create_version_failures(client):
     """Test various project push failures beyond invalid payload"""
     project = Project.query.filter_by(
@@ -1145,6 +1381,221 @@ def test_upload_chunk(client):
         assert f.read() == b"a" * max_chunk_size
 
 
+def test_upload_chunk_by_checksum(client):
+    """Test content addressed chunks are deduplicated"""
+    project = Project.query.filter_by(
+        workspace_id=test_workspace_id, name=test_project
+    ).first()
+    url = f"/v2/projects/{project.id}/chunks"
+    data = os.urandom(1024)
+    checksum = hashlib.sha1(data).hexdigest()
+
+    response = client.post(
+        f"/v2/projects/{project.id}/chunks/batch", json={"checksums": [checksum]}
+    )
+    assert response.status_code == 200
+    assert response.json["chunks"] == []
+
+    # checksum does not match data
+    response = client.post(
+        f"{url}?checksum={checksum}",
+        data=b"a" + data,
+        headers={"Content-Type": "application/octet-stream"},
+    )
+    assert response.status_code == 400
+    assert not os.path.exists(get_chunk_location(checksum, project.workspace_id))
+    response = client.post(
+        f"{url}?checksum=invalid",
+        data=data,
+        headers={"Content-Type": "application/octet-stream"},
+    )
+    assert response.status_code == 400
+
+    response = client.post(
+        f"{url}?checksum={checksum}",
+        data=data,
+        headers={"Content-Type": "application/octet-stream"},
+    )
+    assert response.status_code == 200
+    assert response.json["id"] == checksum
+    with open(get_chunk_location(checksum, project.workspace_id), "rb") as f:
+        assert f.read() == data
+    # no leftovers from writing chunk aside
+    chunk_name = os.path.basename(get_chunk_location(checksum, project.workspace_id))
+    assert not [
+        f
+        for f in os.listdir(
+            os.path.dirname(get_chunk_location(checksum, project.workspace_id))
+        )
+        if f.startswith(chunk_name + ".")
+    ]
+
+    # the same chunk is not written again
+    with patch("mergin.sync.public_api_v2_controller.save_to_file") as mock_save:
+        response = client.post(
+            f"{url}?checksum={checksum}",
+            data=data,
+            headers={"Content-Type": "application/octet-stream"},
+        )
+        assert response.status_code == 200
+        assert response.json["id"] == checksum
+        assert not mock_save.called
+
+    response = client.post(
+        f"/v2/projects/{project.id}/chunks/batch",
+        json={"checksums": [checksum, checksum.upper(), "a" * 40, "invalid"]},
+    )
+    assert response.status_code == 200
+    assert [c["id"] for c in response.json["chunks"]] == [checksum]
+    assert response.json["chunks"][0]["valid_until"]
+
+    client.application.config["MAX_BATCH_SIZE"] = 1
+    response = client.post(
+        f"/v2/projects/{project.id}/chunks/batch",
+        json={"checksums": [checksum, "a" * 40]},
+    )
+    assert response.status_code == 400
+    assert response.json["code"] == BatchLimitError.code
+
+    # shared chunks are not removed with upload transaction
+    remove_transaction_chunks([checksum])
+    assert os.path.exists(get_chunk_location(checksum, project.workspace_id))
+
+    # chunks are not shared with other workspaces
+    data = os.urandom(1024)
+    checksum = hashlib.sha1(data).hexdigest()
+    other_workspace_chunk = get_chunk_location(checksum, project.workspace_id + 1)
+    os.makedirs(os.path.dirname(other_workspace_chunk), exist_ok=True)
+    with open(other_workspace_chunk, "wb") as f:
+        f.write(data)
+    response = client.post(
+        f"/v2/projects/{project.id}/chunks/batch", json={"checksums": [checksum]}
+    )
+    assert response.status_code == 200
+    assert response.json["chunks"] == []
+    changes = {
+        "added": [
+            {
+                "path": "chunk.bin",
+                "size": len(data),
+                "checksum": checksum,
+                "chunks": [checksum],
+            }
+        ],
+        "updated": [],
+        "removed": [],
+    }
+    upload = Upload.create_upload(project.id, 1, changes, project.creator_id)
+    _, errors = upload.process_chunks(use_shared_chunk_dir=True)
+    assert errors == {"chunk.bin": "corrupted"}
+
+
+def test_upload_chunk_resumable(client):
+    """Test chunk upload by byte ranges"""
+    project = Project.query.filter_by(
+        workspace_id=test_workspace_id, name=test_project
+    ).first()
+    url = f"/v2/projects/{project.id}/chunks"
+    data = os.urandom(3000)
+
+    def upload_range(start, stop, chunk_id=None, checksum=None):
+        params = []
+        if chunk_id:
+            params.append(f"id={chunk_id}")
+        if checksum:
+            params.append(f"checksum={checksum}")
+        return client.post(
+            f"{url}?{'&'.join(params)}",
+            data=data[start:stop],
+            headers={
+                "Content-Type": "application/octet-stream",
+                "Content-Range": f"bytes {start}-{stop - 1}/{len(data)}",
+            },
+        )
+
+    response = upload_range(0, 1000)
+    assert response.status_code == 202
+    assert response.json["offset"] == 1000
+    chunk_id = response.json["id"]
+    assert not os.path.exists(get_chunk_location(chunk_id))
+
+    # ask for current offset
+    response = client.post(
+        f"{url}?id={chunk_id}", headers={"Content-Range": f"bytes */{len(data)}"}
+    )
+    assert response.status_code == 202
+    assert response.json["offset"] == 1000
+
+    # data do not follow stored part
+    response = upload_range(500, 1500, chunk_id)
+    assert response.status_code == 416
+    assert response.json["code"] == ChunkOffsetMismatch.code
+    assert response.json["offset"] == 1000
+
+    # another request is appending data to the chunk
+    with exclusive_lock(get_chunk_location(chunk_id) + ".lock"):
+        response = upload_range(1000, 3000, chunk_id)
+        assert response.status_code == 409
+        assert response.json["code"] == AnotherUploadRunning.code
+
+    response = upload_range(1000, 3000, chunk_id)
+    assert response.status_code == 200
+    assert response.json["offset"] == 3000
+    with open(get_chunk_location(chunk_id), "rb") as f:
+        assert f.read() == data
+    assert not os.path.exists(get_chunk_location(chunk_id) + ".lock")
+
+    # content addressed chunk uploaded by parts
+    checksum = hashlib.sha1(data).hexdigest()
+    response = upload_range(0, 2000, checksum=checksum)
+    assert response.status_code == 202
+    assert response.json["id"] == checksum
+    response = upload_range(2000, 3000, checksum=checksum)
+    assert response.status_code == 200
+    assert os.path.exists(get_chunk_location(checksum, project.workspace_id))
+
+    # more data than declared by range
+    response = client.post(
+        url,
+        data=data,
+        headers={
+            "Content-Type": "application/octet-stream",
+            "Content-Range": f"bytes 0-999/{len(data)}",
+        },
+    )
+    assert response.status_code == 400
+    assert response.json["detail"].startswith("Data exceed Content-Range")
+
+    # client disconnected, upload can be resumed from the data stored so far
+    def save_part(stream, path, *args, **kwargs):
+        with open(path, "ab") as f:
+            f.write(stream.read(500))
+        raise ClientDisconnected()
+
+    with patch(
+        "mergin.sync.public_api_v2_controller.save_to_file", side_effect=save_part
+    ):
+        response = upload_range(0, 1000)
+    assert response.status_code == 202
+    assert response.json["offset"] == 500
+
+    # server errors are not hidden as client errors
+    with patch(
+        "mergin.sync.public_api_v2_controller.save_to_file",
+        side_effect=OSError(errno.ENOSPC, "No space left on device"),
+    ), pytest.raises(InternalServerError):
+        upload_range(0, 1000)
+
+    # invalid requests
+    response = upload_range(0, 1000, chunk_id="../../chunk")
+    assert response.status_code == 400
+    response = client.post(url, data=data, headers={"Content-Range": "invalid"})
+    assert response.status_code == 400
+    client.application.config["MAX_CHUNK_SIZE"] = 1024
+    response = upload_range(0, 1000)
+    assert response.status_code == 413
+
+
 def test_full_push(client):
     """Test full project push with upload of chunks and project version creation"""
     project = Project.query.filter_by(
@@ -1311,6 +1762,67 @@ def test_project_pull_diffs(client, diff_project):
     assert response.status_code == 200
 
 
+def test_project_delta_cache(client, diff_project):
+    """Test delta responses are computed once for the same version range"""
+    cache: DeltaCache = current_app.delta_cache
+    url = f"v2/projects/{diff_project.id}/delta?since=v4&to=v8"
+    response = client.get(url)
+    assert response.status_code == 200
+    assert cache.get(DeltaCache.key(diff_project.id, 4, 8)) == response.get_data(
+        as_text=True
+    )
+
+    with patch.object(Project, "get_delta_changes") as delta_mock:
+        hits = cache.hits
+        cached_response = client.get(url)
+        assert cached_response.status_code == 200
+        assert cached_response.json == response.json
+        assert cache.hits == hits + 1
+        # latest version is resolved before cache lookup
+        response = client.get(f"v2/projects/{diff_project.id}/delta?since=v4")
+        assert response.status_code == 200
+        delta_mock.assert_called_once_with(4, 10)
+
+    # failed delta is not cached
+    with patch.object(Project, "get_delta_changes", return_value=None):
+        response = client.get(f"v2/projects/{diff_project.id}/delta?since=v1&to=v2")
+        assert response.status_code == 200
+        assert response.json["items"] == []
+    assert cache.get(DeltaCache.key(diff_project.id, 1, 2)) is None
+
+
+def test_delta_cache():
+    """Test local LRU bounded by size and shared cache backend"""
+    cache = DeltaCache(10)
+    cache.set("a", "12345")
+    cache.set("b", "123")
+    assert cache.get("a") == "12345"
+    # b is the least recently used
+    cache.set("c", "1234")
+    assert cache.get("b") is None
+    assert cache.get("a") == "12345" and cache.get("c") == "1234"
+    assert cache.size == 9
+    # too large entry is not cached at all
+    cache.set("d", "x" * 11)
+    assert cache.get("d") is None
+    assert cache.size == 9
+
+    with patch("mergin.sync.delta.redis.Redis.from_url") as redis_mock:
+        shared = redis_mock.return_value
+        cache = DeltaCache(10, "redis://localhost:6379/1", 60)
+        cache.set("a", "123")
+        shared.set.assert_called_once_with("a", "123", ex=60)
+        # entry computed by other worker
+        shared.get.return_value = b"456"
+        assert cache.get("b") == "456"
+        # and kept locally
+        shared.get.return_value = None
+        assert cache.get("b") == "456"
+        # shared backend failure is just a cache miss
+        shared.get.side_effect = redis.RedisError
+        assert cache.get("c") is None
+
+
 def test_list_workspace_projects(client):
     admin = User.query.filter_by(username=DEFAULT_USER[0]).first()
     test_workspace = create_workspace()
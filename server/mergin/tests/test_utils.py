@@ -3,9 +3,13 @@
 # SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-MerginMaps-Commercial
 
 import base64
+import hashlib
 from datetime import datetime
 import json
 import pytest
+import subprocess
+import sys
+import textwrap
 from flask import url_for, current_app
 from marshmallow import Schema, fields
 from sqlalchemy import desc
@@ -18,6 +22,7 @@ from pathlib import PureWindowsPath
 from ..utils import save_diagnostic_log_file, get_schema_fields_map
 
 from ..sync.utils import (
+    TimeSlicedYield,
     is_reserved_word,
     has_valid_characters,
     has_valid_first_character,
@@ -30,7 +35,10 @@ from ..sync.utils import (
     wkb2wkt,
     has_trailing_space,
     check_skip_validation,
+    checksum_cache_location,
+    generate_checksum,
 )
+from ..sync.files import ProjectFile, changes_size_delta, index_files
 from ..auth.models import LoginHistory, User
 from . import json_headers
 from .utils import login
@@ -402,3 +410,120 @@ def test_mime_type_validation_skip():
 
         # Should be forbidden
         assert not is_supported_type("other.js")
+
+
+def test_time_sliced_yield():
+    """Yield to gevent hub only when time slice passed"""
+    with patch("mergin.sync.utils.sleep") as mock_sleep:
+        cooperative_yield = TimeSlicedYield(1000)
+        for _ in range(100):
+            cooperative_yield()
+        assert not mock_sleep.called
+
+        cooperative_yield = TimeSlicedYield(0)
+        for _ in range(100):
+            cooperative_yield()
+        assert mock_sleep.call_count == 100
+
+
+def test_generate_checksum(tmp_path):
+    """Test checksum calculation with threadpool and cache"""
+    file = tmp_path / "data.bin"
+    data = os.urandom(3 * 1024 + 5)
+    file.write_bytes(data)
+    expected = hashlib.sha1(data).hexdigest()
+    assert generate_checksum(str(file), chunk_size=1024) == expected
+    empty_file = tmp_path / "empty.bin"
+    empty_file.touch()
+    assert generate_checksum(str(empty_file)) == hashlib.sha1().hexdigest()
+
+    # hashing is offloaded to native thread under gevent
+    with patch("mergin.sync.utils.is_module_patched", return_value=True), patch(
+        "mergin.sync.utils._sha1_file", wraps=lambda *args: expected
+    ) as mock_sha1:
+        assert generate_checksum(str(file)) == expected
+        assert len(mock_sha1.call_args.args) == 2
+
+    cache_dir = tmp_path / "checksums"
+    with patch("mergin.sync.utils.Configuration.CHECKSUM_CACHE_DIR", str(cache_dir)):
+        assert generate_checksum(str(file)) == expected
+        cache_file = checksum_cache_location(os.stat(file))
+        assert os.path.exists(cache_file)
+        with open(cache_file) as f:
+            assert f.read() == expected
+        # file is not read again
+        with patch("mergin.sync.utils._sha1_file") as mock_sha1:
+            assert generate_checksum(str(file)) == expected
+            assert not mock_sha1.called
+
+        # invalid cache entry is ignored
+        with open(cache_file, "w") as f:
+            f.write("foo")
+        assert generate_checksum(str(file)) == expected
+
+        # modified file invalidates cache entry
+        data = os.urandom(1024)
+        file.write_bytes(data)
+        assert checksum_cache_location(os.stat(file)) != cache_file
+        assert generate_checksum(str(file)) == hashlib.sha1(data).hexdigest()
+
+
+def test_thread_pool_executor_monkey_patched():
+    """Test blocking calls run in parallel native threads when gevent monkey patching is active"""
+    script = textwrap.dedent(
+        """
+        from gevent import monkey
+
+        monkey.patch_all()
+
+        import time
+        from gevent.monkey import get_original
+        from mergin.sync.utils import thread_pool_executor
+
+        blocking_sleep = get_original("time", "sleep")
+        get_ident = get_original("threading", "get_ident")
+
+        def work(i):
+            # mimic blocking C call (e.g. geodiff) which does not yield to gevent hub
+            blocking_sleep(0.5)
+            return get_ident()
+
+        start = time.monotonic()
+        with thread_pool_executor(4) as executor:
+            idents = list(executor.map(work, range(4)))
+        print(len(set(idents)), get_ident() in idents, time.monotonic() - start)
+        """
+    )
+    server_dir = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+    output = subprocess.run(
+        [sys.executable, "-c", script],
+        cwd=server_dir,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout.split()
+    threads, in_main_thread, elapsed = int(output[0]), output[1], float(output[2])
+    assert threads == 4
+    assert in_main_thread == "False"
+    # sequential run would take 2 seconds
+    assert elapsed < 1.5
+
+
+def test_changes_size_delta():
+    """Test size difference of push changes against indexed project files"""
+    files = index_files(
+        [
+            ProjectFile(
+                path=path, checksum="0", size=size, diff=None, mtime=None, location=""
+            )
+            for path, size in (("a.txt", 10), ("b.txt", 20), ("c.txt", 30))
+        ]
+    )
+    assert list(files.keys()) == ["a.txt", "b.txt", "c.txt"]
+    changes = {
+        "added": [{"path": "d.txt", "size": 5}],
+        "updated": [{"path": "a.txt", "size": 15}],
+        "removed": [{"path": "c.txt", "size": 30}],
+    }
+    assert changes_size_delta(changes, files) == 5 + 15 - 10 - 30
+    assert changes_size_delta({"added": [], "updated": [], "removed": []}, files) == 0
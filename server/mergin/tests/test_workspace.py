@@ -3,14 +3,16 @@
 # SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-MerginMaps-Commercial
 import datetime
 import os
+from unittest.mock import Mock
 
+import pytest
 from sqlalchemy import null
 
 from ..app import db
 from ..config import Configuration
 from ..sync.interfaces import WorkspaceRole
 from ..sync.models import FileHistory, ProjectVersion, PushChangeType, ProjectFilePath
-from ..sync.workspace import GlobalWorkspaceHandler
+from ..sync.workspace import CachedWorkspaceHandler, GlobalWorkspaceHandler
 from .utils import add_user, login, create_project
 
 
@@ -98,6 +100,40 @@ def test_workspace_implementation(client):
     assert handler.monthly_contributors_count() == 2
 
 
+def test_cached_workspace_handler(client):
+    """Test workspace lookups are cached by wrapper of workspace handler"""
+    handler = CachedWorkspaceHandler(GlobalWorkspaceHandler(), ttl=60)
+    assert isinstance(client.application.ws_handler, CachedWorkspaceHandler)
+
+    ws = handler.get(1)
+    assert (handler.hits, handler.misses) == (0, 1)
+    assert handler.get(1) is ws
+    assert handler.get_by_name(Configuration.GLOBAL_WORKSPACE) is ws
+    assert handler.get_by_ids([1, 1]) == [ws]
+    assert (handler.hits, handler.misses) == (3, 1)
+    # not found workspaces are not cached
+    assert not handler.get_by_name("foo")
+    assert not handler.get_by_name("foo")
+    assert handler.misses == 3
+    # other methods are passed to wrapped handler
+    assert handler.list_active()[0].name == ws.name
+    # cached workspace follows configuration
+    storage = Configuration.GLOBAL_STORAGE
+    Configuration.GLOBAL_STORAGE = 1024
+    assert handler.get(1).storage == 1024
+    Configuration.GLOBAL_STORAGE = storage
+
+    # expired entries are loaded again
+    handler.ttl = 0
+    handler._by_id.clear()
+    handler.get(1)
+    assert handler.get_by_name(Configuration.GLOBAL_WORKSPACE) is not ws
+    assert handler.misses == 5
+    # workspaces of other handlers may be bound to db session
+    with pytest.raises(TypeError):
+        CachedWorkspaceHandler(Mock(), ttl=60)
+
+
 def test_workspace(client):
     """Test get global workspace"""
     resp = client.get("/v1/workspaces")
@@ -1,9 +1,12 @@
 # Copyright (C) Lutra Consulting Limited
 #
 # SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-MerginMaps-Commercial
+import base64
+import json
 import logging
 
 import math
+import uuid
 from collections import namedtuple
 from datetime import datetime, timedelta, timezone
 from enum import Enum
@@ -12,9 +15,12 @@ from flask import current_app
 from flask_sqlalchemy.model import Model
 from marshmallow import Schema, fields
 from pathvalidate import sanitize_filename
-from sqlalchemy import Column, JSON
+from sqlalchemy import Column, JSON, and_, false, or_, true
+from sqlalchemy.engine import Row
+from sqlalchemy.orm import Query
+from sqlalchemy.sql import operators
 from sqlalchemy.sql.elements import UnaryExpression
-from typing import Optional, Type
+from typing import List, Optional, Tuple, Type
 
 OrderParam = namedtuple("OrderParam", "name direction")
 
@@ -172,3 +178,147 @@ def get_schema_fields_map(schema: Type[Schema]) -> dict:
         else:
             mapping[name] = name
     return mapping
+
+
+def _keyset_column(clause) -> Tuple[Column, bool]:
+    """Column and descending flag of order by clause usable for keyset pagination"""
+    descending = False
+    if isinstance(clause, UnaryExpression) and clause.modifier in (
+        operators.asc_op,
+        operators.desc_op,
+    ):
+        descending = clause.modifier is operators.desc_op
+        clause = clause.element
+    if not isinstance(clause, Column):
+        raise ValueError(f"Unsupported order by clause for cursor: {clause}")
+    return clause, descending
+
+
+def _encode_cursor(values: list) -> str:
+    data = json.dumps(
+        [v.isoformat() if isinstance(v, datetime) else v for v in values],
+        default=str,
+    )
+    return base64.urlsafe_b64encode(data.encode()).decode()
+
+
+def _decode_cursor(cursor: str, columns: List[Column]) -> list:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(values, list) or len(values) != len(columns):
+            raise ValueError("Invalid cursor")
+        decoded = []
+        for value, column in zip(values, columns):
+            python_type = column.type.python_type
+            if value is not None and python_type is datetime:
+                value = datetime.fromisoformat(value)
+            elif value is not None and python_type is uuid.UUID:
+                value = uuid.UUID(value)
+            # value is compared with column in db query, it must not fail there
+            if value is not None and (
+                not isinstance(value, python_type)
+                or (isinstance(value, bool) and python_type is not bool)
+            ):
+                raise ValueError("Invalid cursor")
+            decoded.append(value)
+        return decoded
+    except (TypeError, AttributeError, NotImplementedError, json.JSONDecodeError) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def _keyset_order(query: Query, key) -> Tuple[Query, List[Tuple[Column, bool]]]:
+    """Query ordering made unique by key column, as list of columns with descending flag"""
+    if hasattr(key, "__clause_element__"):
+        key = key.__clause_element__()
+    order_by = [_keyset_column(c) for c in query._order_by_clauses]
+    if not any(column.compare(key) for column, _ in order_by):
+        order_by.append((key, False))
+        query = query.order_by(key)
+    return query, order_by
+
+
+def get_cursor(query: Query, key, item) -> Optional[str]:
+    """Cursor of page which follows the item in ordered query, None if query ordering does not support cursor"""
+    try:
+        _, order_by = _keyset_order(query, key)
+    except ValueError:
+        return None
+    # query can return rows with additional columns to entity
+    if isinstance(item, Row):
+        item = item[0]
+    return _encode_cursor([getattr(item, column.key) for column, _ in order_by])
+
+
+def paginate_by_cursor(
+    query: Query, per_page: int, key, cursor: Optional[str] = None
+) -> Tuple[list, Optional[str]]:
+    """Paginate ordered query with cursor (keyset pagination).
+
+    Cursor holds sort key of the last item of the previous page, hence next page is filtered by sort key
+    rather than skipped by offset and any page costs the same as the first one.
+    Ordering of query is made unique by appending key column (e.g. primary key).
+    Database default ordering of nulls is assumed (nulls are last in ascending order).
+
+    :param query: ordered query, order by clauses must be plain (optionally asc/desc) columns
+    :param per_page: number of items per page
+    :param key: unique column of queried entity
+    :param cursor: cursor of requested page, None for the first page
+    :returns: items of page and cursor of the next page, None if there is no next page
+    :raises ValueError: if query ordering is not supported or cursor is invalid
+    """
+    query, order_by = _keyset_order(query, key)
+    columns = [column for column, _ in order_by]
+    if cursor:
+        values = _decode_cursor(cursor, columns)
+        conditions = []
+        for i, ((column, descending), value) in enumerate(zip(order_by, values)):
+            # items with the same sort key in preceding columns and after the cursor in this one
+            if value is None:
+                after = column.isnot(None) if descending else false()
+            elif descending:
+                after = column < value
+            else:
+                after = or_(column > value, column.is_(None))
+            equal = [
+                c.is_(None) if v is None else c == v
+                for c, v in zip(columns[:i], values[:i])
+            ]
+            conditions.append(and_(true(), *equal, after))
+        query = query.filter(or_(*conditions))
+
+    items = query.limit(per_page + 1).all()
+    if len(items) <= per_page:
+        return items, None
+    items = items[:per_page]
+    return items, get_cursor(query, key, items[-1])
+
+
+def paginate_query(
+    query: Query,
+    page: int,
+    per_page: int,
+    key,
+    cursor: Optional[str] = None,
+    count: bool = True,
+) -> Tuple[list, Optional[int], Optional[str]]:
+    """Paginate ordered query either by cursor (if provided) or by page number.
+
+    :param query: ordered query
+    :param page: page number, ignored if cursor is provided
+    :param per_page: number of items per page
+    :param key: unique column of queried entity
+    :param cursor: cursor of requested page
+    :param count: whether to count total number of items
+    :returns: items of page, total number of items (None if not counted) and cursor of the next page
+    :raises ValueError: if cursor is invalid or query ordering does not support it
+    """
+    if cursor:
+        items, next_cursor = paginate_by_cursor(query, per_page, key, cursor)
+        total = query.order_by(None).count() if count else None
+        return items, total, next_cursor
+
+    pagination = query.paginate(page=page, per_page=per_page, count=count)
+    items = pagination.items
+    has_next = pagination.has_next if count else len(items) == per_page
+    next_cursor = get_cursor(query, key, items[-1]) if items and has_next else None
+    return items, pagination.total, next_cursor
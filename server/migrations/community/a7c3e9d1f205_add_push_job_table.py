@@ -0,0 +1,62 @@
+"""Add push_job table for asynchronous project push
+
+Revision ID: a7c3e9d1f205
+Revises: f1d9e4a7b823
+Create Date: 2026-10-17 00:00:00.000000
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = "a7c3e9d1f205"
+down_revision = "f1d9e4a7b823"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "push_job",
+        sa.Column("id", postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column("project_id", postgresql.UUID(as_uuid=True), nullable=True),
+        sa.Column("version", sa.Integer(), nullable=False),
+        sa.Column("user_id", sa.Integer(), nullable=True),
+        sa.Column(
+            "status",
+            postgresql.ENUM("pending", "finished", "failed", name="push_job_status"),
+            nullable=False,
+        ),
+        sa.Column("error", postgresql.JSONB(astext_type=sa.Text()), nullable=True),
+        sa.Column("created", sa.DateTime(), nullable=True),
+        sa.Column("finished", sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(
+            ["project_id"],
+            ["project.id"],
+            name=op.f("fk_push_job_project_id_project"),
+            ondelete="CASCADE",
+        ),
+        sa.ForeignKeyConstraint(
+            ["user_id"],
+            ["user.id"],
+            name=op.f("fk_push_job_user_id_user"),
+            ondelete="SET NULL",
+        ),
+        sa.PrimaryKeyConstraint("id", name=op.f("pk_push_job")),
+    )
+    op.create_index(
+        op.f("ix_push_job_project_id"), "push_job", ["project_id"], unique=False
+    )
+    op.create_index(op.f("ix_push_job_status"), "push_job", ["status"], unique=False)
+    op.create_index(op.f("ix_push_job_created"), "push_job", ["created"], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f("ix_push_job_created"), table_name="push_job")
+    op.drop_index(op.f("ix_push_job_status"), table_name="push_job")
+    op.drop_index(op.f("ix_push_job_project_id"), table_name="push_job")
+    op.drop_table("push_job")
+    op.execute("DROP TYPE IF EXISTS push_job_status;")
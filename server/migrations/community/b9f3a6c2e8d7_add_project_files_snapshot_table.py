@@ -0,0 +1,43 @@
+"""Add project_files_snapshot table with files of project versions at checkpoints
+
+Revision ID: b9f3a6c2e8d7
+Revises: e2b7d5f1a9c4
+Create Date: 2026-10-17 00:00:00.000000
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = "b9f3a6c2e8d7"
+down_revision = "e2b7d5f1a9c4"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # snapshots of existing project versions are created on demand
+    op.create_table(
+        "project_files_snapshot",
+        sa.Column("project_id", postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column("version", sa.Integer(), nullable=False),
+        sa.Column(
+            "file_history_ids", postgresql.ARRAY(sa.BigInteger()), nullable=False
+        ),
+        sa.ForeignKeyConstraint(
+            ["project_id"],
+            ["project.id"],
+            name=op.f("fk_project_files_snapshot_project_id_project"),
+            ondelete="CASCADE",
+        ),
+        sa.PrimaryKeyConstraint(
+            "project_id", "version", name=op.f("pk_project_files_snapshot")
+        ),
+    )
+
+
+def downgrade():
+    op.drop_table("project_files_snapshot")
@@ -0,0 +1,101 @@
+"""Add current_project_file table with denormalized latest project files
+
+Revision ID: c4e8b2a9d316
+Revises: a7c3e9d1f205
+Create Date: 2026-10-17 00:00:00.000000
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = "c4e8b2a9d316"
+down_revision = "a7c3e9d1f205"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "current_project_file",
+        sa.Column("file_path_id", sa.BigInteger(), nullable=False),
+        sa.Column("project_id", postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column("file_history_id", sa.BigInteger(), nullable=False),
+        sa.Column("path", sa.String(), nullable=False),
+        sa.Column("size", sa.BigInteger(), nullable=False),
+        sa.Column("checksum", sa.String(), nullable=False),
+        sa.Column("location", sa.String(), nullable=True),
+        sa.Column("mtime", sa.DateTime(), nullable=True),
+        sa.Column("diff_path", sa.String(), nullable=True),
+        sa.Column("diff_size", sa.BigInteger(), nullable=True),
+        sa.Column("diff_checksum", sa.String(), nullable=True),
+        sa.Column("diff_location", sa.String(), nullable=True),
+        sa.ForeignKeyConstraint(
+            ["file_path_id"],
+            ["project_file_path.id"],
+            name=op.f("fk_current_project_file_file_path_id_project_file_path"),
+            ondelete="CASCADE",
+        ),
+        sa.ForeignKeyConstraint(
+            ["project_id"],
+            ["project.id"],
+            name=op.f("fk_current_project_file_project_id_project"),
+            ondelete="CASCADE",
+        ),
+        sa.ForeignKeyConstraint(
+            ["file_history_id"],
+            ["file_history.id"],
+            name=op.f("fk_current_project_file_file_history_id_file_history"),
+            ondelete="CASCADE",
+        ),
+        sa.PrimaryKeyConstraint("file_path_id", name=op.f("pk_current_project_file")),
+    )
+    op.create_index(
+        op.f("ix_current_project_file_project_id"),
+        "current_project_file",
+        ["project_id"],
+        unique=False,
+    )
+
+    # fill up from cached latest file history ids
+    op.execute(
+        """
+        INSERT INTO current_project_file (
+            file_path_id, project_id, file_history_id, path, size, checksum, location, mtime,
+            diff_path, diff_size, diff_checksum, diff_location
+        )
+        SELECT
+            fp.id,
+            fp.project_id,
+            fh.id,
+            fp.path,
+            fh.size,
+            fh.checksum,
+            fh.location,
+            pv.created,
+            fd.path,
+            fd.size,
+            fd.checksum,
+            fd.location
+        FROM (
+            SELECT unnest(file_history_ids) AS fh_id
+            FROM latest_project_files
+            WHERE file_history_ids IS NOT NULL
+        ) AS files_ids
+        JOIN file_history fh ON fh.id = files_ids.fh_id
+        JOIN project_file_path fp ON fp.id = fh.file_path_id
+        JOIN project_version pv ON pv.id = fh.version_id
+        LEFT OUTER JOIN file_diff fd ON fd.file_path_id = fh.file_path_id AND fd.version = fh.project_version_name AND fd.rank = 0
+        ON CONFLICT DO NOTHING;
+        """
+    )
+
+
+def downgrade():
+    op.drop_index(
+        op.f("ix_current_project_file_project_id"), table_name="current_project_file"
+    )
+    op.drop_table("current_project_file")
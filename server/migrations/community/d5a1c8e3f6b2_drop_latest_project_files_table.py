@@ -0,0 +1,106 @@
+"""Drop latest_project_files table replaced by current_project_file
+
+Revision ID: d5a1c8e3f6b2
+Revises: b9f3a6c2e8d7
+Create Date: 2026-10-17 00:00:00.000000
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = "d5a1c8e3f6b2"
+down_revision = "b9f3a6c2e8d7"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # fill up current files of projects which did not have latest files cached yet
+    op.execute(
+        """
+        INSERT INTO current_project_file (
+            file_path_id, project_id, file_history_id, path, size, checksum, location, mtime,
+            diff_path, diff_size, diff_checksum, diff_location
+        )
+        SELECT
+            fp.id,
+            fp.project_id,
+            fh.id,
+            fp.path,
+            fh.size,
+            fh.checksum,
+            fh.location,
+            pv.created,
+            fd.path,
+            fd.size,
+            fd.checksum,
+            fd.location
+        FROM (
+            SELECT DISTINCT ON (h.file_path_id) h.id, h.change
+            FROM file_history h
+            JOIN project_version v ON v.id = h.version_id
+            JOIN project p ON p.id = v.project_id
+            JOIN latest_project_files lpf ON lpf.project_id = p.id
+            WHERE lpf.file_history_ids IS NULL AND v.name <= p.latest_version
+            ORDER BY h.file_path_id, v.name DESC
+        ) AS latest
+        JOIN file_history fh ON fh.id = latest.id
+        JOIN project_file_path fp ON fp.id = fh.file_path_id
+        JOIN project_version pv ON pv.id = fh.version_id
+        LEFT OUTER JOIN file_diff fd ON fd.file_path_id = fh.file_path_id AND fd.version = fh.project_version_name AND fd.rank = 0
+        WHERE latest.change != 'delete'
+        ON CONFLICT DO NOTHING;
+        """
+    )
+    op.execute(
+        """
+        UPDATE project p
+        SET qgis_files_count = (
+            SELECT count(*)
+            FROM current_project_file cf
+            WHERE cf.project_id = p.id AND lower(cf.path) ~ '\\.(qgs|qgz)$'
+        )
+        WHERE p.qgis_files_count IS NULL;
+        """
+    )
+    op.drop_index(
+        op.f("ix_latest_project_files_project_id"), table_name="latest_project_files"
+    )
+    op.drop_table("latest_project_files")
+
+
+def downgrade():
+    op.create_table(
+        "latest_project_files",
+        sa.Column("project_id", postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column("file_history_ids", postgresql.ARRAY(sa.Integer()), nullable=True),
+        sa.ForeignKeyConstraint(
+            ["project_id"],
+            ["project.id"],
+            name=op.f("fk_latest_project_files_project_id_project"),
+            ondelete="CASCADE",
+        ),
+        sa.PrimaryKeyConstraint("project_id", name=op.f("pk_latest_project_files")),
+    )
+    op.create_index(
+        op.f("ix_latest_project_files_project_id"),
+        "latest_project_files",
+        ["project_id"],
+        unique=False,
+    )
+    op.execute(
+        """
+        INSERT INTO latest_project_files (project_id, file_history_ids)
+        SELECT
+            p.id,
+            COALESCE(
+                (SELECT array_agg(cf.file_history_id) FROM current_project_file cf WHERE cf.project_id = p.id),
+                ARRAY[]::INTEGER[]
+            )
+        FROM project p;
+        """
+    )
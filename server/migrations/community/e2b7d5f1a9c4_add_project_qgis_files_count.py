@@ -0,0 +1,38 @@
+"""Add number of QGIS files to project
+
+Revision ID: e2b7d5f1a9c4
+Revises: c4e8b2a9d316
+Create Date: 2026-10-17 00:00:00.000000
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "e2b7d5f1a9c4"
+down_revision = "c4e8b2a9d316"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("project", sa.Column("qgis_files_count", sa.Integer(), nullable=True))
+    # projects without cached latest files are left to be counted with the next push
+    op.execute(
+        """
+        UPDATE project p
+        SET qgis_files_count = (
+            SELECT count(*)
+            FROM current_project_file cf
+            WHERE cf.project_id = p.id AND lower(cf.path) ~ '\\.(qgs|qgz)$'
+        )
+        FROM latest_project_files lpf
+        WHERE lpf.project_id = p.id AND lpf.file_history_ids IS NOT NULL;
+        """
+    )
+
+
+def downgrade():
+    op.drop_column("project", "qgis_files_count")
@@ -0,0 +1,29 @@
+"""Add index of projects shared with user
+
+Revision ID: f3c9d2a7b8e1
+Revises: d5a1c8e3f6b2
+Create Date: 2026-10-17 00:00:00.000000
+
+"""
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "f3c9d2a7b8e1"
+down_revision = "d5a1c8e3f6b2"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        op.f("ix_project_member_user_id"),
+        "project_member",
+        ["user_id"],
+        unique=False,
+    )
+
+
+def downgrade():
+    op.drop_index(op.f("ix_project_member_user_id"), table_name="project_member")